@@ -0,0 +1,119 @@
+import asyncio
+import concurrent.futures
+import sqlite_utils
+from . import compact, partitions, rollups, utils
+
+
+async def iterate_in_thread(iterable, executor=None):
+    # Async generator yielding the items of a blocking iterable, running each
+    # next() call in a thread so the event loop is never blocked. Without an
+    # executor each iterable gets a thread of its own
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    iterator = iter(iterable)
+    done = object()
+    try:
+        while True:
+            item = await loop.run_in_executor(executor, next, iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await loop.run_in_executor(executor, close)
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+async def fetch_all_checkins(token, **kwargs):
+    # Async generator version of utils.fetch_all_checkins(), with the same
+    # arguments. The pages are fetched and checkins yielded from a thread
+    checkins = iterate_in_thread(utils.fetch_all_checkins(token, **kwargs))
+    try:
+        async for checkin in checkins:
+            yield checkin
+    finally:
+        await checkins.aclose()
+
+
+async def import_checkins(db_path, checkins, queue_size=10, batch_size=100, **options):
+    # Saves checkins from an async or regular iterable to the database at
+    # db_path, returning the number of distinct checkins saved. SQLite is
+    # only used from a dedicated writer thread, which opens its own
+    # connection, so any number of imports can run concurrently on one event
+    # loop. Checkins are passed to the writer in lists of batch_size, with at
+    # most queue_size lists waiting. Other options are passed to
+    # utils.save_checkins()
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue(queue_size)
+    checkin_ids = set()
+    venue_ids = set()
+
+    def queued():
+        while True:
+            batch = asyncio.run_coroutine_threadsafe(batches.get(), loop).result()
+            if batch is None:
+                return
+            for checkin in batch:
+                checkin_ids.add(checkin["id"])
+                if "venue" in checkin:
+                    venue_ids.add(checkin["venue"]["id"])
+                yield checkin
+
+    def write():
+        db = sqlite_utils.Database(db_path)
+        try:
+            utils.create_tables(db)
+            # Storage modes enabled for this database are kept up to date
+            if utils.has_row_hashes(db):
+                options.setdefault("changes", utils.ChangeDetector())
+            options.setdefault("compact", compact.has_compact_storage(db))
+            if partitions.has_partitions(db):
+                options.setdefault("partitions", partitions.Partitions(db))
+            if rollups.has_rollups(db):
+                rollups.create_rollup_triggers(db)
+            try:
+                utils.save_checkins(queued(), db, batch_size=batch_size, **options)
+            finally:
+                if options.get("partitions") is not None:
+                    options["partitions"].close()
+            utils.finish_import(db, checkin_ids, venue_ids)
+        finally:
+            db.conn.close()
+
+    async def put(batch):
+        # Waits for space in the queue, unless the writer has failed
+        putting = asyncio.ensure_future(batches.put(batch))
+        await asyncio.wait([putting, writer], return_when=asyncio.FIRST_COMPLETED)
+        if not putting.done():
+            putting.cancel()
+            writer.result()
+
+    # Regular iterables may block, for example while reading a file or
+    # fetching from the API, so they are read in a thread
+    reader = None
+    if not hasattr(checkins, "__aiter__"):
+        checkins = reader = iterate_in_thread(checkins)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    writer = loop.run_in_executor(executor, write)
+    try:
+        batch = []
+        async for checkin in checkins:
+            batch.append(checkin)
+            if len(batch) >= batch_size:
+                await put(batch)
+                batch = []
+        if batch:
+            await put(batch)
+    finally:
+        if reader is not None:
+            await reader.aclose()
+        # The writer commits what it has been sent, even if fetching failed
+        if not writer.done():
+            await put(None)
+        await writer
+        executor.shutdown(wait=False)
+    return len(checkin_ids)
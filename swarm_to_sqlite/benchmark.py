@@ -0,0 +1,175 @@
+import click
+import json
+import multiprocessing
+import os
+import platform
+import sqlite3
+import sqlite_utils
+import sys
+import tempfile
+import time
+from . import synthetic, utils
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    from importlib.metadata import version as package_version
+except ImportError:  # Python 3.7
+    package_version = None
+
+
+def bench_save_checkin(directory, checkins):
+    db = sqlite_utils.Database(os.path.join(directory, "bench.db"))
+    start = time.perf_counter()
+    for checkin in checkins:
+        utils.save_checkin(checkin, db)
+    return {"seconds": time.perf_counter() - start}
+
+
+def bench_save_checkins(directory, checkins):
+    db = sqlite_utils.Database(os.path.join(directory, "bench.db"))
+    start = time.perf_counter()
+    utils.create_tables(db)
+    utils.save_checkins(checkins, db, cache=utils.ImportCache())
+    return {"seconds": time.perf_counter() - start}
+
+
+def bench_load(directory, checkins):
+    from .cli import cli
+
+    load_path = os.path.join(directory, "checkins.json")
+    with open(load_path, "w") as fp:
+        json.dump(list(checkins), fp)
+    start = time.perf_counter()
+    cli.main(
+        [os.path.join(directory, "bench.db"), "--load", load_path, "--silent"],
+        standalone_mode=False,
+    )
+    return {"seconds": time.perf_counter() - start}
+
+
+def bench_views(directory, checkins):
+    db = sqlite_utils.Database(os.path.join(directory, "bench.db"))
+    utils.create_tables(db)
+    utils.save_checkins(checkins, db)
+    utils.create_indexes(db)
+    utils.create_views(db)
+    result = {"seconds": 0}
+    for name in utils.VIEWS:
+        start = time.perf_counter()
+        db.execute("select * from [{}]".format(name)).fetchall()
+        result["{}_seconds".format(name)] = time.perf_counter() - start
+        result["seconds"] += result["{}_seconds".format(name)]
+    return result
+
+
+def bench_fetch(directory, checkins):
+    from .mockapi import MockFoursquareAPI, benchmark_cli
+
+    api = MockFoursquareAPI(checkins)
+    return benchmark_cli(api, os.path.join(directory, "bench.db"))
+
+
+BENCHMARKS = {
+    "save_checkin": bench_save_checkin,
+    "save_checkins": bench_save_checkins,
+    "load": bench_load,
+    "views": bench_views,
+    "fetch": bench_fetch,
+}
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def installed_version(package):
+    if package_version is None:
+        return None
+    try:
+        return package_version(package)
+    except Exception:
+        return None
+
+
+def run_benchmark(name, options):
+    # Runs a single benchmark against freshly generated checkins
+    with tempfile.TemporaryDirectory() as directory:
+        checkins = synthetic.generate_checkins(**options)
+        result = BENCHMARKS[name](directory, checkins)
+        result["checkins_per_second"] = (
+            options["count"] / result["seconds"] if result["seconds"] else None
+        )
+        result["db_size_bytes"] = os.path.getsize(os.path.join(directory, "bench.db"))
+        result["peak_rss_bytes"] = peak_rss_bytes()
+        return dict(result, name=name)
+
+
+def run_benchmarks(names=None, isolate=True, **options):
+    # Runs each benchmark and returns the results as a JSON-serializable dict
+    # If isolate is True each benchmark runs in a fresh process, so that
+    # peak_rss_bytes reflects that benchmark alone
+    results = []
+    for name in names or BENCHMARKS:
+        if isolate:
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                results.append(pool.apply(run_benchmark, (name, options)))
+        else:
+            results.append(run_benchmark(name, options))
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "swarm_to_sqlite": installed_version("swarm-to-sqlite"),
+        "sqlite_utils": installed_version("sqlite-utils"),
+        "options": options,
+        "results": results,
+    }
+
+
+@click.command()
+@click.option("--count", default=1000, show_default=True, help="Checkins to generate")
+@click.option(
+    "--venue-reuse",
+    type=click.FloatRange(0, 1),
+    default=0.7,
+    show_default=True,
+    help="Probability that a checkin is at a previously seen venue",
+)
+@click.option("--photos", default=0.5, show_default=True, help="Photos per checkin")
+@click.option("--posts", default=0.1, show_default=True, help="Posts per checkin")
+@click.option("--likes", default=1.0, show_default=True, help="Likes per checkin")
+@click.option("--seed", default=0, show_default=True, help="Random seed")
+@click.option(
+    "benchmarks",
+    "--benchmark",
+    type=click.Choice(list(BENCHMARKS)),
+    multiple=True,
+    help="Benchmarks to run, defaults to all of them",
+)
+@click.option(
+    "-o", "--output", type=click.File("w"), default="-", help="Write JSON here"
+)
+def cli(count, venue_reuse, photos, posts, likes, seed, benchmarks, output):
+    "Benchmark importing synthetic checkins, outputting results as JSON"
+    results = run_benchmarks(
+        benchmarks,
+        count=count,
+        venue_reuse=venue_reuse,
+        photos=photos,
+        posts=posts,
+        likes=likes,
+        seed=seed,
+    )
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    cli()
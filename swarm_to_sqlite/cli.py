@@ -1,9 +1,47 @@
 import click
+import contextlib
+import cProfile
 import os
 import json
 import re
 import sqlite_utils
-from .utils import save_checkin, ensure_foreign_keys, create_views, fetch_all_checkins
+import time
+from .utils import (
+    save_checkins,
+    finish_import,
+    create_tables,
+    has_materialized_views,
+    has_search_index,
+    fetch_all_checkins,
+    fetch_checkins_in_windows,
+    incremental_state,
+    iter_json_records,
+    interleaved,
+    concurrently,
+    fetch_account,
+    with_account,
+    FoursquareClient,
+    ImportCache,
+    ImportStats,
+    ChangeDetector,
+    has_row_hashes,
+    bulk_import_mode,
+    ResponseCache,
+    get_import_state,
+    start_import_state,
+    checkpoint_import_state,
+    complete_import_state,
+    API_URL,
+)
+from .compact import has_compact_storage, enable_compact_storage, compact_storage_report
+from .partitions import (
+    has_partitions,
+    partition_period,
+    enable_partitions,
+    Partitions,
+    PARTITION_FORMATS,
+)
+from .rollups import has_rollups, create_rollup_triggers
 
 
 since_re = re.compile("^(\d+)(w|h|d)$")
@@ -13,21 +51,43 @@ def validate_since(ctx, param, value):
     if value:
         match = since_re.match(value)
         if not match:
-            raise click.BadParameter("since need to be in format 3d/2h/1w")
+            raise click.BadParameter(
+                "{} need to be in format 3d/2h/1w".format(param.name)
+            )
         num, unit = match.groups()
         multiplier = {"d": 24 * 60 * 60, "h": 60 * 60, "w": 7 * 24 * 60 * 60}[unit]
         return int(num) * multiplier
 
 
+def file_size(fp):
+    try:
+        return os.fstat(fp.fileno()).st_size
+    except (OSError, ValueError):
+        return None
+
+
 @click.command()
 @click.argument(
     "db_path",
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
     required=True,
 )
-@click.option("--token", envvar="FOURSQUARE_TOKEN", help="Foursquare OAuth token")
 @click.option(
-    "--load", type=click.File(), help="Load checkins from this JSON file on disk"
+    "--token",
+    "tokens",
+    envvar="FOURSQUARE_TOKEN",
+    multiple=True,
+    help="Foursquare OAuth token - can be used more than once to import checkins from multiple accounts",
+)
+@click.option(
+    "--tokens-file",
+    type=click.File(),
+    help="Import checkins for every Foursquare OAuth token in this file, one per line",
+)
+@click.option(
+    "--load",
+    type=click.File("rb"),
+    help="Load checkins from this JSON or newline-delimited JSON file on disk",
 )
 @click.option(
     "--save", type=click.File("w"), help="Save checkins to this JSON file on disk"
@@ -38,43 +98,466 @@ def validate_since(ctx, param, value):
     callback=validate_since,
     help="Look for checkins since 1w/2d/3h ago",
 )
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch checkins newer than the most recent one in the database",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted import from the last page that was saved",
+)
+@click.option(
+    "--parallel",
+    type=click.IntRange(min=1),
+    help="Backfill by fetching this many time windows of history at once",
+)
+@click.option(
+    "--prefetch",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Fetch up to this many pages of checkins in the background",
+)
+@click.option(
+    "--http-cache",
+    type=click.Path(file_okay=False, dir_okay=True),
+    help="Cache historical pages of API responses in this directory",
+)
+@click.option(
+    "--http-cache-ttl",
+    type=str,
+    default="30d",
+    show_default=True,
+    callback=validate_since,
+    help="Fetch cached pages again once they are this old",
+)
+@click.option(
+    "--http-cache-max-size",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+    help="Maximum size of the --http-cache directory in MB",
+)
+@click.option(
+    "--api-url",
+    envvar="FOURSQUARE_API_URL",
+    default=API_URL,
+    show_default=True,
+    help="Base URL of the Foursquare API, e.g. for a local mock server",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+    help="Number of checkins to write to the database at a time",
+)
+@click.option(
+    "--processes",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Transform checkins using this many worker processes",
+)
+@click.option(
+    "--commit-every",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Commit a transaction after this many checkins",
+)
+@click.option(
+    "--bulk",
+    is_flag=True,
+    help="Use WAL mode, synchronous=NORMAL and a larger cache during the import",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=10000,
+    show_default=True,
+    help="Remember this many venues, users etc per table to avoid rewriting them",
+)
+@click.option(
+    "--materialize",
+    is_flag=True,
+    help="Store venue_details and checkin_details as tables, refreshed on each import",
+)
+@click.option(
+    "--spatial-index",
+    is_flag=True,
+    help="Maintain an R*Tree index of venue locations",
+)
+@click.option(
+    "--search-index",
+    is_flag=True,
+    help="Maintain FTS5 search indexes for shouts, venues and events",
+)
+@click.option(
+    "--rollups",
+    is_flag=True,
+    help="Maintain tables of checkin counts per day, week, category, city and companion",
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Store photos and posts compactly, behind views with the same names",
+)
+@click.option(
+    "--partition",
+    type=click.Choice(list(PARTITION_FORMATS)),
+    help="Store checkins, photos and posts in a database file per year or month",
+)
+@click.option(
+    "--skip-unchanged",
+    is_flag=True,
+    help="Store a hash of each row and skip writing rows that have not changed",
+)
+@click.option(
+    "--stats",
+    "show_stats",
+    is_flag=True,
+    help="Show time spent in each stage of the import and on each table",
+)
+@click.option(
+    "--stats-json",
+    type=click.File("w"),
+    help="Write time spent in each stage of the import to this JSON file",
+)
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False),
+    help="Write cProfile data for the whole run to this file",
+)
 @click.option("-s", "--silent", is_flag=True, help="Don't show progress bar")
-def cli(db_path, token, load, save, since, silent):
+def cli(
+    db_path,
+    tokens,
+    tokens_file,
+    load,
+    save,
+    since,
+    incremental,
+    resume,
+    parallel,
+    prefetch,
+    http_cache,
+    http_cache_ttl,
+    http_cache_max_size,
+    api_url,
+    batch_size,
+    processes,
+    commit_every,
+    bulk,
+    cache_size,
+    materialize,
+    spatial_index,
+    search_index,
+    rollups,
+    compact,
+    partition,
+    skip_unchanged,
+    show_stats,
+    stats_json,
+    profile,
+    silent,
+):
     "Save Swarm checkins to a SQLite database"
-    if token and load:
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    tokens = list(tokens)
+    if tokens_file:
+        tokens.extend(line.strip() for line in tokens_file if line.strip())
+    if tokens and load:
         raise click.ClickException("Provide either --load or --token")
+    if incremental and load:
+        raise click.ClickException("--incremental cannot be used with --load")
+    if resume and load:
+        raise click.ClickException("--resume cannot be used with --load")
+    if resume and parallel:
+        # Windows are fetched out of order, so there is no single cursor
+        raise click.ClickException("--resume cannot be used with --parallel")
 
-    if not token and not load:
-        token = click.prompt(
-            "Please provide your Foursquare OAuth token", hide_input=True
-        )
+    if not tokens and not load:
+        tokens = [
+            click.prompt("Please provide your Foursquare OAuth token", hide_input=True)
+        ]
 
-    if token:
-        checkins = fetch_all_checkins(token, count_first=True, since_delta=since)
-        checkin_count = next(checkins)
-    else:
-        checkins = json.load(load)
-        checkin_count = len(checkins)
     db = sqlite_utils.Database(db_path)
-    saved = []
-    if silent:
-        for checkin in checkins:
-            save_checkin(checkin, db)
-            if save:
-                saved.append(checkin)
+    stats = None
+    if show_stats or stats_json:
+        stats = ImportStats()
+        stats.trace(db)
+
+    def stage(name):
+        return stats.timer(name) if stats else contextlib.nullcontext()
+
+    with stage("create_tables"):
+        create_tables(db)
+    if partition or has_partitions(db):
+        if has_partitions(db) and partition and partition != partition_period(db):
+            raise click.ClickException(
+                "Database is already partitioned by {}".format(partition_period(db))
+            )
+        # These modes store derived data about checkins in the main database
+        for flag, enabled in (
+            ("--compact", compact or has_compact_storage(db)),
+            ("--search-index", search_index or has_search_index(db)),
+            ("--materialize", materialize or has_materialized_views(db)),
+            ("--rollups", rollups or has_rollups(db)),
+        ):
+            if enabled:
+                raise click.ClickException(
+                    "{} cannot be used with partitioned storage".format(flag)
+                )
+        if not has_partitions(db):
+            with stage("partitions"):
+                enable_partitions(db, partition)
+    partitions = Partitions(db) if has_partitions(db) else None
+    # Storage savings are reported by the import that converts the tables
+    report_compact = compact and not has_compact_storage(db) and not silent
+    if compact and not has_compact_storage(db):
+        with stage("compact_storage"):
+            enable_compact_storage(db)
+    compact_storage = has_compact_storage(db)
+    # Materialized tables are refreshed for just the checkins and venues in
+    # this import, so their IDs are only collected when there are any
+    materialized = partitions is None and (materialize or has_materialized_views(db))
+    clients = []
+    response_caches = []
+    state_keys = []
+    bar = None
+    user_url = api_url.rstrip("/") + "/users/self"
+    checkins_url = user_url + "/checkins"
+    if tokens:
+        # With multiple tokens each account is fetched in its own thread, with
+        # checkins tagged by account and written by this thread. The account
+        # lookups and then the first pages are also fetched concurrently, as
+        # for a nightly --incremental import those are often all there is
+        multiple = len(tokens) > 1
+        clients = [FoursquareClient() for _ in tokens]
+        accounts = [None] * len(tokens)
+        if multiple:
+            with stage("fetch"):
+                users = concurrently(
+                    lambda token, client: fetch_account(token, client, url=user_url),
+                    tokens,
+                    clients,
+                )
+            for user in users:
+                db["users"].insert(user, pk="id", alter=True, replace=True)
+            accounts = [user["id"] for user in users]
+        account_checkins = []
+        for token, client, account in zip(tokens, clients, accounts):
+            # Progress is recorded in import_state so it can be resumed
+            state_key = account or "self"
+            state = get_import_state(db, state_key) if resume or incremental else None
+            if state and not state["complete"] and not resume:
+                # The newest stored checkin is not a safe starting point if
+                # older history was never fetched, so finish that first
+                if parallel:
+                    raise click.ClickException(
+                        "An earlier import was interrupted - use --resume to finish it"
+                    )
+                if not silent:
+                    click.echo(
+                        "Resuming an interrupted import - run again with "
+                        "--incremental to fetch newer checkins",
+                        err=True,
+                    )
+            after_timestamp, before_timestamp, stop_ids = None, None, None
+            if state and not state["complete"]:
+                after_timestamp = state["after_timestamp"]
+                before_timestamp = state["before_timestamp"]
+            else:
+                if incremental:
+                    after_timestamp, stop_ids = incremental_state(db, account)
+                if since:
+                    after_timestamp = max(
+                        after_timestamp or 0, int(time.time() - since)
+                    )
+            if not parallel:
+                state_keys.append(state_key)
+                if not state or state["complete"]:
+                    start_import_state(db, state_key, after_timestamp)
+            response_cache = None
+            if http_cache:
+                response_cache = ResponseCache(
+                    http_cache,
+                    ttl=http_cache_ttl,
+                    max_bytes=http_cache_max_size * 1024 * 1024,
+                    namespace=account,
+                )
+                response_caches.append(response_cache)
+            if parallel:
+                window_clients = [client] + [
+                    FoursquareClient() for _ in range(parallel - 1)
+                ]
+                clients.extend(window_clients[1:])
+                checkins = fetch_checkins_in_windows(
+                    token,
+                    workers=parallel,
+                    count_first=True,
+                    after_timestamp=after_timestamp,
+                    url=checkins_url,
+                    clients=window_clients,
+                    response_cache=response_cache,
+                )
+            else:
+                checkins = fetch_all_checkins(
+                    token,
+                    count_first=True,
+                    after_timestamp=after_timestamp,
+                    before_timestamp=before_timestamp,
+                    stop_ids=stop_ids,
+                    prefetch=prefetch,
+                    url=checkins_url,
+                    client=client,
+                    response_cache=response_cache,
+                )
+            account_checkins.append(checkins)
+        with stage("fetch"):
+            # Each generator starts by fetching its first page and yielding
+            # the total count
+            checkin_count = sum(concurrently(next, account_checkins))
+        if multiple:
+            account_checkins = [
+                with_account(checkins, account)
+                for checkins, account in zip(account_checkins, accounts)
+            ]
+            checkins = interleaved(account_checkins, 1000)
+        else:
+            checkins = account_checkins[0]
+        bar_length = checkin_count
+        label = "Importing {} checkin{}".format(
+            checkin_count, "" if checkin_count == 1 else "s"
+        )
     else:
-        with click.progressbar(
-            length=checkin_count,
-            label="Importing {} checkin{}".format(
-                checkin_count, "" if checkin_count == 1 else "s"
-            ),
-        ) as bar:
-            for checkin in checkins:
-                save_checkin(checkin, db)
+        # Progress is measured in bytes read from the file. Worker processes
+        # decode newline-delimited JSON themselves, unless the checkins are
+        # needed here for --save or materialized tables
+        checkins = iter_json_records(
+            load,
+            progress=lambda size: bar.update(size) if bar else None,
+            raw=bool(processes) and not save and not materialized,
+        )
+        bar_length = file_size(load)
+        label = "Importing checkins"
+    if stats:
+        checkins = stats.timed("fetch" if tokens else "load", checkins)
+    checkin_ids = set() if materialized else None
+    venue_ids = set() if materialized else None
+
+    def collect(checkins):
+        # Checkins are written to --save as they are read
+        if save:
+            save.write("[")
+        for i, checkin in enumerate(checkins):
+            if save:
+                save.write((", " if i else "") + json.dumps(checkin))
+            if materialized:
+                checkin_ids.add(checkin["id"])
+                if "venue" in checkin:
+                    venue_ids.add(checkin["venue"]["id"])
+            yield checkin
+            if bar is not None and tokens:
                 bar.update(1)
-                if save:
-                    saved.append(checkin)
-    ensure_foreign_keys(db)
-    create_views(db)
-    if save:
-        json.dump(saved, save)
+        if save:
+            save.write("]")
+
+    cache = ImportCache(cache_size) if cache_size else None
+    changes = None
+    if skip_unchanged or has_row_hashes(db):
+        changes = ChangeDetector()
+    save_options = dict(
+        batch_size=batch_size,
+        cache=cache,
+        stats=stats,
+        changes=changes,
+        commit_every=commit_every,
+        processes=processes,
+        checkpoint=checkpoint_import_state if state_keys else None,
+        compact=compact_storage,
+        partitions=partitions,
+    )
+    import_mode = bulk_import_mode(db) if bulk else contextlib.nullcontext()
+    if has_rollups(db):
+        # Triggers update the rollups with each checkin saved
+        create_rollup_triggers(db)
+    with import_mode:
+        if silent or not bar_length:
+            save_checkins(collect(checkins), db, **save_options)
+        else:
+            with click.progressbar(length=bar_length, label=label) as bar:
+                save_checkins(collect(checkins), db, **save_options)
+    if partitions is not None:
+        partitions.close()
+    if state_keys:
+        complete_import_state(db, state_keys)
+    finish_import(
+        db,
+        checkin_ids,
+        venue_ids,
+        materialize=materialized,
+        spatial_index=spatial_index,
+        rollups=rollups,
+        search_index=search_index,
+        stage=stage,
+    )
+    if clients and not silent:
+        request_count = sum(client.request_count for client in clients)
+        retry_count = sum(client.retry_count for client in clients)
+        click.echo(
+            "Made {} API request{} ({} bytes, {} retr{})".format(
+                request_count,
+                "" if request_count == 1 else "s",
+                sum(client.bytes_transferred for client in clients),
+                retry_count,
+                "y" if retry_count == 1 else "ies",
+            ),
+            err=True,
+        )
+    if response_caches and not silent:
+        hits = sum(response_cache.hits for response_cache in response_caches)
+        misses = sum(response_cache.misses for response_cache in response_caches)
+        click.echo(
+            "HTTP cache: {} hit{}, {} miss{}".format(
+                hits, "" if hits == 1 else "s", misses, "" if misses == 1 else "es"
+            ),
+            err=True,
+        )
+    if cache is not None and not silent:
+        click.echo(
+            "Cache hit rates: {}".format(
+                ", ".join(
+                    "{} {:.1%}".format(table, rate)
+                    for table, rate in cache.hit_rates().items()
+                )
+            ),
+            err=True,
+        )
+    report = compact_storage_report(db) if report_compact else None
+    if report is not None:
+        for table, sizes in report.items():
+            click.echo(
+                "Compact {}: {} bytes instead of {}, saving {}".format(
+                    table,
+                    sizes["compact_bytes"],
+                    sizes["original_bytes"],
+                    sizes["saved_bytes"],
+                ),
+                err=True,
+            )
+    if changes is not None and not silent:
+        click.echo(changes.summary(), err=True)
+    if stats is not None:
+        db.conn.set_trace_callback(None)
+        if show_stats:
+            click.echo(stats.summary(), err=True)
+        if stats_json:
+            json.dump(stats.as_dict(), stats_json, indent=2)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile)
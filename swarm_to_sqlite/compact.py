@@ -0,0 +1,261 @@
+import sqlite3
+from . import utils
+
+
+# Compact storage mode stores photos and posts in these tables instead, with
+# repeated values moved to lookup tables and derived values left out
+COMPACT_TABLES = {"photos": "photos_compact", "posts": "posts_compact"}
+COMPACT_SCHEMAS = {
+    "photo_prefixes": dict(columns={"id": int, "prefix": str}, unique=["prefix"]),
+    "photo_sizes": dict(
+        columns={"id": int, "width": int, "height": int}, unique=["width", "height"]
+    ),
+    "photos_compact": dict(
+        columns={
+            "id": str,
+            "createdAt": int,
+            "source": int,
+            "prefix": int,
+            "suffix": str,
+            "size": int,
+            "visibility": str,
+            "user": str,
+        }
+    ),
+    "posts_compact": dict(
+        columns={
+            "id": str,
+            "createdAt": int,
+            "text": str,
+            "url": str,
+            "url_derived": int,
+            "contentId": str,
+            "post_source": str,
+            "checkin": str,
+        }
+    ),
+}
+# Post URLs are almost always this followed by the contentId, in which case
+# url is stored as null with url_derived set, so that null URLs stay null
+POST_URL_PREFIX = "https://foursquare.com/item/"
+# Views with the same names and columns as the tables they replace, with a
+# {extra} placeholder for columns added to the compact tables later
+COMPACT_VIEWS = {
+    "photos": (
+        "photos_compact",
+        """
+select
+    photos_compact.id,
+    photos_compact.createdAt,
+    photos_compact.source,
+    photo_prefixes.prefix,
+    photos_compact.suffix,
+    photo_sizes.width,
+    photo_sizes.height,
+    photos_compact.visibility,
+    strftime('%Y-%m-%dT%H:%M:%S', photos_compact.createdAt, 'unixepoch') as created,
+    photos_compact.user{extra}
+from photos_compact
+    left join photo_prefixes on photo_prefixes.id = photos_compact.prefix
+    left join photo_sizes on photo_sizes.id = photos_compact.size
+        """,
+    ),
+    "posts": (
+        "posts_compact",
+        """
+select
+    posts_compact.id,
+    posts_compact.createdAt,
+    posts_compact.text,
+    case when posts_compact.url_derived then '{url_prefix}' || posts_compact.contentId
+        else posts_compact.url end as url,
+    posts_compact.contentId,
+    strftime('%Y-%m-%dT%H:%M:%S', posts_compact.createdAt, 'unixepoch') as created,
+    posts_compact.post_source,
+    posts_compact.checkin{extra}
+from posts_compact
+        """,
+    ),
+}
+# SQL used to copy existing rows into the compact tables
+COMPACT_COPY = {
+    "photos": """
+select
+    photos.id,
+    photos.createdAt,
+    photos.source,
+    photo_prefixes.id,
+    photos.suffix,
+    photo_sizes.id,
+    photos.visibility,
+    photos.user{extra}
+from photos
+    left join photo_prefixes on photo_prefixes.prefix = photos.prefix
+    left join photo_sizes on photo_sizes.width = photos.width
+        and photo_sizes.height = photos.height
+    """,
+    "posts": """
+select
+    posts.id,
+    posts.createdAt,
+    posts.text,
+    case when posts.url = '{url_prefix}' || posts.contentId then null
+        else posts.url end,
+    posts.url is not null and posts.url = '{url_prefix}' || posts.contentId,
+    posts.contentId,
+    posts.post_source,
+    posts.checkin{extra}
+from posts
+    """,
+}
+COMPACT_LOOKUPS = {
+    "photo_prefixes": "select distinct prefix from photos where prefix is not null",
+    "photo_sizes": """
+select distinct width, height from photos
+where width is not null and height is not null
+    """,
+}
+
+
+def has_compact_storage(db):
+    return any(db[table].exists() for table in COMPACT_TABLES.values())
+
+
+def compact_rows(rows, db, cache=None):
+    # Rewrites the photos and posts rows from utils.transform_checkin() as
+    # rows for the compact tables, looking up IDs for repeated values
+    def lookup(table, values):
+        if cache is not None:
+            return cache.lookup(db, table, values)
+        return db[table].lookup(values)
+
+    compacted = {}
+    for table, table_rows in rows.items():
+        if table == "photos":
+            for photo in table_rows:
+                photo.pop("created", None)
+                if photo.get("prefix") is not None:
+                    photo["prefix"] = lookup(
+                        "photo_prefixes", {"prefix": photo["prefix"]}
+                    )
+                width, height = photo.pop("width", None), photo.pop("height", None)
+                if width is not None and height is not None:
+                    photo["size"] = lookup(
+                        "photo_sizes", {"width": width, "height": height}
+                    )
+        elif table == "posts":
+            for post in table_rows:
+                post.pop("created", None)
+                url = POST_URL_PREFIX + str(post.get("contentId"))
+                post["url_derived"] = int(post.get("url") == url)
+                if post["url_derived"]:
+                    post["url"] = None
+        compacted[COMPACT_TABLES.get(table, table)] = table_rows
+    return compacted
+
+
+def enable_compact_storage(db):
+    # Moves existing photos and posts into the compact tables, then replaces
+    # the original tables with views that reconstruct them
+    with db.conn:
+        for table, schema in COMPACT_SCHEMAS.items():
+            if not db[table].exists():
+                db[table].create(
+                    schema["columns"],
+                    pk="id",
+                    foreign_keys=utils.TABLE_OPTIONS.get(table, {}).get("foreign_keys"),
+                )
+                if "unique" in schema:
+                    db[table].create_index(schema["unique"], unique=True)
+        table_names = set(db.table_names())
+        if "photos" in table_names:
+            for lookup_table, sql in COMPACT_LOOKUPS.items():
+                columns = list(COMPACT_SCHEMAS[lookup_table]["unique"])
+                db.execute(
+                    "insert or ignore into [{}] ({}) {}".format(
+                        lookup_table, ", ".join(columns), sql
+                    )
+                )
+        for table, compact_table in COMPACT_TABLES.items():
+            if table not in table_names:
+                continue
+            known = set(utils.TABLE_SCHEMAS[table]["columns"])
+            extra = [c for c in db[table].columns_dict if c not in known]
+            for column in extra:
+                db[compact_table].add_column(column, db[table].columns_dict[column])
+            columns = list(COMPACT_SCHEMAS[compact_table]["columns"]) + extra
+            db.execute(
+                "insert or replace into [{}] ({}) {}".format(
+                    compact_table,
+                    ", ".join("[{}]".format(column) for column in columns),
+                    COMPACT_COPY[table].format(
+                        url_prefix=POST_URL_PREFIX,
+                        extra="".join(
+                            ",\n    [{}].[{}]".format(table, column) for column in extra
+                        ),
+                    ),
+                )
+            )
+            db.execute("drop table [{}]".format(table))
+        create_compact_views(db)
+
+
+def create_compact_views(db):
+    # Recreates the views, so they include any columns added by later imports
+    if "url_derived" not in db["posts_compact"].columns_dict:
+        # Compact tables from before url_derived stored every derived URL
+        # as null, which was also how they stored null URLs
+        with db.conn:
+            db["posts_compact"].add_column("url_derived", int)
+            db.execute("update posts_compact set url_derived = 1 where url is null")
+    for name, (compact_table, sql) in COMPACT_VIEWS.items():
+        known = set(COMPACT_SCHEMAS[compact_table]["columns"])
+        extra = [c for c in db[compact_table].columns_dict if c not in known]
+        db.create_view(
+            name,
+            sql.format(
+                url_prefix=POST_URL_PREFIX,
+                extra="".join(
+                    ",\n    [{}].[{}]".format(compact_table, column) for column in extra
+                ),
+            ),
+            replace=True,
+        )
+
+
+def has_dbstat(db):
+    # The dbstat table is only there if SQLite was compiled with
+    # SQLITE_ENABLE_DBSTAT_VTAB
+    try:
+        db.execute("select 1 from dbstat limit 1").fetchall()
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def compact_storage_report(db):
+    # Compares the bytes of row data in each compact table and its lookup
+    # tables with the bytes the same rows would take in the original table,
+    # by copying those rows into a temporary table - or returns None if
+    # SQLite does not have the dbstat table needed to measure them
+    if not has_dbstat(db):
+        return None
+    sizes = dict(
+        db.execute("select name, sum(payload) from dbstat group by name").fetchall()
+    )
+    report = {}
+    for table, compact_table in COMPACT_TABLES.items():
+        db.execute("drop table if exists temp.[expanded]")
+        db.execute("create temp table [expanded] as select * from [{}]".format(table))
+        expanded = db.execute(
+            "select sum(payload) from dbstat('temp') where name = 'expanded'"
+        ).fetchone()[0]
+        db.execute("drop table temp.[expanded]")
+        lookups = ["photo_prefixes", "photo_sizes"] if table == "photos" else []
+        compact = sum(sizes.get(name) or 0 for name in [compact_table] + lookups)
+        report[table] = {
+            "original_bytes": expanded or 0,
+            "compact_bytes": compact,
+            "saved_bytes": (expanded or 0) - compact,
+        }
+    return report
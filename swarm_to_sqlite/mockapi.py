@@ -0,0 +1,324 @@
+import bisect
+import click
+import http.server
+import json
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+from . import synthetic, utils
+from .benchmark import installed_version
+
+# The Foursquare API returns 100 checkins per page by default, and at most 250
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 250
+
+
+class MockFoursquareAPI:
+    # A stand-in for the parts of the Foursquare API used by swarm-to-sqlite,
+    # serving /v2/users/self/checkins and /v2/users/self from a list of
+    # checkins, for any token. beforeTimestamp and afterTimestamp select
+    # checkins created strictly before or after them, and limit, offset and
+    # sort=newestfirst/oldestfirst work as they do in the real API
+    # Every response waits for latency seconds. error_rate is the fraction
+    # of requests that fail with a 500 error, and rate_limit is the number of
+    # requests allowed per rate_limit_window seconds, after which requests
+    # get 429 responses until the window resets
+    def __init__(
+        self,
+        checkins,
+        user=None,
+        max_limit=MAX_LIMIT,
+        latency=0,
+        error_rate=0,
+        rate_limit=None,
+        rate_limit_window=60,
+        seed=0,
+    ):
+        checkins = sorted(checkins, key=lambda c: c["createdAt"], reverse=True)
+        # Checkins are encoded once, so serving a page is a join of bytes
+        self.encoded = [json.dumps(checkin).encode("utf-8") for checkin in checkins]
+        self.keys = [-checkin["createdAt"] for checkin in checkins]
+        self.user = user or {"id": "1", "firstName": "Mock", "relationship": "self"}
+        self.max_limit = max_limit
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.window_requests = 0
+        self.requests = 0
+        self.pages = 0
+        self.checkins_served = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.server = None
+
+    def handle(self, path, params):
+        # Returns (status, headers, body bytes) for a GET request
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            now = time.time()
+            if now - self.window_start >= self.rate_limit_window:
+                self.window_start, self.window_requests = now, 0
+            self.window_requests += 1
+            headers = {}
+            if self.rate_limit is not None:
+                reset = int(self.window_start + self.rate_limit_window)
+                headers = {
+                    "X-RateLimit-Limit": str(self.rate_limit),
+                    "X-RateLimit-Remaining": str(
+                        max(self.rate_limit - self.window_requests, 0)
+                    ),
+                    "X-RateLimit-Reset": str(reset),
+                }
+                if self.window_requests > self.rate_limit:
+                    self.rate_limited += 1
+                    headers["Retry-After"] = str(max(int(reset - now), 1))
+                    return error(429, "rate_limit_exceeded", headers)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return error(500, "server_error", headers)
+        if not params.get("oauth_token"):
+            return error(401, "invalid_auth", headers)
+        if path.rstrip("/") == "/v2/users/self":
+            return response(200, {"user": self.user}, headers)
+        if path.rstrip("/") != "/v2/users/self/checkins":
+            return error(404, "endpoint_error", headers)
+        try:
+            limit = min(int(params.get("limit", DEFAULT_LIMIT)), self.max_limit)
+            offset = int(params.get("offset", 0))
+            before = params.get("beforeTimestamp")
+            after = params.get("afterTimestamp")
+            start = bisect.bisect_right(self.keys, -int(before)) if before else 0
+            end = bisect.bisect_left(self.keys, -int(after)) if after else None
+        except ValueError:
+            return error(400, "param_error", headers)
+        selected = self.encoded[start:end]
+        if params.get("sort") == "oldestfirst":
+            selected = selected[::-1]
+        items = selected[offset : offset + limit]
+        with self.lock:
+            self.pages += 1
+            self.checkins_served += len(items)
+        body = b"".join(
+            [
+                b'{"meta": {"code": 200}, "response": {"checkins": {"count": ',
+                str(len(self.encoded)).encode("utf-8"),
+                b', "items": [',
+                b", ".join(items),
+                b"]}}}",
+            ]
+        )
+        return 200, dict(headers, **{"Content-Type": "application/json"}), body
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "pages": self.pages,
+            "checkins_served": self.checkins_served,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+        }
+
+    def start(self, host="127.0.0.1", port=0):
+        # Serves the API from a background thread, returning its base URL
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                status, headers, body = api.handle(url.path, params)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        return "http://{}:{}/v2".format(*self.server.server_address[:2])
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def response(status, data, headers, meta=None):
+    body = {"meta": dict(meta or {}, code=status), "response": data}
+    headers = dict(headers, **{"Content-Type": "application/json"})
+    return status, headers, json.dumps(body).encode("utf-8")
+
+
+def error(status, error_type, headers):
+    return response(status, {}, headers, {"errorType": error_type})
+
+
+def benchmark_cli(api, db_path, args=()):
+    # Imports every checkin the mock API serves using the command-line tool,
+    # returning the pages and checkins per second
+    from .cli import cli
+
+    api_url = api.start()
+    try:
+        start = time.perf_counter()
+        cli.main(
+            [db_path, "--token", "mock", "--api-url", api_url, "--silent"] + list(args),
+            standalone_mode=False,
+        )
+        seconds = time.perf_counter() - start
+    finally:
+        api.stop()
+    stats = api.stats()
+    return dict(
+        stats,
+        seconds=seconds,
+        pages_per_second=stats["pages"] / seconds,
+        checkins_per_second=stats["checkins_served"] / seconds,
+    )
+
+
+def load_checkins(load, count, seed):
+    if load:
+        return list(utils.iter_json_records(load))
+    return list(synthetic.generate_checkins(count, seed=seed))
+
+
+def api_options(function):
+    for decorator in reversed(
+        (
+            click.option(
+                "--count",
+                default=1000,
+                show_default=True,
+                help="Synthetic checkins to serve",
+            ),
+            click.option("--seed", default=0, show_default=True, help="Random seed"),
+            click.option(
+                "--load",
+                type=click.File("rb"),
+                help="Serve checkins from this JSON file, e.g. one saved using --save",
+            ),
+            click.option(
+                "--max-limit",
+                type=click.IntRange(min=1),
+                default=MAX_LIMIT,
+                show_default=True,
+                help="Largest page size to return, whatever limit is requested",
+            ),
+            click.option(
+                "--latency",
+                type=click.FloatRange(min=0),
+                default=0,
+                show_default=True,
+                help="Seconds to wait before each response",
+            ),
+            click.option(
+                "--error-rate",
+                type=click.FloatRange(0, 1),
+                default=0,
+                show_default=True,
+                help="Fraction of requests that fail with a 500 error",
+            ),
+            click.option(
+                "--rate-limit",
+                type=click.IntRange(min=1),
+                help="Requests allowed per --rate-limit-window before 429 responses",
+            ),
+            click.option(
+                "--rate-limit-window",
+                type=click.FloatRange(min=0, min_open=True),
+                default=60,
+                show_default=True,
+                help="Seconds before the rate limit resets",
+            ),
+        )
+    ):
+        function = decorator(function)
+    return function
+
+
+def make_api(load, count, seed, **options):
+    return MockFoursquareAPI(load_checkins(load, count, seed), seed=seed, **options)
+
+
+@click.group()
+def cli():
+    "A local mock of the Foursquare API, for load testing"
+
+
+@cli.command()
+@api_options
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8000, show_default=True)
+def serve(host, port, **options):
+    """
+    Serve the mock API until interrupted
+
+    Use it with: swarm-to-sqlite checkins.db --api-url=http://127.0.0.1:8000/v2
+    """
+    api = make_api(**options)
+    click.echo("Serving {} at {}".format(len(api.encoded), api.start(host, port)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        api.stop()
+
+
+@cli.command(context_settings={"ignore_unknown_options": True})
+@api_options
+@click.option(
+    "-o", "--output", type=click.File("w"), default="-", help="Write JSON here"
+)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def benchmark(output, args, **options):
+    """
+    Import from the mock API with swarm-to-sqlite, outputting pages/sec and
+    checkins/sec as JSON. Any ARGS are passed to swarm-to-sqlite, e.g.
+
+    python -m swarm_to_sqlite.mockapi benchmark --latency 0.05 -- --parallel 4
+    """
+    api = make_api(**options)
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bench.db")
+        result = benchmark_cli(api, db_path, args)
+        result["db_size_bytes"] = os.path.getsize(db_path)
+    options.pop("load")
+    json.dump(
+        {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "swarm_to_sqlite": installed_version("swarm-to-sqlite"),
+            "sqlite_utils": installed_version("sqlite-utils"),
+            "options": dict(options, args=list(args)),
+            "result": result,
+        },
+        output,
+        indent=2,
+    )
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,351 @@
+import calendar
+import click
+import contextlib
+import os
+import sqlite3
+import sqlite_utils
+import time
+from . import utils
+
+
+# Partitioned storage writes these tables to a database file per year or
+# month next to the main database, which keeps the shared tables they refer to
+PARTITIONED_TABLES = ("checkins", "photos", "posts")
+PARTITION_FORMATS = {"year": "%Y", "month": "%Y-%m"}
+
+
+def has_partitions(db):
+    return db["partitions"].exists()
+
+
+def partition_period(db):
+    # The period is kept in the one-row partition_settings table, so it is
+    # known before any partitions have been created
+    return db["partition_settings"].get(1)["period"]
+
+
+def partition_name(created_at, period):
+    return time.strftime(PARTITION_FORMATS[period], time.gmtime(created_at))
+
+
+def partition_bounds(name):
+    # Returns the (start, end) timestamps of a partition, end being exclusive
+    parts = [int(part) for part in name.split("-")]
+    year, month = parts[0], parts[1] if len(parts) > 1 else None
+    if month is None:
+        start, end = (year, 1), (year + 1, 1)
+    else:
+        start, end = (year, month), (year + month // 12, month % 12 + 1)
+    return tuple(calendar.timegm(ym + (1, 0, 0, 0)) for ym in (start, end))
+
+
+def database_path(db):
+    for _, name, path in db.execute("pragma database_list").fetchall():
+        if name == "main":
+            return path
+    return ""
+
+
+class Partitions:
+    # Opens the partition databases of a partitioned database as rows are
+    # routed to them, creating any that do not exist yet. Each partition has
+    # its own known columns and batches of rows waiting to be saved
+    def __init__(self, db):
+        self.db = db
+        self.period = partition_period(db)
+        self.directory, filename = os.path.split(database_path(db))
+        if not filename:
+            raise ValueError("Partitioned storage needs a database file")
+        self.stem = os.path.splitext(filename)[0]
+        self.databases = {}
+        self.known_columns = {}
+        self.batches = {}
+        self.stack = None
+
+    def path(self, name):
+        return os.path.join(self.directory, "{}-{}.db".format(self.stem, name))
+
+    def database(self, name):
+        if name in self.databases:
+            return self.databases[name]
+        db = sqlite_utils.Database(self.path(name))
+        for table in PARTITIONED_TABLES:
+            if not db[table].exists():
+                db[table].create(utils.TABLE_SCHEMAS[table]["columns"], pk="id")
+        utils.create_indexes(db)
+        start, end = partition_bounds(name)
+        self.db.execute(
+            "insert or ignore into partitions (name, path, start, [end]) "
+            "values (?, ?, ?, ?)",
+            [name, os.path.basename(self.path(name)), start, end],
+        )
+        if self.stack is not None:
+            self.stack.enter_context(utils.transaction(db))
+        self.databases[name] = db
+        self.known_columns[name] = {}
+        return db
+
+    def add(self, rows):
+        # Moves the rows for partitioned tables out of the rows of a
+        # transformed checkin, into the batch for the checkin's partition.
+        # Posts go in the same partition as their checkin, and photos in the
+        # partition for their own createdAt, as enable_partitions() does
+        checkins = rows.get("checkins")
+        if not checkins:
+            return rows
+        name = partition_name(checkins[0]["createdAt"], self.period)
+        for table in ("checkins", "posts"):
+            table_rows = rows.pop(table, None)
+            if table_rows:
+                batch = self.batches.setdefault(name, {})
+                batch.setdefault(table, []).extend(table_rows)
+        for photo in rows.pop("photos", None) or ():
+            photo_name = partition_name(photo["createdAt"], self.period)
+            batch = self.batches.setdefault(photo_name, {})
+            batch.setdefault("photos", []).append(photo)
+        return rows
+
+    def save(self, stats=None, changes=None):
+        for name, batch in self.batches.items():
+            db = self.database(name)
+            utils.save_rows(batch, db, self.known_columns[name], stats, changes)
+        self.batches = {}
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Partitions written to inside this block commit together at the end
+        with contextlib.ExitStack() as stack:
+            for db in self.databases.values():
+                stack.enter_context(utils.transaction(db))
+            self.stack = stack
+            try:
+                yield
+            finally:
+                self.stack = None
+
+    def close(self):
+        for db in self.databases.values():
+            db.conn.close()
+        self.databases = {}
+
+
+def enable_partitions(db, period):
+    # Copies existing checkins, photos and posts into partition databases,
+    # then drops them from the main database along with the views that
+    # depend on them. Posts go in the partition of their checkin, and photos
+    # by their own createdAt, as the photos table does not record their
+    # checkin - the same as Partitions.add() does for later imports
+    if not has_partitions(db):
+        with utils.transaction(db):
+            db["partition_settings"].insert({"id": 1, "period": period}, pk="id")
+            db["partitions"].create(
+                {"name": str, "path": str, "start": int, "end": int}, pk="name"
+            )
+    partitions = Partitions(db)
+    table_names = set(db.table_names())
+    tables = [table for table in PARTITIONED_TABLES if table in table_names]
+    partitioned_by = {table: "[{}].createdAt".format(table) for table in tables}
+    if "posts" in tables and "checkins" in tables:
+        partitioned_by["posts"] = (
+            "coalesce((select createdAt from main.checkins "
+            "where checkins.id = posts.checkin), posts.createdAt)"
+        )
+    with utils.transaction(db):
+        for table in tables:
+            for (created_at,) in db.execute(
+                "select distinct {} from main.[{}]".format(partitioned_by[table], table)
+            ).fetchall():
+                if created_at is not None:
+                    partitions.database(partition_name(created_at, period))
+    # Databases cannot be attached inside a transaction
+    for name, partition in sorted(partitions.databases.items()):
+        start, end = partition_bounds(name)
+        for table in tables:
+            columns = db[table].columns_dict
+            for column, column_type in columns.items():
+                if column not in partition[table].columns_dict:
+                    partition[table].add_column(column, column_type)
+        db.execute("attach database ? as partition", [partitions.path(name)])
+        try:
+            with utils.transaction(db):
+                for table in tables:
+                    columns = ", ".join(
+                        "[{}]".format(column) for column in db[table].columns_dict
+                    )
+                    db.execute(
+                        "insert or replace into partition.[{table}] ({columns}) "
+                        "select {columns} from main.[{table}] "
+                        "where {created_at} >= ? and {created_at} < ?".format(
+                            table=table,
+                            columns=columns,
+                            created_at=partitioned_by[table],
+                        ),
+                        [start, end],
+                    )
+        finally:
+            db.execute("detach database partition")
+    partitions.close()
+    with utils.transaction(db):
+        for name in utils.VIEWS:
+            if name in db.view_names():
+                db.execute("drop view [{}]".format(name))
+        for table in tables:
+            db.execute("drop table [{}]".format(table))
+        if "row_hashes" in table_names:
+            # Hashes of partitioned rows are kept in their partition
+            db.execute(
+                "delete from row_hashes where [table] in (?, ?, ?)",
+                PARTITIONED_TABLES,
+            )
+
+
+def attach_partitions(db, start=None, end=None):
+    # Attaches the partitions with checkins between the start and end
+    # timestamps, or all of them, then creates temporary views that UNION ALL
+    # each partitioned table plus the views in utils.VIEWS on top of those.
+    # Views stored in the database cannot refer to attached databases, so this
+    # is needed on every connection. Returns the SQL statements it executed
+    limit = getattr(db.conn, "getlimit", None)
+    max_attached = limit(sqlite3.SQLITE_LIMIT_ATTACHED) if limit else 10
+    where, params = "1 = 1", []
+    if start is not None:
+        where, params = where + " and [end] > ?", params + [start]
+    if end is not None:
+        where, params = where + " and start <= ?", params + [end]
+    partitions = db.execute(
+        "select name, path from partitions where {} order by name".format(where),
+        params,
+    ).fetchall()
+    if len(partitions) > max_attached:
+        raise ValueError(
+            "Cannot attach {} partitions, SQLite allows {} - "
+            "pass start and end to select fewer".format(len(partitions), max_attached)
+        )
+    directory = os.path.dirname(database_path(db))
+    statements = []
+
+    def execute(sql):
+        db.execute(sql)
+        statements.append(sql)
+
+    attached = {row[1] for row in db.execute("pragma database_list")}
+    schemas = []
+    for name, path in partitions:
+        schema = "partition_{}".format(name.replace("-", "_"))
+        if schema not in attached:
+            execute(
+                "attach database {} as [{}]".format(
+                    db.quote(os.path.join(directory, path)), schema
+                )
+            )
+        schemas.append(schema)
+    for table in PARTITIONED_TABLES:
+        # Partitions created later may have more columns
+        columns = []
+        schema_columns = {}
+        for schema in schemas:
+            schema_columns[schema] = [
+                row[1]
+                for row in db.execute(
+                    "select * from pragma_table_info(?, ?)", [table, schema]
+                )
+            ]
+            columns.extend(c for c in schema_columns[schema] if c not in columns)
+        selects = [
+            "select {} from [{}].[{}]".format(
+                ", ".join(
+                    "[{}]".format(column)
+                    if column in schema_columns[schema]
+                    else "null as [{}]".format(column)
+                    for column in columns
+                ),
+                schema,
+                table,
+            )
+            for schema in schemas
+        ] or [
+            "select {} where 0".format(
+                ", ".join(
+                    "null as [{}]".format(column)
+                    for column in utils.TABLE_SCHEMAS[table]["columns"]
+                )
+            )
+        ]
+        execute("drop view if exists temp.[{}]".format(table))
+        execute(
+            "create temp view [{}] as\n{}".format(table, "\nunion all\n".join(selects))
+        )
+    for name, (_, sql) in utils.VIEWS.items():
+        execute("drop view if exists temp.[{}]".format(name))
+        execute("create temp view [{}] as {}".format(name, sql.format(where="")))
+    return statements
+
+
+def validate_partition(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return partition_bounds(value)
+    except ValueError:
+        raise click.BadParameter("Use a year like 2020 or a month like 2020-03")
+
+
+def partitioned_incremental_state(db, account=None):
+    # utils.incremental_state() for a partitioned database. The partitions
+    # are checked newest first, so usually only the newest one is read
+    partitions = Partitions(db)
+    try:
+        for (name,) in db.execute(
+            "select name from partitions order by name desc"
+        ).fetchall():
+            state = utils.incremental_state(partitions.database(name), account)
+            if state[0] is not None:
+                return state
+    finally:
+        partitions.close()
+    return None, set()
+
+
+@click.group()
+def cli():
+    "Query databases created with --partition"
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, exists=True),
+)
+@click.option(
+    "--start",
+    callback=validate_partition,
+    help="Only include partitions from this year or month onwards",
+)
+@click.option(
+    "--end",
+    callback=validate_partition,
+    help="Only include partitions up to and including this year or month",
+)
+def views(db_path, start, end):
+    """
+    Output SQL that attaches the partitions and creates views across them
+
+    For example: sqlite3 -init views.sql checkins.db
+    """
+    db = sqlite_utils.Database(db_path)
+    if not has_partitions(db):
+        raise click.ClickException("{} is not partitioned".format(db_path))
+    try:
+        statements = attach_partitions(
+            db,
+            start=start[0] if start else None,
+            end=end[1] - 1 if end else None,
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for statement in statements:
+        click.echo(statement + ";")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,498 @@
+import datetime
+
+# Record types for the objects that make up a checkin, decoded from the JSON
+# returned by the API without modifying it. from_json() copies each column
+# and row() returns them in table order. Keys the API returns that are not
+# in KNOWN are kept in extra, so they still become columns, and known
+# columns that were missing from the JSON are left out of the row
+
+MISSING = object()
+
+
+def extra_keys(data, known):
+    # The keys of data that are not known columns, or None if there are none
+    if data.keys() <= known:
+        return None
+    return {key: value for key, value in data.items() if key not in known}
+
+
+def build_row(row, extra):
+    # Leaves the MISSING values out of row and adds any extra keys
+    if MISSING in row.values():
+        row = {column: value for column, value in row.items() if value is not MISSING}
+    if extra:
+        row.update(extra)
+    return row
+
+
+class Record:
+    __slots__ = ("extra",)
+
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, self.row())
+
+
+def iso_timestamp(created_at):
+    return datetime.datetime.utcfromtimestamp(created_at).isoformat()
+
+
+class Category(Record):
+    __slots__ = (
+        "id",
+        "name",
+        "pluralName",
+        "shortName",
+        "primary",
+        "icon_prefix",
+        "icon_suffix",
+    )
+    KNOWN = frozenset(__slots__ + ("icon",))
+
+    @classmethod
+    def from_json(cls, data):
+        category = cls()
+        get = data.get
+        category.id = get("id", MISSING)
+        category.name = get("name", MISSING)
+        category.pluralName = get("pluralName", MISSING)
+        category.shortName = get("shortName", MISSING)
+        category.primary = get("primary", MISSING)
+        category.icon_prefix = data["icon"]["prefix"]
+        category.icon_suffix = data["icon"]["suffix"]
+        category.extra = extra_keys(data, cls.KNOWN)
+        return category
+
+    def row(self):
+        return build_row(
+            {
+                "id": self.id,
+                "name": self.name,
+                "pluralName": self.pluralName,
+                "shortName": self.shortName,
+                "primary": self.primary,
+                "icon_prefix": self.icon_prefix,
+                "icon_suffix": self.icon_suffix,
+            },
+            self.extra,
+        )
+
+
+class User(Record):
+    __slots__ = (
+        "id",
+        "firstName",
+        "lastName",
+        "gender",
+        "relationship",
+        "photo_prefix",
+        "photo_suffix",
+    )
+    KNOWN = frozenset(__slots__ + ("photo",))
+
+    @classmethod
+    def from_json(cls, data):
+        user = cls()
+        get = data.get
+        user.id = get("id", MISSING)
+        user.firstName = get("firstName", MISSING)
+        user.lastName = get("lastName", MISSING)
+        user.gender = get("gender", MISSING)
+        user.relationship = get("relationship", MISSING)
+        photo = get("photo") or {}
+        user.photo_prefix = photo.get("prefix")
+        user.photo_suffix = photo.get("suffix")
+        user.extra = extra_keys(data, cls.KNOWN)
+        return user
+
+    def row(self):
+        return build_row(
+            {
+                "id": self.id,
+                "firstName": self.firstName,
+                "lastName": self.lastName,
+                "gender": self.gender,
+                "relationship": self.relationship,
+                "photo_prefix": self.photo_prefix,
+                "photo_suffix": self.photo_suffix,
+            },
+            self.extra,
+        )
+
+
+class Venue(Record):
+    __slots__ = (
+        "id",
+        "name",
+        "address",
+        "crossStreet",
+        "postalCode",
+        "cc",
+        "city",
+        "state",
+        "country",
+        "formattedAddress",
+        "latitude",
+        "longitude",
+        "categories",
+    )
+    KNOWN = frozenset(__slots__ + ("location", "labeledLatLngs", "lat", "lng"))
+
+    @classmethod
+    def from_json(cls, data):
+        # The fields of location are stored as columns of the venue
+        location = data["location"]
+        data = {**data, **location}
+        venue = cls()
+        get = data.get
+        venue.id = get("id", MISSING)
+        venue.name = get("name", MISSING)
+        venue.address = get("address", MISSING)
+        venue.crossStreet = get("crossStreet", MISSING)
+        venue.postalCode = get("postalCode", MISSING)
+        venue.cc = get("cc", MISSING)
+        venue.city = get("city", MISSING)
+        venue.state = get("state", MISSING)
+        venue.country = get("country", MISSING)
+        venue.formattedAddress = get("formattedAddress", MISSING)
+        venue.latitude = location["lat"]
+        venue.longitude = location["lng"]
+        venue.categories = [Category.from_json(c) for c in data["categories"]]
+        venue.extra = extra_keys(data, cls.KNOWN)
+        return venue
+
+    def row(self):
+        return build_row(
+            {
+                "id": self.id,
+                "name": self.name,
+                "address": self.address,
+                "crossStreet": self.crossStreet,
+                "postalCode": self.postalCode,
+                "cc": self.cc,
+                "city": self.city,
+                "state": self.state,
+                "country": self.country,
+                "formattedAddress": self.formattedAddress,
+                "latitude": self.latitude,
+                "longitude": self.longitude,
+            },
+            self.extra,
+        )
+
+
+class Event(Record):
+    __slots__ = ("id", "name", "categories")
+    KNOWN = frozenset(__slots__)
+
+    @classmethod
+    def from_json(cls, data):
+        event = cls()
+        event.id = data.get("id", MISSING)
+        event.name = data.get("name", MISSING)
+        event.categories = [Category.from_json(c) for c in data["categories"]]
+        event.extra = extra_keys(data, cls.KNOWN)
+        return event
+
+    def row(self):
+        return build_row({"id": self.id, "name": self.name}, self.extra)
+
+
+class Sticker(Record):
+    __slots__ = (
+        "id",
+        "name",
+        "stickerType",
+        "group",
+        "pickerPosition",
+        "teaseText",
+        "unlockText",
+        "image_prefix",
+        "image_sizes",
+        "image_name",
+    )
+    KNOWN = frozenset(__slots__ + ("image",))
+
+    @classmethod
+    def from_json(cls, data):
+        sticker = cls()
+        get = data.get
+        sticker.id = get("id", MISSING)
+        sticker.name = get("name", MISSING)
+        sticker.stickerType = get("stickerType", MISSING)
+        sticker.group = get("group", MISSING)
+        sticker.pickerPosition = get("pickerPosition", MISSING)
+        sticker.teaseText = get("teaseText", MISSING)
+        sticker.unlockText = get("unlockText", MISSING)
+        image = data["image"]
+        sticker.image_prefix = image["prefix"]
+        sticker.image_sizes = image["sizes"]
+        sticker.image_name = image["name"]
+        sticker.extra = extra_keys(data, cls.KNOWN)
+        return sticker
+
+    def row(self):
+        return build_row(
+            {
+                "id": self.id,
+                "name": self.name,
+                "stickerType": self.stickerType,
+                "group": self.group,
+                "pickerPosition": self.pickerPosition,
+                "teaseText": self.teaseText,
+                "unlockText": self.unlockText,
+                "image_prefix": self.image_prefix,
+                "image_sizes": self.image_sizes,
+                "image_name": self.image_name,
+            },
+            self.extra,
+        )
+
+
+class Photo(Record):
+    __slots__ = (
+        "id",
+        "createdAt",
+        "source",
+        "prefix",
+        "suffix",
+        "width",
+        "height",
+        "visibility",
+        "created",
+        "user",
+    )
+    KNOWN = frozenset(__slots__)
+
+    @classmethod
+    def from_json(cls, data):
+        photo = cls()
+        get = data.get
+        photo.id = get("id", MISSING)
+        photo.createdAt = get("createdAt", MISSING)
+        # source is left as a dictionary, to be looked up in the sources table
+        photo.source = get("source", MISSING)
+        photo.prefix = get("prefix", MISSING)
+        photo.suffix = get("suffix", MISSING)
+        photo.width = get("width", MISSING)
+        photo.height = get("height", MISSING)
+        photo.visibility = get("visibility", MISSING)
+        photo.created = iso_timestamp(data["createdAt"])
+        photo.user = User.from_json(data["user"])
+        photo.extra = extra_keys(data, cls.KNOWN)
+        return photo
+
+    def row(self):
+        return build_row(
+            {
+                "id": self.id,
+                "createdAt": self.createdAt,
+                "source": self.source,
+                "prefix": self.prefix,
+                "suffix": self.suffix,
+                "width": self.width,
+                "height": self.height,
+                "visibility": self.visibility,
+                "created": self.created,
+                "user": self.user.id,
+            },
+            self.extra,
+        )
+
+
+class PostSource(Record):
+    __slots__ = ("id", "consumerId", "name", "photo", "icon", "detailUrl", "url")
+    KNOWN = frozenset(__slots__)
+
+    @classmethod
+    def from_json(cls, data):
+        source = cls()
+        get = data.get
+        source.id = get("id", MISSING)
+        source.consumerId = get("consumerId", MISSING)
+        source.name = get("name", MISSING)
+        source.photo = get("photo", MISSING)
+        source.icon = get("icon", MISSING)
+        source.detailUrl = get("detailUrl", MISSING)
+        source.url = get("url", MISSING)
+        source.extra = extra_keys(data, cls.KNOWN)
+        return source
+
+    def row(self):
+        return build_row(
+            {
+                "id": self.id,
+                "consumerId": self.consumerId,
+                "name": self.name,
+                "photo": self.photo,
+                "icon": self.icon,
+                "detailUrl": self.detailUrl,
+                "url": self.url,
+            },
+            self.extra,
+        )
+
+
+class Post(Record):
+    __slots__ = (
+        "id",
+        "createdAt",
+        "text",
+        "url",
+        "contentId",
+        "created",
+        "post_source",
+        "checkin",
+    )
+    KNOWN = frozenset(__slots__ + ("source",))
+
+    @classmethod
+    def from_json(cls, data, checkin_id=None):
+        post = cls()
+        get = data.get
+        post.id = get("id", MISSING)
+        post.createdAt = get("createdAt", MISSING)
+        post.text = get("text", MISSING)
+        post.url = get("url", MISSING)
+        post.contentId = get("contentId", MISSING)
+        post.created = iso_timestamp(data["createdAt"])
+        post.post_source = PostSource.from_json(data["source"])
+        post.checkin = checkin_id
+        post.extra = extra_keys(data, cls.KNOWN)
+        return post
+
+    def row(self):
+        return build_row(
+            {
+                "id": self.id,
+                "createdAt": self.createdAt,
+                "text": self.text,
+                "url": self.url,
+                "contentId": self.contentId,
+                "created": self.created,
+                "post_source": self.post_source.id,
+                "checkin": self.checkin,
+            },
+            self.extra,
+        )
+
+
+class Checkin(Record):
+    __slots__ = (
+        "id",
+        "createdAt",
+        "type",
+        "entities",
+        "shout",
+        "timeZoneOffset",
+        "like",
+        "isMayor",
+        "source",
+        "venue",
+        "createdBy",
+        "event",
+        "sticker",
+        "created",
+        "comments_count",
+        "with_",
+        "likes",
+        "photos",
+        "posts",
+    )
+    # with_ is the attribute for the with key, a reserved word in Python
+    KNOWN = frozenset(__slots__ + ("with", "comments")) - {"with_"}
+
+    @classmethod
+    def from_json(cls, data):
+        checkin = cls()
+        get = data.get
+        checkin.id = get("id", MISSING)
+        checkin.createdAt = get("createdAt", MISSING)
+        checkin.type = get("type", MISSING)
+        checkin.entities = get("entities", MISSING)
+        checkin.shout = get("shout", MISSING)
+        checkin.timeZoneOffset = get("timeZoneOffset", MISSING)
+        checkin.like = get("like", MISSING)
+        checkin.isMayor = get("isMayor", MISSING)
+        # source is left as a dictionary, to be looked up in the sources table
+        checkin.source = get("source")
+        venue = get("venue")
+        checkin.venue = Venue.from_json(venue) if venue else None
+        created_by = get("createdBy")
+        checkin.createdBy = User.from_json(created_by) if created_by else None
+        event = get("event")
+        checkin.event = Event.from_json(event) if event else None
+        sticker = get("sticker")
+        checkin.sticker = Sticker.from_json(sticker) if sticker else None
+        checkin.created = iso_timestamp(data["createdAt"])
+        checkin.comments_count = data["comments"]["count"]
+        checkin.with_ = [User.from_json(user) for user in get("with") or ()]
+        checkin.likes = [
+            User.from_json(user)
+            for group in data["likes"]["groups"]
+            for user in group["items"]
+        ]
+        checkin.photos = [Photo.from_json(photo) for photo in data["photos"]["items"]]
+        checkin.posts = [
+            Post.from_json(post, data["id"])
+            for post in (get("posts") or {}).get("items") or ()
+        ]
+        checkin.extra = extra_keys(data, cls.KNOWN)
+        return checkin
+
+    def row(self):
+        return build_row(
+            {
+                "id": self.id,
+                "createdAt": self.createdAt,
+                "type": self.type,
+                "entities": self.entities,
+                "shout": self.shout,
+                "timeZoneOffset": self.timeZoneOffset,
+                "like": self.like,
+                "isMayor": self.isMayor,
+                "source": self.source,
+                "venue": self.venue and self.venue.id,
+                "createdBy": self.createdBy and self.createdBy.id,
+                "event": self.event and self.event.id,
+                "sticker": self.sticker and self.sticker.id,
+                "created": self.created,
+                "comments_count": self.comments_count,
+            },
+            self.extra,
+        )
+
+    def rows(self):
+        # Flattens the checkin into {table_name: [rows]}, with tables in the
+        # order they need to be created in so foreign keys can be added
+        rows = {}
+        add = rows.setdefault
+        if self.venue is not None:
+            add("venues", []).append(self.venue.row())
+            for category in self.venue.categories:
+                add("categories", []).append(category.row())
+                add("categories_venues", []).append(
+                    {"categories_id": category.id, "venues_id": self.venue.id}
+                )
+        if self.event is not None:
+            add("events", []).append(self.event.row())
+            for category in self.event.categories:
+                add("categories", []).append(category.row())
+                add("categories_events", []).append(
+                    {"categories_id": category.id, "events_id": self.event.id}
+                )
+        if self.sticker is not None:
+            add("stickers", []).append(self.sticker.row())
+        if self.createdBy is not None:
+            add("users", []).append(self.createdBy.row())
+        add("checkins", []).append(self.row())
+        for m2m_table, users in (("with", self.with_), ("likes", self.likes)):
+            for user in users:
+                add("users", []).append(user.row())
+                add(m2m_table, []).append({"users_id": user.id, "checkins_id": self.id})
+        for photo in self.photos:
+            add("users", []).append(photo.user.row())
+            add("photos", []).append(photo.row())
+        for post in self.posts:
+            add("post_sources", []).append(post.post_source.row())
+            add("posts", []).append(post.row())
+        return rows
@@ -0,0 +1,179 @@
+import click
+import sqlite_utils
+from . import partitions, utils
+
+
+# Each rollup counts the rows of a join, grouped by its key columns. keys and
+# where refer to each table in tables as {table}, so the same query can count
+# every row for a rebuild, or just the rows joined to one inserted or deleted
+# row - named new or old - in a trigger. Days and weeks use the checkin's
+# local time, and weeks start on Monday
+ROLLUPS = {
+    "rollup_days": dict(
+        columns={"day": str},
+        keys=[
+            "date({checkins}.createdAt + "
+            "coalesce({checkins}.timeZoneOffset, 0) * 60, 'unixepoch')"
+        ],
+        tables=["checkins"],
+    ),
+    "rollup_weeks": dict(
+        columns={"week": str},
+        keys=[
+            "date({checkins}.createdAt + "
+            "coalesce({checkins}.timeZoneOffset, 0) * 60, 'unixepoch', "
+            "'-6 days', 'weekday 1')"
+        ],
+        tables=["checkins"],
+    ),
+    "rollup_categories": dict(
+        columns={"category": str},
+        keys=["{categories_venues}.categories_id"],
+        tables=["checkins", "categories_venues"],
+        where="{categories_venues}.venues_id = {checkins}.venue",
+    ),
+    "rollup_cities": dict(
+        columns={"cc": str, "city": str},
+        keys=["coalesce({venues}.cc, '')", "coalesce({venues}.city, '')"],
+        tables=["checkins", "venues"],
+        where="{venues}.id = {checkins}.venue",
+    ),
+    "rollup_companions": dict(
+        columns={"user": str},
+        keys=["{with}.users_id"],
+        tables=["with"],
+    ),
+}
+
+
+def rollup_select(rollup, count, row=None, table=None):
+    # Selects the key columns and count for the rows of the join, or with
+    # row (new or old) standing in for table, for the rows joined to it
+    names = {name: "[{}]".format(name) for name in rollup["tables"]}
+    if table is not None:
+        names[table] = row
+    keys = [key.format(**names) for key in rollup["keys"]]
+    sql = "select " + ", ".join(keys + ([count] if count else []))
+    tables = [name for name in rollup["tables"] if name != table]
+    if tables:
+        sql += " from " + ", ".join("[{}]".format(name) for name in tables)
+    sql += " where {}".format(rollup.get("where", "1").format(**names))
+    return sql + " group by {}".format(", ".join(keys))
+
+
+ROLLUP_ADD_SQL = """
+    insert into [{name}] ({columns}, checkins) {select}
+    on conflict ({columns}) do update set checkins = checkins + excluded.checkins;"""
+# Counts that fall to zero are removed, as a rebuild would not have them
+ROLLUP_REMOVE_SQL = """
+    delete from [{name}] where checkins <= 0 and ({columns}) in (
+        {select}
+    );"""
+
+
+def rollup_triggers(name, rollup):
+    # Returns {trigger_name: sql} for triggers on each table in the rollup,
+    # which add the counts joined to inserted rows and subtract those joined
+    # to deleted ones. With recursive_triggers on, as sqlite-utils sets it, an
+    # insert or replace fires the delete triggers for the row it replaces
+    columns = ", ".join("[{}]".format(column) for column in rollup["columns"])
+    triggers = {}
+    for table in rollup["tables"]:
+        add = ROLLUP_ADD_SQL.format(
+            name=name,
+            columns=columns,
+            select=rollup_select(rollup, "count(*)", "new", table),
+        )
+        subtract = ROLLUP_ADD_SQL.format(
+            name=name,
+            columns=columns,
+            select=rollup_select(rollup, "-count(*)", "old", table),
+        ) + ROLLUP_REMOVE_SQL.format(
+            name=name,
+            columns=columns,
+            select=rollup_select(rollup, None, "old", table),
+        )
+        for event, body in (
+            ("insert", add),
+            ("delete", subtract),
+            ("update", subtract + add),
+        ):
+            trigger = "{}_{}_{}".format(name, table, event)
+            sql = "create trigger [{}] after {} on [{}] begin{}\nend"
+            triggers[trigger] = sql.format(trigger, event, table, body)
+    return triggers
+
+
+def has_rollups(db):
+    return any(db[name].exists() for name in ROLLUPS)
+
+
+def create_rollup_triggers(db):
+    # Triggers are lost when a table is recreated, e.g. to add a foreign key
+    existing = set(db.triggers_dict)
+    with db.conn:
+        for name, rollup in ROLLUPS.items():
+            for trigger, sql in rollup_triggers(name, rollup).items():
+                if trigger not in existing:
+                    db.execute(sql)
+
+
+def enable_rollups(db):
+    # Creates the rollup tables and builds them from the existing checkins,
+    # then triggers keep them up to date as checkins are saved
+    for name, rollup in ROLLUPS.items():
+        if not db[name].exists():
+            columns = list(rollup["columns"])
+            db[name].create(
+                dict(rollup["columns"], checkins=int),
+                pk=columns[0] if len(columns) == 1 else tuple(columns),
+                not_null=columns,
+            )
+    rebuild_rollups(db)
+    create_rollup_triggers(db)
+
+
+def rebuild_rollups(db):
+    # Recomputes every rollup from scratch, in one transaction
+    table_names = set(db.table_names())
+    with db.conn:
+        for name, rollup in ROLLUPS.items():
+            db.execute("delete from [{}]".format(name))
+            if set(rollup["tables"]) <= table_names:
+                db.execute(
+                    "insert into [{}] ({}, checkins) {}".format(
+                        name,
+                        ", ".join(
+                            "[{}]".format(column) for column in rollup["columns"]
+                        ),
+                        rollup_select(rollup, "count(*)"),
+                    )
+                )
+
+
+@click.group()
+def cli():
+    "Manage the rollup tables of checkin counts"
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, exists=True),
+)
+def rebuild(db_path):
+    "Rebuild the rollup tables from scratch, creating them if necessary"
+    db = sqlite_utils.Database(db_path)
+    if not db["checkins"].exists():
+        raise click.ClickException("No checkins table in {}".format(db_path))
+    if partitions.has_partitions(db):
+        raise click.ClickException("Rollups cannot be used with partitioned storage")
+    utils.ensure_foreign_keys(db)
+    utils.create_indexes(db)
+    enable_rollups(db)
+    for name in ROLLUPS:
+        click.echo("{}: {} rows".format(name, db[name].count))
+
+
+if __name__ == "__main__":
+    cli()
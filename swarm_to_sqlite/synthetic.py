@@ -0,0 +1,190 @@
+import random
+
+SOURCES = (
+    {"name": "Swarm for iOS", "url": "https://www.swarmapp.com"},
+    {"name": "Swarm for Android", "url": "https://www.swarmapp.com"},
+)
+CATEGORY_NAMES = (
+    "Coffee Shop",
+    "Restaurant",
+    "Bar",
+    "Park",
+    "Museum",
+    "Airport",
+    "Hotel",
+    "Bookstore",
+    "Movie Theater",
+    "Train Station",
+)
+CITIES = (
+    ("San Francisco", "CA", "US", 37.77, -122.42),
+    ("London", "England", "GB", 51.51, -0.13),
+    ("New York", "NY", "US", 40.71, -74.01),
+    ("Tokyo", "Tokyo", "JP", 35.68, 139.69),
+)
+
+
+def generate_checkins(
+    count,
+    venue_reuse=0.7,
+    photos=0.5,
+    posts=0.1,
+    likes=1.0,
+    friends=50,
+    seed=0,
+    start=1262304000,
+):
+    # Generator yielding count synthetic checkins shaped like the ones returned
+    # by the Foursquare API, newest first. venue_reuse is the probability that
+    # a checkin is at a venue that has been seen before, photos, posts and
+    # likes are the average number of each per checkin
+    rng = random.Random(seed)
+    venues = []
+    users = [make_user(rng, "friend") for _ in range(friends)]
+    self_user = make_user(rng, "self")
+    categories = [make_category(rng, name) for name in CATEGORY_NAMES]
+    timestamps = sorted(
+        (start + rng.randint(0, 10 * 365 * 24 * 60 * 60) for _ in range(count)),
+        reverse=True,
+    )
+    for created_at in timestamps:
+        if venues and rng.random() < venue_reuse:
+            venue = rng.choice(venues)
+        else:
+            venue = make_venue(rng, rng.choice(categories))
+            venues.append(venue)
+        checkin = {
+            "id": make_id(rng),
+            "createdAt": created_at,
+            "type": "checkin",
+            "entities": [],
+            "shout": "Checkin number {}".format(rng.randint(0, 10**6)),
+            "timeZoneOffset": rng.choice((-480, -420, 0, 60, 540)),
+            "with": [dict(user) for user in rng.sample(users, rng.randint(0, 2))],
+            "venue": copy_venue(venue),
+            "likes": {
+                "count": 0,
+                "groups": [
+                    {
+                        "type": "friends",
+                        "items": [
+                            dict(user) for user in rng.sample(users, around(rng, likes))
+                        ],
+                    }
+                ],
+            },
+            "like": False,
+            "isMayor": rng.random() < 0.05,
+            "photos": {
+                "items": [
+                    make_photo(rng, created_at, self_user)
+                    for _ in range(around(rng, photos))
+                ]
+            },
+            "posts": {
+                "items": [make_post(rng, created_at) for _ in range(around(rng, posts))]
+            },
+            "comments": {"count": rng.randint(0, 3)},
+            "source": dict(rng.choice(SOURCES)),
+        }
+        checkin["likes"]["count"] = len(checkin["likes"]["groups"][0]["items"])
+        yield checkin
+
+
+def around(rng, mean):
+    # A random whole number with the specified mean
+    whole = int(mean)
+    return whole + (1 if rng.random() < mean - whole else 0)
+
+
+def make_id(rng):
+    return "{:024x}".format(rng.getrandbits(96))
+
+
+def make_user(rng, relationship):
+    return {
+        "id": str(rng.randint(1, 10**8)),
+        "firstName": rng.choice(("Alex", "Sam", "Jo", "Kim", "Lee")),
+        "lastName": rng.choice(("Smith", "Jones", "Brown", "Garcia")),
+        "gender": rng.choice(("female", "male", "none")),
+        "relationship": relationship,
+        "photo": {
+            "prefix": "https://fastly.4sqi.net/img/user/",
+            "suffix": "/{}.jpg".format(make_id(rng)),
+        },
+    }
+
+
+def make_category(rng, name):
+    return {
+        "id": make_id(rng),
+        "name": name,
+        "pluralName": name + "s",
+        "shortName": name,
+        "icon": {
+            "prefix": "https://ss3.4sqi.net/img/categories_v2/",
+            "suffix": ".png",
+        },
+        "primary": True,
+    }
+
+
+def make_venue(rng, category):
+    city, state, cc, lat, lng = rng.choice(CITIES)
+    lat = round(lat + rng.uniform(-0.2, 0.2), 6)
+    lng = round(lng + rng.uniform(-0.2, 0.2), 6)
+    address = "{} Main Street".format(rng.randint(1, 2000))
+    return {
+        "id": make_id(rng),
+        "name": "{} {}".format(category["name"], rng.randint(1, 10**4)),
+        "location": {
+            "address": address,
+            "lat": lat,
+            "lng": lng,
+            "labeledLatLngs": [{"label": "display", "lat": lat, "lng": lng}],
+            "cc": cc,
+            "city": city,
+            "state": state,
+            "formattedAddress": [address, city, state],
+        },
+        "categories": [category],
+    }
+
+
+def copy_venue(venue):
+    # Each checkin gets its own copy of the venue, as it would from the API
+    venue = dict(venue)
+    venue["location"] = dict(venue["location"])
+    venue["categories"] = [
+        dict(category, icon=dict(category["icon"])) for category in venue["categories"]
+    ]
+    return venue
+
+
+def make_photo(rng, created_at, user):
+    return {
+        "id": make_id(rng),
+        "createdAt": created_at + rng.randint(0, 600),
+        "source": dict(SOURCES[0]),
+        "prefix": "https://fastly.4sqi.net/img/general/",
+        "suffix": "/{}.jpg".format(make_id(rng)),
+        "width": 1920,
+        "height": 1440,
+        "user": dict(user),
+        "visibility": "public",
+    }
+
+
+def make_post(rng, created_at):
+    return {
+        "id": make_id(rng),
+        "createdAt": created_at + rng.randint(0, 600),
+        "source": {
+            "id": "UJXJTUHR42CKGO54KXQWGUZJL3OJKMKMVHGJ1SWIOC5TRKAC",
+            "name": "Foursquare for iOS",
+            "url": "https://foursquare.com/download/#/iphone",
+        },
+        "text": "A review of this place",
+        "url": "https://foursquare.com/item/{}".format(make_id(rng)),
+        "contentId": make_id(rng),
+    }
@@ -1,130 +1,683 @@
+import codecs
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import gzip
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import re
+import tempfile
+import threading
 import time
 import requests
+import sqlite_utils
 from sqlite_utils.db import AlterError, ForeignKey
+from .records import Checkin, User
 
+API_URL = "https://api.foursquare.com/v2"
+CHECKINS_URL = API_URL + "/users/self/checkins"
+USER_URL = API_URL + "/users/self"
+PAGE_SIZE = 250
+# Swarm's predecessor Foursquare launched in March 2009, so no checkins are
+# older than this
+FIRST_CHECKIN_TIMESTAMP = 1235865600
+USER_COLUMNS = ("id", "firstName", "lastName", "gender", "relationship", "photo")
+whitespace_re = re.compile(r"[ \t\n\r]*")
 
-def save_checkin(checkin, db):
-    # Create copy that we can modify
-    checkin = dict(checkin)
-    if "venue" in checkin:
-        venue = checkin.pop("venue")
-        categories = venue.pop("categories")
-        venue.update(venue.pop("location"))
-        venue.pop("labeledLatLngs", None)
-        venue["latitude"] = venue.pop("lat")
-        venue["longitude"] = venue.pop("lng")
-        v = db["venues"].insert(venue, pk="id", alter=True, replace=True)
-        for category in categories:
-            cleanup_category(category)
-            v.m2m("categories", category, pk="id", alter=True)
-        checkin["venue"] = venue["id"]
-    else:
-        checkin["venue"] = None
-    if "createdBy" not in checkin:
-        checkin["createdBy"] = None
-    if "event" in checkin:
-        event = checkin.pop("event")
-        categories = event.pop("categories")
-        e = db["events"].insert(event, pk="id", alter=True, replace=True)
-        for category in categories:
-            cleanup_category(category)
-            e.m2m("categories", category, pk="id", alter=True)
-        checkin["event"] = event["id"]
-    else:
-        checkin["event"] = None
-
-    if "sticker" in checkin:
-        sticker = checkin.pop("sticker")
-        sticker_image = sticker.pop("image")
-        sticker["image_prefix"] = sticker_image["prefix"]
-        sticker["image_sizes"] = sticker_image["sizes"]
-        sticker["image_name"] = sticker_image["name"]
-        checkin["sticker"] = (
-            db["stickers"].insert(sticker, pk="id", alter=True, replace=True).last_pk
-        )
-    else:
-        checkin["sticker"] = None
 
-    checkin["created"] = datetime.datetime.utcfromtimestamp(
-        checkin["createdAt"]
-    ).isoformat()
-    checkin["source"] = (
-        db["sources"].lookup(checkin["source"]) if "source" in checkin else None
-    )
-    users_with = checkin.pop("with", None) or []
-    users_likes = []
-    for group in checkin["likes"]["groups"]:
-        users_likes.extend(group["items"])
-    del checkin["likes"]
-    photos = checkin.pop("photos")["items"]
-    posts = (checkin.pop("posts") or {}).get("items") or []
-    if checkin.get("createdBy"):
-        created_by_user = checkin.pop("createdBy")
-        cleanup_user(created_by_user)
-        db["users"].insert(created_by_user, pk="id", replace=True, alter=True)
-        checkin["createdBy"] = created_by_user["id"]
-    checkin["comments_count"] = checkin.pop("comments")["count"]
-    # Actually save the checkin
-    checkins_table = db["checkins"].insert(
-        checkin,
+M2M_COLUMNS = {
+    "categories_venues": ["categories_id", "venues_id"],
+    "categories_events": ["categories_id", "events_id"],
+    "with": ["checkins_id", "users_id"],
+    "likes": ["checkins_id", "users_id"],
+}
+
+TABLE_OPTIONS = {
+    "venues": dict(pk="id", alter=True, replace=True),
+    "categories": dict(pk="id", alter=True, replace=True),
+    "events": dict(pk="id", alter=True, replace=True),
+    "stickers": dict(pk="id", alter=True, replace=True),
+    "users": dict(pk="id", alter=True, replace=True),
+    "checkins": dict(
         pk="id",
         foreign_keys=(("venue", "venues", "id"), ("source", "sources", "id")),
         alter=True,
         replace=True,
-    )
-    # Save m2m 'with' users and 'likes' users
-    for user in users_with:
-        cleanup_user(user)
-        checkins_table.m2m("users", user, m2m_table="with", pk="id", alter=True)
-    for user in users_likes:
-        cleanup_user(user)
-        checkins_table.m2m("users", user, m2m_table="likes", pk="id", alter=True)
-    # Handle photos
-    photos_table = db.table("photos", pk="id", foreign_keys=("user", "source"))
-    for photo in photos:
-        photo["created"] = datetime.datetime.utcfromtimestamp(
-            photo["createdAt"]
-        ).isoformat()
-        photo["source"] = db["sources"].lookup(photo["source"])
-        user = photo.pop("user")
-        cleanup_user(user)
-        db["users"].insert(user, pk="id", replace=True, alter=True)
-        photo["user"] = user["id"]
-        photos_table.insert(photo, replace=True, alter=True)
-    # Handle posts
-    posts_table = db.table("posts", pk="id")
-    for post in posts:
-        post["created"] = datetime.datetime.utcfromtimestamp(
-            post["createdAt"]
-        ).isoformat()
-        post["post_source"] = (
-            db["post_sources"]
-            .insert(post.pop("source"), pk="id", replace=True, alter=True)
-            .last_pk
-        )
-        post["checkin"] = checkin["id"]
-        posts_table.insert(
-            post, foreign_keys=("post_source", "checkin"), replace=True, alter=True
+    ),
+    "photos": dict(pk="id", foreign_keys=("user", "source"), alter=True, replace=True),
+    "post_sources": dict(pk="id", alter=True, replace=True),
+    "posts": dict(
+        pk="id", foreign_keys=("post_source", "checkin"), alter=True, replace=True
+    ),
+    "photos_compact": dict(
+        pk="id",
+        foreign_keys=(
+            ("source", "sources", "id"),
+            ("prefix", "photo_prefixes", "id"),
+            ("size", "photo_sizes", "id"),
+            ("user", "users", "id"),
+        ),
+        alter=True,
+        replace=True,
+    ),
+    "posts_compact": dict(
+        pk="id",
+        foreign_keys=(
+            ("post_source", "post_sources", "id"),
+            ("checkin", "checkins", "id"),
+        ),
+        alter=True,
+        replace=True,
+    ),
+}
+for m2m_table, columns in M2M_COLUMNS.items():
+    TABLE_OPTIONS[m2m_table] = dict(pk=columns, foreign_keys=columns, replace=True)
+
+# The known shape of each table, in an order where referenced tables are
+# created before the tables that reference them
+TABLE_SCHEMAS = {
+    "sources": dict(columns={"id": int, "name": str, "url": str}),
+    "venues": dict(
+        columns={
+            "id": str,
+            "name": str,
+            "address": str,
+            "crossStreet": str,
+            "postalCode": str,
+            "cc": str,
+            "city": str,
+            "state": str,
+            "country": str,
+            "formattedAddress": str,
+            "latitude": float,
+            "longitude": float,
+        }
+    ),
+    "categories": dict(
+        columns={
+            "id": str,
+            "name": str,
+            "pluralName": str,
+            "shortName": str,
+            "primary": int,
+            "icon_prefix": str,
+            "icon_suffix": str,
+        }
+    ),
+    "categories_venues": dict(
+        columns={"categories_id": str, "venues_id": str},
+        foreign_keys=[
+            ("categories_id", "categories", "id"),
+            ("venues_id", "venues", "id"),
+        ],
+    ),
+    "events": dict(columns={"id": str, "name": str}),
+    "categories_events": dict(
+        columns={"categories_id": str, "events_id": str},
+        foreign_keys=[
+            ("categories_id", "categories", "id"),
+            ("events_id", "events", "id"),
+        ],
+    ),
+    "stickers": dict(
+        columns={
+            "id": str,
+            "name": str,
+            "stickerType": str,
+            "group": str,
+            "pickerPosition": str,
+            "teaseText": str,
+            "unlockText": str,
+            "image_prefix": str,
+            "image_sizes": str,
+            "image_name": str,
+        }
+    ),
+    "users": dict(
+        columns={
+            "id": str,
+            "firstName": str,
+            "lastName": str,
+            "gender": str,
+            "relationship": str,
+            "photo_prefix": str,
+            "photo_suffix": str,
+        }
+    ),
+    "checkins": dict(
+        columns={
+            "id": str,
+            "createdAt": int,
+            "type": str,
+            "entities": str,
+            "shout": str,
+            "timeZoneOffset": int,
+            "like": int,
+            "isMayor": int,
+            "source": int,
+            "venue": str,
+            "createdBy": str,
+            "event": str,
+            "sticker": str,
+            "created": str,
+            "comments_count": int,
+        },
+        foreign_keys=[
+            ("source", "sources", "id"),
+            ("venue", "venues", "id"),
+            ("createdBy", "users", "id"),
+            ("event", "events", "id"),
+            ("sticker", "stickers", "id"),
+        ],
+    ),
+    "with": dict(
+        columns={"users_id": str, "checkins_id": str},
+        foreign_keys=[("users_id", "users", "id"), ("checkins_id", "checkins", "id")],
+    ),
+    "likes": dict(
+        columns={"users_id": str, "checkins_id": str},
+        foreign_keys=[("users_id", "users", "id"), ("checkins_id", "checkins", "id")],
+    ),
+    "photos": dict(
+        columns={
+            "id": str,
+            "createdAt": int,
+            "source": int,
+            "prefix": str,
+            "suffix": str,
+            "width": int,
+            "height": int,
+            "visibility": str,
+            "created": str,
+            "user": str,
+        },
+        foreign_keys=[("source", "sources", "id"), ("user", "users", "id")],
+    ),
+    "post_sources": dict(
+        columns={
+            "id": str,
+            "consumerId": str,
+            "name": str,
+            "photo": str,
+            "icon": str,
+            "detailUrl": str,
+            "url": str,
+        }
+    ),
+    "posts": dict(
+        columns={
+            "id": str,
+            "createdAt": int,
+            "text": str,
+            "url": str,
+            "contentId": str,
+            "created": str,
+            "post_source": str,
+            "checkin": str,
+        },
+        foreign_keys=[
+            ("post_source", "post_sources", "id"),
+            ("checkin", "checkins", "id"),
+        ],
+    ),
+}
+
+
+CACHED_TABLES = {
+    "venues",
+    "categories",
+    "categories_venues",
+    "events",
+    "categories_events",
+    "stickers",
+    "users",
+    "post_sources",
+}
+
+
+class ImportCache:
+    # Remembers the rows and source lookups already written during an import,
+    # keeping up to max_size entries per table in least-recently-used order
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = collections.defaultdict(collections.OrderedDict)
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def get(self, table, key):
+        entries = self.entries[table]
+        if key in entries:
+            entries.move_to_end(key)
+            self.hits[table] += 1
+            return entries[key]
+        self.misses[table] += 1
+        return None
+
+    def set(self, table, key, value):
+        entries = self.entries[table]
+        entries[key] = value
+        entries.move_to_end(key)
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def seen(self, table, row, key_hash=None):
+        # Returns True if this exact row has already been written. key_hash
+        # is (row_key(), row_hash()) for the row, if already calculated
+        key, hash = key_hash or (row_key(table, row), row_hash(row))
+        if self.get(table, key) == hash:
+            return True
+        self.set(table, key, hash)
+        return False
+
+    def lookup(self, db, table, values):
+        key = json.dumps(values, sort_keys=True, default=repr)
+        id = self.get(table, key)
+        if id is None:
+            id = db[table].lookup(values)
+            self.set(table, key, id)
+        return id
+
+    def hit_rates(self):
+        return {
+            table: self.hits[table] / (self.hits[table] + self.misses[table])
+            for table in sorted(set(self.hits) | set(self.misses))
+        }
+
+
+class ChangeDetector:
+    # Stores a hash of each row written in the row_hashes table, so rows that
+    # are unchanged since they were last written can be skipped
+    def __init__(self):
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def filter(self, db, table, rows):
+        # Returns (changed_rows, row_hashes_to_store)
+        latest = {}
+        for row in rows:
+            latest[row_key(table, row)] = row
+        existing = {}
+        if db["row_hashes"].exists():
+            existing = dict(
+                db.execute(
+                    "select key, hash from row_hashes where [table] = ? "
+                    "and key in (select value from json_each(?))",
+                    [table, json.dumps(list(latest))],
+                ).fetchall()
+            )
+        changed = []
+        hashes = []
+        for key, row in latest.items():
+            hash = row_hash(row)
+            previous = existing.get(key)
+            if previous == hash:
+                self.counts[table]["unchanged"] += 1
+                continue
+            self.counts[table]["inserted" if previous is None else "updated"] += 1
+            changed.append(row)
+            hashes.append({"table": table, "key": key, "hash": hash})
+        return changed, hashes
+
+    def summary(self):
+        return "\n".join(
+            "{}: {} inserted, {} updated, {} unchanged".format(
+                table,
+                counts["inserted"],
+                counts["updated"],
+                counts["unchanged"],
+            )
+            for table, counts in sorted(self.counts.items())
         )
 
 
-def cleanup_user(user):
-    photo = user.pop("photo", None) or {}
-    user["photo_prefix"] = photo.get("prefix")
-    user["photo_suffix"] = photo.get("suffix")
+def has_row_hashes(db):
+    return db["row_hashes"].exists()
+
+
+def row_key(table, row):
+    # The primary key of a row as a string
+    pk = TABLE_OPTIONS[table]["pk"]
+    if isinstance(pk, list):
+        return json.dumps([row[column] for column in pk])
+    return str(row[pk])
+
+
+def row_hash(row):
+    return hashlib.sha1(
+        json.dumps(row, sort_keys=True, default=repr).encode("utf-8")
+    ).hexdigest()
+
+
+class ImportStats:
+    # Records wall time, call counts and rows for each stage of an import,
+    # plus the number of SQL statements executed
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.rows = collections.Counter()
+        self.sql_statements = 0
+
+    @contextlib.contextmanager
+    def timer(self, stage, rows=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+            self.rows[stage] += rows
+
+    def timed(self, stage, iterator):
+        # Generator that records the time spent producing each item
+        iterator = iter(iterator)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def trace(self, db):
+        # Count every statement executed against this database connection
+        def count_statement(sql):
+            self.sql_statements += 1
+
+        db.conn.set_trace_callback(count_statement)
+
+    def as_dict(self):
+        return {
+            "stages": {
+                stage: {
+                    "seconds": self.seconds[stage],
+                    "calls": self.calls[stage],
+                    "rows": self.rows[stage],
+                }
+                for stage in self.seconds
+            },
+            "sql_statements": self.sql_statements,
+        }
+
+    def summary(self):
+        lines = [
+            "{:<30} {:>10} {:>10} {:>10}".format("stage", "calls", "rows", "seconds")
+        ]
+        for stage in sorted(self.seconds, key=self.seconds.get, reverse=True):
+            lines.append(
+                "{:<30} {:>10} {:>10} {:>10.3f}".format(
+                    stage, self.calls[stage], self.rows[stage], self.seconds[stage]
+                )
+            )
+        lines.append("SQL statements: {}".format(self.sql_statements))
+        return "\n".join(lines)
+
+
+def save_checkin(checkin, db):
+    save_rows(transform_checkin(checkin, db), db)
+
+
+def create_tables(db):
+    # Create any missing tables with their known columns and foreign keys
+    # Tables replaced by views in compact storage mode are left alone, as
+    # db[table] is then a View object which exists(), as are partitioned
+    # tables, which are created in each partition instead
+    # The storage mode modules are imported here, as they import this module
+    from .partitions import has_partitions, PARTITIONED_TABLES
+
+    partitioned = has_partitions(db)
+    for table, schema in TABLE_SCHEMAS.items():
+        if partitioned and table in PARTITIONED_TABLES:
+            continue
+        if not db[table].exists():
+            pk = TABLE_OPTIONS.get(table, {}).get("pk", "id")
+            foreign_keys = schema.get("foreign_keys")
+            if partitioned and foreign_keys:
+                foreign_keys = [
+                    fk for fk in foreign_keys if fk[1] not in PARTITIONED_TABLES
+                ]
+            db[table].create(
+                schema["columns"],
+                pk=tuple(pk) if isinstance(pk, list) else pk,
+                foreign_keys=foreign_keys,
+            )
+
+
+def save_checkins(
+    checkins,
+    db,
+    batch_size=100,
+    cache=None,
+    stats=None,
+    changes=None,
+    commit_every=None,
+    processes=None,
+    checkpoint=None,
+    compact=False,
+    partitions=None,
+):
+    # Accumulate rows for batch_size checkins at a time, then write each
+    # table using a single insert_all() call
+    # Everything is written in one transaction, unless commit_every is set in
+    # which case a transaction is committed after every commit_every checkins
+    # If an ImportCache is provided, rows it has already seen are skipped
+    # If ImportStats are provided, transform and write times are recorded
+    # If a ChangeDetector is provided, rows unchanged in the database are skipped
+    # If processes is set, checkins are flattened by a pool of that many worker
+    # processes, while this process looks up sources and writes the rows
+    # checkpoint(db, checkin_rows) is called just before each transaction
+    # commits, with the checkins table rows saved in that transaction
+    # If compact is True, photos and posts are written in compact storage form
+    # If Partitions are provided, checkins, photos and posts are written to
+    # the partition for each checkin, in a transaction committed with db's own
+    from .compact import compact_rows
+
+    if processes:
+        checkins = flatten_in_processes(checkins, processes)
+    checkins = iter(checkins)
+    known_columns = {}
+    while True:
+        chunk = itertools.islice(checkins, commit_every) if commit_every else checkins
+        batch = {}
+        count = 0
+        saved = 0
+        checkin_rows = []
+        if partitions is not None:
+            partitioned = partitions.transaction()
+        else:
+            partitioned = contextlib.nullcontext()
+        with transaction(db), partitioned:
+            for checkin in chunk:
+                if processes:
+                    transform = finish_flattened
+                else:
+                    transform = transform_checkin
+                if stats is None:
+                    transformed = transform(checkin, db, cache)
+                else:
+                    with stats.timer("transform", rows=1):
+                        transformed = transform(checkin, db, cache)
+                if compact:
+                    transformed = compact_rows(transformed, db, cache)
+                checkin_rows.extend(transformed["checkins"])
+                if partitions is not None:
+                    transformed = partitions.add(transformed)
+                for table, rows in transformed.items():
+                    batch.setdefault(table, []).extend(rows)
+                count += 1
+                saved += 1
+                if count >= batch_size:
+                    save_rows(batch, db, known_columns, stats, changes)
+                    if partitions is not None:
+                        partitions.save(stats, changes)
+                    batch = {}
+                    count = 0
+            if batch:
+                save_rows(batch, db, known_columns, stats, changes)
+            if partitions is not None:
+                partitions.save(stats, changes)
+            if checkpoint is not None and checkin_rows:
+                checkpoint(db, checkin_rows)
+        if not commit_every or saved < commit_every:
+            break
+
+
+def flatten_in_processes(checkins, processes, shard_size=100):
+    # Generator yielding flatten_checkin() for each checkin, in order, using
+    # a pool of worker processes - at most two shards per process are in
+    # flight at once, so memory use does not grow with the input size
+    # Checkins can be undecoded JSON strings, which the workers decode
+    checkins = iter(checkins)
+    pending = collections.deque()
+    with multiprocessing.Pool(processes) as pool:
+        while True:
+            while len(pending) < processes * 2:
+                shard = list(itertools.islice(checkins, shard_size))
+                if not shard:
+                    break
+                pending.append(pool.apply_async(flatten_checkins, (shard,)))
+            if not pending:
+                return
+            for rows in pending.popleft().get():
+                yield rows
+
+
+def flatten_checkins(checkins):
+    # Runs in the worker processes, returning (rows, key_hashes) for each
+    # checkin, where key_hashes has the cache keys and hashes of the rows in
+    # CACHED_TABLES, so the parent process does not need to calculate them
+    flattened = []
+    for checkin in checkins:
+        if isinstance(checkin, str):
+            checkin = json.loads(checkin)
+        rows = flatten_checkin(checkin)
+        key_hashes = {
+            table: [(row_key(table, row), row_hash(row)) for row in table_rows]
+            for table, table_rows in rows.items()
+            if table in CACHED_TABLES
+        }
+        flattened.append((rows, key_hashes))
+    return flattened
+
+
+def finish_flattened(flattened, db, cache=None):
+    # finish_transform() for a (rows, key_hashes) pair from flatten_checkins()
+    rows, key_hashes = flattened
+    return finish_transform(rows, db, cache, key_hashes)
+
+
+@contextlib.contextmanager
+def transaction(db):
+    # sqlite-utils 4 has atomic(), which uses savepoints when nested
+    if hasattr(db, "atomic"):
+        with db.atomic():
+            yield
+    else:
+        with db.conn:
+            yield
+
+
+@contextlib.contextmanager
+def bulk_import_mode(db, cache_size_mb=64, mmap_size_mb=256):
+    # Switch to WAL with synchronous=NORMAL and a larger page cache and
+    # memory map for the duration of an import, then restore the previous
+    # settings. Each committed transaction is still atomic, so an interrupted
+    # import leaves the database consistent
+    pragmas = ("journal_mode", "synchronous", "cache_size", "mmap_size")
+    previous = {
+        pragma: db.execute("pragma {}".format(pragma)).fetchone()[0]
+        for pragma in pragmas
+    }
+    db.execute("pragma journal_mode = wal")
+    db.execute("pragma synchronous = normal")
+    db.execute("pragma cache_size = {}".format(-cache_size_mb * 1024))
+    db.execute("pragma mmap_size = {}".format(mmap_size_mb * 1024 * 1024))
+    try:
+        yield
+    finally:
+        for pragma in reversed(pragmas):
+            db.execute("pragma {} = {}".format(pragma, previous[pragma]))
+
+
+def save_rows(rows_by_table, db, known_columns=None, stats=None, changes=None):
+    # Tables are written in the order they were first seen, which guarantees
+    # that tables referenced by foreign keys exist before they are needed
+    # known_columns is a {table: set_of_columns} dictionary used to only pass
+    # alter=True when rows have columns that the table does not have yet
+    for table, rows in rows_by_table.items():
+        hashes = None
+        if changes is not None:
+            rows, hashes = changes.filter(db, table, rows)
+            if not rows:
+                continue
+        options = TABLE_OPTIONS[table]
+        if known_columns is not None:
+            if table not in known_columns and db[table].exists():
+                known_columns[table] = set(db[table].columns_dict)
+            columns = set()
+            for row in rows:
+                columns.update(row)
+            if columns.issubset(known_columns.get(table, ())):
+                options = dict(options, alter=False)
+            else:
+                known_columns[table] = known_columns.get(table, set()) | columns
+        if stats is None:
+            db[table].insert_all(rows, **options)
+        else:
+            with stats.timer("write {}".format(table), rows=len(rows)):
+                db[table].insert_all(rows, **options)
+        if hashes:
+            db["row_hashes"].insert_all(hashes, pk=("table", "key"), replace=True)
+
+
+def transform_checkin(checkin, db, cache=None):
+    # Flatten a checkin into {table_name: [rows]}, looking up source IDs
+    # and dropping rows already seen by the cache
+    return finish_transform(flatten_checkin(checkin), db, cache)
+
+
+def finish_transform(rows, db, cache=None, key_hashes=None):
+    # Replaces source dictionaries left by flatten_checkin() with IDs from
+    # the sources lookup table, then drops rows the cache has already seen
+    # key_hashes optionally has the cache keys and hashes for those rows
+    for table in ("checkins", "photos"):
+        for row in rows.get(table, ()):
+            if isinstance(row.get("source"), dict):
+                if cache is not None:
+                    row["source"] = cache.lookup(db, "sources", row["source"])
+                else:
+                    row["source"] = db["sources"].lookup(row["source"])
+    if cache is not None:
+        for table in list(rows):
+            if table in CACHED_TABLES:
+                if key_hashes is not None:
+                    pairs = zip(rows[table], key_hashes[table])
+                else:
+                    pairs = ((row, None) for row in rows[table])
+                rows[table] = [
+                    row
+                    for row, key_hash in pairs
+                    if not cache.seen(table, row, key_hash)
+                ]
+                if not rows[table]:
+                    del rows[table]
+    return rows
 
 
-def cleanup_category(category):
-    category["icon_prefix"] = category["icon"]["prefix"]
-    category["icon_suffix"] = category["icon"]["suffix"]
-    del category["icon"]
+def flatten_checkin(checkin):
+    # Flatten a checkin into {table_name: [rows]} without touching the
+    # database - sources are left as dictionaries for finish_transform()
+    return Checkin.from_json(checkin).rows()
 
 
 def ensure_foreign_keys(db):
-    existing = []
-    for table in db.tables:
-        existing.extend(table.foreign_keys)
+    # All of these foreign keys are on the checkins table
+    if not db["checkins"].exists():
+        return
+    existing = db["checkins"].foreign_keys
     desired = [
         ForeignKey(
             table="checkins", column="createdBy", other_table="users", other_column="id"
@@ -132,6 +685,12 @@ def ensure_foreign_keys(db):
         ForeignKey(
             table="checkins", column="event", other_table="events", other_column="id"
         ),
+        ForeignKey(
+            table="checkins",
+            column="account",
+            other_table="users",
+            other_column="id",
+        ),
         ForeignKey(
             table="checkins",
             column="sticker",
@@ -145,13 +704,19 @@ def ensure_foreign_keys(db):
                 db[fk.table].add_foreign_key(fk.column, fk.other_table, fk.other_column)
             except AlterError:
                 pass
+    from .rollups import has_rollups, create_rollup_triggers
 
+    if has_rollups(db):
+        # Adding a foreign key recreates the checkins table, without triggers
+        create_rollup_triggers(db)
 
-def create_views(db):
-    for name, sql in (
-        (
-            "venue_details",
-            """
+
+# SQL for each view, with a {where} placeholder used to only select the
+# rows for specific venues or checkins when refreshing materialized tables
+VIEWS = {
+    "venue_details": (
+        "venues.id",
+        """
 select
     min(created) as first,
     max(created) as last,
@@ -162,12 +727,12 @@ from venues
     join checkins on checkins.venue = venues.id
     join categories_venues on venues.id = categories_venues.venues_id
     join categories on categories.id = categories_venues.categories_id
-group by venues.id
+{where}group by venues.id
         """,
-        ),
-        (
-            "checkin_details",
-            """
+    ),
+    "checkin_details": (
+        "checkins.id",
+        """
 select
     checkins.id,
     strftime('%Y-%m-%dT%H:%M:%S', checkins.createdAt, 'unixepoch') as created,
@@ -184,41 +749,789 @@ from checkins
     left join events on checkins.event = events.id
     join categories_venues on venues.id = categories_venues.venues_id
     join categories on categories.id = categories_venues.categories_id
-group by checkins.id
+{where}group by checkins.id
 order by checkins.createdAt desc
         """,
-        ),
-    ):
+    ),
+}
+
+INDEXES = (
+    ("checkins", ["venue"]),
+    ("checkins", ["createdAt"]),
+    ("categories_venues", ["venues_id"]),
+    ("categories_events", ["events_id"]),
+    ("with", ["users_id"]),
+    ("likes", ["users_id"]),
+    ("photos", ["user"]),
+    ("photos_compact", ["user"]),
+)
+
+
+def create_views(db):
+    for name, (_, sql) in VIEWS.items():
         try:
-            db.create_view(name, sql, replace=True)
+            db.create_view(name, sql.format(where=""), replace=True)
         except Exception:
             pass
 
 
-def fetch_all_checkins(token, count_first=False, since_delta=None):
+def create_indexes(db):
+    table_names = set(db.table_names())
+    for table, columns in INDEXES:
+        if table in table_names:
+            db[table].create_index(columns, if_not_exists=True)
+
+
+def has_materialized_views(db):
+    # db[name] is a View object for views, which also exist()
+    table_names = set(db.table_names())
+    return any(name in table_names for name in VIEWS)
+
+
+def materialize_views(db, checkin_ids=None, venue_ids=None):
+    # Store each view as a table of the same name. If IDs are provided, only
+    # the rows for those checkins and venues are refreshed - unless the table
+    # does not exist yet or its columns have changed, then it is rebuilt
+    if checkin_ids is not None and venue_ids:
+        # checkin_details copies venue columns, so checkins at the venues
+        # that were saved are refreshed too
+        checkin_ids = set(checkin_ids) | {
+            row[0]
+            for row in db.execute(
+                "select id from checkins where venue in "
+                "(select value from json_each(?))",
+                [json.dumps(list(venue_ids))],
+            )
+        }
+    ids = {"checkin_details": checkin_ids, "venue_details": venue_ids}
+    with db.conn:
+        for name, (id_column, sql) in VIEWS.items():
+            full_sql = sql.format(where="")
+            columns = [
+                d[0]
+                for d in db.execute(
+                    "select * from ({}) limit 0".format(full_sql)
+                ).description
+            ]
+            if name in db.view_names():
+                db.execute("drop view [{}]".format(name))
+            if (
+                ids[name] is None
+                or not db[name].exists()
+                or list(db[name].columns_dict) != columns
+            ):
+                db.execute("drop table if exists [{}]".format(name))
+                db.execute("create table [{}] as {}".format(name, full_sql))
+                db[name].create_index(["id"], unique=True)
+                continue
+            where = "where {} in (select value from json_each(?))\n".format(id_column)
+            id_json = json.dumps(list(ids[name]))
+            db.execute(
+                "delete from [{}] where id in (select value from json_each(?))".format(
+                    name
+                ),
+                [id_json],
+            )
+            db.execute(
+                "insert into [{}] {}".format(name, sql.format(where=where)), [id_json]
+            )
+
+
+# Columns indexed for full-text search, in tables named <table>_fts
+SEARCH_INDEXES = {
+    "checkins": ["shout"],
+    "venues": ["name", "address", "crossStreet", "city", "state", "country"],
+    "events": ["name"],
+}
+
+
+def has_search_index(db):
+    return any(db["{}_fts".format(table)].exists() for table in SEARCH_INDEXES)
+
+
+def enable_search_index(db):
+    # Configures FTS5 for each table in SEARCH_INDEXES, with triggers that
+    # update the index as rows are saved. A table is only indexed from scratch
+    # if it has no index yet, or its triggers were lost because the table was
+    # recreated, e.g. to add a foreign key
+    for table, columns in SEARCH_INDEXES.items():
+        if not db[table].exists():
+            continue
+        columns = [column for column in columns if column in db[table].columns_dict]
+        if columns:
+            db[table].enable_fts(columns, create_triggers=True, replace=True)
+
+
+def finish_import(
+    db,
+    checkin_ids=None,
+    venue_ids=None,
+    materialize=False,
+    spatial_index=False,
+    rollups=False,
+    search_index=False,
+    stage=None,
+):
+    # Brings the foreign keys, indexes, views and other derived tables up to
+    # date after checkins have been saved. The options enable those features,
+    # and ones the database already has are always kept up to date
+    # Materialized views are refreshed for checkin_ids and venue_ids, or
+    # rebuilt if they are None. stage is an optional function returning a
+    # context manager for timing each step, such as ImportStats.timer
+    from .compact import has_compact_storage, create_compact_views
+    from .partitions import has_partitions
+    from .rollups import has_rollups, enable_rollups
+    from .venues import has_spatial_index, enable_spatial_index
+
+    stage = stage or (lambda name: contextlib.nullcontext())
+    with stage("ensure_foreign_keys"):
+        ensure_foreign_keys(db)
+    with stage("create_indexes"):
+        create_indexes(db)
+    if spatial_index and not has_spatial_index(db):
+        # Once created, the index is kept up to date by triggers
+        with stage("spatial_index"):
+            enable_spatial_index(db)
+    if rollups and not has_rollups(db):
+        with stage("rollups"):
+            enable_rollups(db)
+    if has_compact_storage(db):
+        with stage("compact_views"):
+            create_compact_views(db)
+    if search_index or has_search_index(db):
+        # Triggers keep existing indexes up to date, so this only indexes
+        # tables that have no index yet
+        with stage("search_index"):
+            enable_search_index(db)
+    if has_partitions(db):
+        # Partitioned databases get their views from
+        # partitions.attach_partitions() on each connection instead
+        return
+    if materialize or has_materialized_views(db):
+        with stage("materialize_views"):
+            materialize_views(db, checkin_ids, venue_ids)
+    else:
+        with stage("create_views"):
+            create_views(db)
+
+
+def iter_json_records(fp, chunk_size=64 * 1024, progress=None, raw=False):
+    # Generator yielding records one at a time from a file containing either a
+    # top-level JSON array or newline-delimited JSON, reading it in chunks
+    # progress, if provided, is called with the number of bytes of each chunk
+    # If raw is True, newline-delimited records are yielded as undecoded
+    # strings, one per line, so that worker processes can decode them
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    pos = 0
+    eof = False
+    in_array = None
+    expect_comma = False
+    while True:
+        pos = whitespace_re.match(buffer, pos).end()
+        char = buffer[pos] if pos < len(buffer) else None
+        if char is not None and in_array is None:
+            in_array = char == "["
+            if raw and not in_array:
+                yield from iter_lines(buffer[pos:], fp, chunk_size, progress, utf8)
+                return
+            pos += 1 if in_array else 0
+            continue
+        if char is not None and in_array and (char == "]" or expect_comma):
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError("Expected ',' at position {}".format(pos))
+            pos += 1
+            expect_comma = False
+            continue
+        if char is not None:
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                expect_comma = in_array
+                yield record
+                continue
+        if eof:
+            if in_array:
+                raise ValueError("Unexpected end of JSON array")
+            return
+        # Read more, growing the read size if a single record is larger
+        chunk = fp.read(max(chunk_size, len(buffer) - pos))
+        if progress is not None and chunk:
+            progress(len(chunk))
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk, final=not chunk)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def iter_lines(buffer, fp, chunk_size, progress, utf8):
+    # Yields the non-blank lines of buffer followed by the rest of fp
+    while True:
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        if progress is not None and chunk:
+            progress(len(chunk))
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk, final=eof)
+        lines = (buffer + chunk).split("\n")
+        buffer = "" if eof else lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+        if eof:
+            return
+
+
+def incremental_state(db, account=None):
+    # Returns (after_timestamp, known_ids) for resuming from the newest stored
+    # checkin, or (None, set()) if there are no checkins in the database yet
+    # If account is provided only checkins from that account are considered
+    from .partitions import has_partitions, partitioned_incremental_state
+
+    if has_partitions(db):
+        return partitioned_incremental_state(db, account)
+    if not db["checkins"].exists():
+        return None, set()
+    where, params = "", []
+    if account is not None:
+        if "account" not in db["checkins"].columns_dict:
+            return None, set()
+        where, params = " and account = ?", [account]
+    after_timestamp = db.execute(
+        "select max(createdAt) from checkins where 1 = 1" + where, params
+    ).fetchone()[0]
+    if after_timestamp is None:
+        return None, set()
+    known_ids = {
+        row[0]
+        for row in db.execute(
+            "select id from checkins where createdAt >= ?" + where,
+            [after_timestamp] + params,
+        )
+    }
+    return after_timestamp, known_ids
+
+
+def get_import_state(db, key):
+    # Returns the saved progress of the last API import for this key - the
+    # account ID, or "self" for single account imports - or None
+    if not db["import_state"].exists():
+        return None
+    rows = list(db["import_state"].rows_where("key = ?", [key]))
+    return rows[0] if rows else None
+
+
+def start_import_state(db, key, after_timestamp=None):
+    # Records that a fresh import is starting, with no pages saved yet
+    with transaction(db):
+        db["import_state"].insert(
+            {
+                "key": key,
+                "after_timestamp": after_timestamp,
+                "before_timestamp": None,
+                "checkins_saved": 0,
+                "complete": 0,
+                "updated": datetime.datetime.utcnow().isoformat(),
+            },
+            pk="key",
+            replace=True,
+            columns={"after_timestamp": int, "before_timestamp": int},
+        )
+
+
+def checkpoint_import_state(db, checkin_rows):
+    # Moves the paging cursor of each import back to the oldest checkin saved
+    # - called by save_checkins() in the same transaction as those checkins
+    oldest = {}
+    counts = collections.Counter()
+    for row in checkin_rows:
+        key = row.get("account") or "self"
+        oldest[key] = min(oldest.get(key, row["createdAt"]), row["createdAt"])
+        counts[key] += 1
+    for key, created_at in oldest.items():
+        db.execute(
+            """
+            update import_state set
+                before_timestamp = min(coalesce(before_timestamp, ?), ?),
+                checkins_saved = checkins_saved + ?,
+                updated = ?
+            where key = ?
+            """,
+            [
+                created_at,
+                created_at,
+                counts[key],
+                datetime.datetime.utcnow().isoformat(),
+                key,
+            ],
+        )
+
+
+def complete_import_state(db, keys):
+    with transaction(db):
+        for key in keys:
+            db["import_state"].update(key, {"complete": 1})
+
+
+def fetch_account(token, client=None, url=USER_URL):
+    # Returns the user record for the account the token belongs to
+    client = client or FoursquareClient()
+    user = client.get(url, {"oauth_token": token, "v": "20190101"})["response"]["user"]
+    return User.from_json({key: user[key] for key in USER_COLUMNS if key in user}).row()
+
+
+def with_account(checkins, account):
+    # Tags each checkin with the ID of the account it was fetched from
+    for checkin in checkins:
+        yield dict(checkin, account=account)
+
+
+def fetch_all_checkins(
+    token,
+    count_first=False,
+    since_delta=None,
+    after_timestamp=None,
+    stop_ids=None,
+    prefetch=0,
+    url=CHECKINS_URL,
+    client=None,
+    before_timestamp=None,
+    response_cache=None,
+):
     # Generator that yields all checkins using the provided OAuth token
     # If count_first is True it first yields the total checkins count
-    before_timestamp = None
+    # Paging stops as soon as a checkin with an ID in stop_ids is seen
+    # before_timestamp can be used to start paging from an earlier cursor
+    # response_cache is an optional ResponseCache for historical pages
+    # If prefetch is set, up to that many pages are fetched in a background
+    # thread while the caller processes the current page
+    if since_delta:
+        after_timestamp = max(after_timestamp or 0, int(time.time() - since_delta))
+    pages = fetch_checkin_pages(
+        token,
+        after_timestamp=after_timestamp,
+        url=url,
+        client=client,
+        before_timestamp=before_timestamp,
+        response_cache=response_cache,
+    )
+    if prefetch:
+        pages = prefetched(pages, prefetch)
+    stop_ids = stop_ids or set()
+    first = True
+    try:
+        for data in pages:
+            if first:
+                first = False
+                if count_first:
+                    yield data["response"]["checkins"]["count"]
+            items = data.get("response", {}).get("checkins", {}).get("items") or []
+            for item in items:
+                if item["id"] in stop_ids:
+                    return
+                yield item
+    finally:
+        pages.close()
+
+
+# Dropped connections, timeouts and responses cut off part way through
+RETRIED_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class FoursquareClient:
+    # Wraps a requests.Session so connections are kept alive between pages,
+    # retrying 429 and 5xx responses and RETRIED_ERRORS with exponential backoff
+    def __init__(
+        self, max_retries=5, backoff=1.0, timeout=30, session=None, sleep=time.sleep
+    ):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self.sleep = sleep
+        self.request_count = 0
+        self.retry_count = 0
+        self.bytes_transferred = 0
+
+    def get(self, url, params):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except RETRIED_ERRORS:
+                self.request_count += 1
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            else:
+                self.request_count += 1
+                self.bytes_transferred += int(
+                    response.headers.get("content-length") or len(response.content)
+                )
+            if response is not None and not (
+                response.status_code == 429 or response.status_code >= 500
+            ):
+                self.wait_for_rate_limit(response)
+                return response.json()
+            if attempt >= self.max_retries:
+                response.raise_for_status()
+            delay = self.backoff * 2**attempt
+            if response is not None and response.headers.get("retry-after"):
+                try:
+                    delay = max(delay, float(response.headers["retry-after"]))
+                except ValueError:
+                    pass
+            self.retry_count += 1
+            attempt += 1
+            self.sleep(delay)
+
+    def wait_for_rate_limit(self, response):
+        # If we have used up our requests, wait until the limit resets
+        remaining = response.headers.get("x-ratelimit-remaining")
+        reset = response.headers.get("x-ratelimit-reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            if int(remaining) > 0:
+                return
+            delay = int(reset) - time.time()
+        except ValueError:
+            return
+        if delay > 0:
+            self.sleep(delay)
+
+
+# Eviction leaves the response cache at this fraction of max_bytes
+RESPONSE_CACHE_EVICT_TO = 0.9
+
+
+class ResponseCache:
+    # Stores decoded API responses as gzipped JSON files in a directory, keyed
+    # on the URL and request parameters other than the token
+    # Entries older than ttl seconds are ignored, and the least recently used
+    # entries are deleted once the directory grows beyond max_bytes
+    # namespace keeps the entries for different accounts apart
+    # Several threads or processes can share a directory, so any file can
+    # disappear at any time - that is treated as a cache miss
+    def __init__(self, directory, ttl=None, max_bytes=None, namespace=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        # Running total of the directory size, so it is only scanned when
+        # the total goes over max_bytes. Other writers are only counted when
+        # it is scanned again
+        self.size = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url, params):
+        key = json.dumps(
+            [
+                self.namespace,
+                url,
+                {k: v for k, v in params.items() if k != "oauth_token"},
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return os.path.join(
+            self.directory, hashlib.sha1(key.encode("utf8")).hexdigest() + ".json.gz"
+        )
+
+    def get(self, url, params):
+        path = self.path(url, params)
+        try:
+            with gzip.open(path, "rt", encoding="utf8") as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.time() - entry["fetched"] > self.ttl:
+            remove_if_exists(path)
+            self.misses += 1
+            return None
+        # Reading an entry marks it as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return entry["data"]
+
+    def set(self, url, params, data):
+        path = self.path(url, params)
+        # Written to a temporary file of its own first, so readers never see
+        # part of an entry and concurrent writers do not collide
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                with gzip.open(raw, "wt", encoding="utf8") as fp:
+                    json.dump({"fetched": time.time(), "data": data}, fp)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            remove_if_exists(temp_path)
+            raise
+        if self.max_bytes is not None:
+            with self.lock:
+                if self.size is None:
+                    self.size = self.directory_size()
+                else:
+                    self.size += size
+                if self.size > self.max_bytes:
+                    self.evict()
+
+    def entries(self):
+        # Returns (mtime, size, path) for each entry in the directory
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json.gz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def directory_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # Deletes the least recently used entries until the directory is back
+        # under max_bytes, with room to spare so that the next few pages do
+        # not each need another scan, and records the size that is left
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * RESPONSE_CACHE_EVICT_TO
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            remove_if_exists(path)
+            total -= size
+        self.size = total
+
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def fetch_checkin_pages(
+    token,
+    after_timestamp=None,
+    url=CHECKINS_URL,
+    client=None,
+    before_timestamp=None,
+    response_cache=None,
+):
+    # Generator yielding decoded API responses, one per page, newest first -
+    # the final yielded page is the first one that has no items
+    client = client or FoursquareClient()
+    while True:
+        data = fetch_checkin_page(
+            token, after_timestamp, before_timestamp, url, client, response_cache
+        )
+        items = data.get("response", {}).get("checkins", {}).get("items")
+        yield data
+        if not items:
+            break
+        before_timestamp = items[-1]["createdAt"]
+
+
+def fetch_checkin_page(
+    token, after_timestamp, before_timestamp, url, client, response_cache=None
+):
+    # Fetches the page of checkins newer than after_timestamp and older than
+    # before_timestamp, either of which can be None
+    # If a ResponseCache is provided it is used for pages with a
+    # beforeTimestamp, which only change if older checkins are edited - the
+    # first page is always fetched, as new checkins appear on it
     params = {
         "oauth_token": token,
         "v": "20190101",
         "sort": "newestfirst",
-        "limit": "250",
+        "limit": str(PAGE_SIZE),
     }
-    if since_delta:
-        params["afterTimestamp"] = int(time.time() - since_delta)
-    first = True
-    while True:
-        if before_timestamp is not None:
-            params["beforeTimestamp"] = before_timestamp
-        url = "https://api.foursquare.com/v2/users/self/checkins"
-        data = requests.get(url, params).json()
-        if first:
-            first = False
-            if count_first:
-                yield data["response"]["checkins"]["count"]
-        if not data.get("response", {}).get("checkins", {}).get("items"):
-            break
-        for item in data["response"]["checkins"]["items"]:
+    if after_timestamp:
+        params["afterTimestamp"] = after_timestamp
+    if before_timestamp is not None:
+        params["beforeTimestamp"] = before_timestamp
+    if response_cache is not None and before_timestamp is not None:
+        data = response_cache.get(url, params)
+        if data is None:
+            data = client.get(url, dict(params))
+            # Error responses such as an expired token are not cached, or
+            # later imports would stop at this page until the entry expired
+            if "checkins" in (data.get("response") or {}):
+                response_cache.set(url, params, data)
+        return data
+    return client.get(url, dict(params))
+
+
+def fetch_checkins_in_windows(
+    token,
+    workers=4,
+    count_first=False,
+    after_timestamp=None,
+    url=CHECKINS_URL,
+    clients=None,
+    response_cache=None,
+):
+    # Generator like fetch_all_checkins(), for backfilling long histories
+    # If the first page is full, the rest of the timeline is split into
+    # workers windows by afterTimestamp and beforeTimestamp, which are paged
+    # through concurrently by a pool of threads. When workers become idle
+    # the next window to fill a page is split again, so the work stays spread
+    # across the threads however the checkins are distributed over time
+    # Checkins are yielded as their pages arrive, so not in order, and each
+    # one only once even if the API includes it in two windows
+    # clients is a list of FoursquareClient, one for each worker
+    clients = clients or [FoursquareClient() for _ in range(workers)]
+    available = queue.Queue()
+    for client in clients:
+        available.put(client)
+
+    def fetch(window):
+        client = available.get()
+        try:
+            data = fetch_checkin_page(
+                token, window[0], window[1], url, client, response_cache
+            )
+        finally:
+            available.put(client)
+        return data.get("response", {}).get("checkins", {}).get("items") or []
+
+    def next_windows(window, items, idle):
+        # The checkins in this window that are older than this page - always
+        # a narrower window, even if the API were to include its bounds. It
+        # is only split if there are idle workers, as every window costs a
+        # final request that returns no checkins
+        after, before = window[0], min(items[-1]["createdAt"], window[1] - 1)
+        if len(items) < PAGE_SIZE or not idle:
+            return [(after, before)]
+        return split_window(after, before, idle + 1)
+
+    seen = set()
+    data = fetch_checkin_page(
+        token, after_timestamp, None, url, clients[0], response_cache
+    )
+    if count_first:
+        yield data["response"]["checkins"]["count"]
+    items = data.get("response", {}).get("checkins", {}).get("items") or []
+    for item in items:
+        seen.add(item["id"])
+        yield item
+    if not items:
+        return
+    windows = split_window(after_timestamp, items[-1]["createdAt"], workers)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(fetch, window): window for window in windows}
+        try:
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    window = pending.pop(future)
+                    items = future.result()
+                    for item in items:
+                        if item["id"] not in seen:
+                            seen.add(item["id"])
+                            yield item
+                    if items:
+                        idle = max(0, workers - len(pending) - 1)
+                        for next_window in next_windows(window, items, idle):
+                            pending[executor.submit(fetch, next_window)] = next_window
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def split_window(after, before, count):
+    # Splits the timestamps between after and before, both exclusive, into up
+    # to count (after, before) windows - after can be None for no lower bound
+    lower = max(after or 0, FIRST_CHECKIN_TIMESTAMP)
+    seconds = before - lower - 1
+    count = max(1, min(count, seconds))
+    bounds = [lower + 1 + seconds * i // count for i in range(1, count)]
+    # A bound of b puts checkins at b in the newer window, as beforeTimestamp
+    # and afterTimestamp are exclusive
+    afters = [after] + [bound - 1 for bound in bounds]
+    befores = bounds + [before]
+    return list(zip(afters, befores))[::-1]
+
+
+def concurrently(function, *iterables):
+    # Like map(), but with each call made in its own thread, returning a list
+    # of the results - the first exception is re-raised
+    calls = list(zip(*iterables))
+    if len(calls) <= 1:
+        return [function(*call) for call in calls]
+    with concurrent.futures.ThreadPoolExecutor(len(calls)) as executor:
+        return list(executor.map(function, *zip(*calls)))
+
+
+def prefetched(iterable, size):
+    # Generator that consumes iterable in a background thread, buffering up
+    # to size items in a queue - exceptions are re-raised in the consumer
+    return interleaved([iterable], size)
+
+
+def interleaved(iterables, size):
+    # Generator that consumes each iterable in its own background thread,
+    # yielding items from all of them in the order they arrive, buffering up
+    # to size items - exceptions are re-raised in the consumer
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(iterable):
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    for iterable in iterables:
+        threading.Thread(target=produce, args=(iterable,), daemon=True).start()
+    remaining = len(iterables)
+    try:
+        while remaining:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                remaining -= 1
+                continue
             yield item
-        before_timestamp = item["createdAt"]
+    finally:
+        stopped.set()
@@ -0,0 +1,197 @@
+import click
+import json
+import math
+import sqlite_utils
+
+
+# Mean radius of the Earth in meters
+EARTH_RADIUS = 6371008.8
+SPATIAL_INDEX_TRIGGERS = {
+    # Runs before the venue is written, so a venue replaced by an upsert no
+    # longer has an entry under its old rowid
+    "venues_rtree_before_insert": """
+create trigger [venues_rtree_before_insert] before insert on [venues] begin
+    delete from [venues_rtree] where id = (
+        select rowid from [venues] where id = new.id
+    );
+end""",
+    "venues_rtree_insert": """
+create trigger [venues_rtree_insert] after insert on [venues]
+when new.latitude is not null and new.longitude is not null begin
+    insert or replace into [venues_rtree] values (
+        new.rowid, new.latitude, new.latitude, new.longitude, new.longitude
+    );
+end""",
+    "venues_rtree_update": """
+create trigger [venues_rtree_update] after update on [venues] begin
+    delete from [venues_rtree] where id = old.rowid;
+    insert into [venues_rtree] select
+        new.rowid, new.latitude, new.latitude, new.longitude, new.longitude
+    where new.latitude is not null and new.longitude is not null;
+end""",
+    "venues_rtree_delete": """
+create trigger [venues_rtree_delete] after delete on [venues] begin
+    delete from [venues_rtree] where id = old.rowid;
+end""",
+}
+
+
+def has_spatial_index(db):
+    return db["venues_rtree"].exists()
+
+
+def enable_spatial_index(db):
+    # Creates an R*Tree over venue locations, keyed on the venues rowid, and
+    # triggers that keep it up to date as venues are saved
+    with db.conn:
+        db.execute(
+            "create virtual table if not exists [venues_rtree] using rtree("
+            "id, min_latitude, max_latitude, min_longitude, max_longitude)"
+        )
+        existing = set(
+            row[0]
+            for row in db.execute(
+                "select name from sqlite_master where type = 'trigger'"
+            ).fetchall()
+        )
+        for name, sql in SPATIAL_INDEX_TRIGGERS.items():
+            if name not in existing:
+                db.execute(sql)
+        db.execute("delete from [venues_rtree]")
+        db.execute(
+            """
+            insert into [venues_rtree]
+            select rowid, latitude, latitude, longitude, longitude from [venues]
+            where latitude is not null and longitude is not null
+            """
+        )
+
+
+def venues_in_bbox(db, min_latitude, min_longitude, max_latitude, max_longitude):
+    # Venues within a bounding box, using the spatial index - if min_longitude
+    # is greater than max_longitude the box crosses the antimeridian
+    if min_longitude <= max_longitude:
+        boxes = [(min_longitude, max_longitude)]
+    else:
+        boxes = [(min_longitude, 180), (-180, max_longitude)]
+    for min_lng, max_lng in boxes:
+        # The R*Tree stores 32 bit floats, so matches are checked against the
+        # venues table for exact results
+        yield from db.query(
+            """
+            select venues.* from [venues_rtree]
+            join [venues] on [venues].rowid = [venues_rtree].id
+            where max_latitude >= :min_lat and min_latitude <= :max_lat
+            and max_longitude >= :min_lng and min_longitude <= :max_lng
+            and venues.latitude between :min_lat and :max_lat
+            and venues.longitude between :min_lng and :max_lng
+            """,
+            {
+                "min_lat": min_latitude,
+                "max_lat": max_latitude,
+                "min_lng": min_lng,
+                "max_lng": max_lng,
+            },
+        )
+
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+    # Great circle distance in meters, using the haversine formula
+    lat1, lng1, lat2, lng2 = map(
+        math.radians, (latitude1, longitude1, latitude2, longitude2)
+    )
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def bbox_around(latitude, longitude, radius):
+    # A bounding box containing every point within radius meters
+    delta_lat = math.degrees(radius / EARTH_RADIUS)
+    min_lat = max(-90, latitude - delta_lat)
+    max_lat = min(90, latitude + delta_lat)
+    widest = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if max_lat == 90 or min_lat == -90 or delta_lat / widest >= 180:
+        return min_lat, -180, max_lat, 180
+    delta_lng = math.degrees(radius / (EARTH_RADIUS * widest))
+    min_lng = (longitude - delta_lng + 180) % 360 - 180
+    max_lng = (longitude + delta_lng + 180) % 360 - 180
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def nearest_venues(db, latitude, longitude, limit=10, radius=1000):
+    # Returns up to limit venues closest to a point, each with a distance in
+    # meters. The search box starts at radius meters and doubles until it
+    # contains enough venues, then the closest are checked against a circle
+    # that the box is sure to cover
+    total = db["venues_rtree"].count
+    while True:
+        venues = list(venues_in_bbox(db, *bbox_around(latitude, longitude, radius)))
+        if len(venues) >= min(limit, total) or radius > math.pi * EARTH_RADIUS:
+            break
+        radius *= 2
+    for venue in venues:
+        venue["distance"] = distance(
+            latitude, longitude, venue["latitude"], venue["longitude"]
+        )
+    venues.sort(key=lambda venue: venue["distance"])
+    # Venues in the corners of the box may be further away than venues just
+    # outside it, so look again within the distance of the furthest match
+    if venues and venues[:limit][-1]["distance"] > radius:
+        return nearest_venues(
+            db, latitude, longitude, limit, venues[:limit][-1]["distance"]
+        )
+    return [venue for venue in venues if venue["distance"] <= radius][:limit]
+
+
+def open_database(db_path):
+    db = sqlite_utils.Database(db_path)
+    if not db["venues"].exists():
+        raise click.ClickException("No venues table in {}".format(db_path))
+    if not has_spatial_index(db):
+        enable_spatial_index(db)
+    return db
+
+
+@click.group()
+def cli():
+    "Query venues using the spatial index"
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, exists=True),
+)
+@click.option("--latitude", type=float, required=True)
+@click.option("--longitude", type=float, required=True)
+@click.option("--limit", default=10, show_default=True, help="Venues to return")
+def nearest(db_path, latitude, longitude, limit):
+    "Output the venues closest to a point as JSON"
+    db = open_database(db_path)
+    venues = nearest_venues(db, latitude, longitude, limit)
+    click.echo(json.dumps(venues, indent=2))
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, exists=True),
+)
+@click.option(
+    "--bbox",
+    type=float,
+    nargs=4,
+    required=True,
+    help="Minimum latitude, minimum longitude, maximum latitude, maximum longitude",
+)
+def bbox(db_path, bbox):
+    "Output the venues within a bounding box as JSON"
+    db = open_database(db_path)
+    click.echo(json.dumps(list(venues_in_bbox(db, *bbox)), indent=2))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,181 @@
+from swarm_to_sqlite import aio, partitions, utils
+from swarm_to_sqlite.synthetic import generate_checkins
+import asyncio
+import json
+import pytest
+import requests
+import sqlite_utils
+import time
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.status_code = 200
+        self.headers = {}
+        self.content = json.dumps(data).encode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+@pytest.fixture
+def slow_api(monkeypatch):
+    # Serves pages of ten synthetic checkins per token, taking 50ms per page
+    accounts = {
+        "token-a": list(generate_checkins(25, seed=1)),
+        "token-b": list(generate_checkins(25, seed=2)),
+    }
+
+    def fake_get(self, url, params, **kwargs):
+        time.sleep(0.05)
+        checkins = accounts[params["oauth_token"]]
+        items = [
+            c
+            for c in checkins
+            if c["createdAt"] < params.get("beforeTimestamp", float("inf"))
+        ]
+        return FakeResponse(
+            {"response": {"checkins": {"count": len(checkins), "items": items[:10]}}}
+        )
+
+    monkeypatch.setattr(requests.Session, "get", fake_get)
+    return accounts
+
+
+def test_fetch_all_checkins(slow_api):
+    async def fetch():
+        return [
+            checkin
+            async for checkin in aio.fetch_all_checkins("token-a", count_first=True)
+        ]
+
+    fetched = asyncio.run(fetch())
+    assert 25 == fetched[0]
+    assert [c["id"] for c in slow_api["token-a"]] == [c["id"] for c in fetched[1:]]
+
+
+def test_fetch_all_checkins_stop_ids(slow_api):
+    stop_id = slow_api["token-a"][12]["id"]
+
+    async def fetch():
+        return [
+            checkin["id"]
+            async for checkin in aio.fetch_all_checkins("token-a", stop_ids={stop_id})
+        ]
+
+    assert [c["id"] for c in slow_api["token-a"][:12]] == asyncio.run(fetch())
+
+
+def test_concurrent_imports_do_not_block_event_loop(slow_api, tmpdir):
+    ticks = []
+
+    async def heartbeat():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.005)
+
+    async def main():
+        beating = asyncio.ensure_future(heartbeat())
+        counts = await asyncio.gather(
+            *(
+                aio.import_checkins(
+                    str(tmpdir / "{}.db".format(token)),
+                    aio.fetch_all_checkins(token),
+                    batch_size=7,
+                    commit_every=10,
+                )
+                for token in ("token-a", "token-b")
+            )
+        )
+        beating.cancel()
+        return counts
+
+    assert [25, 25] == asyncio.run(main())
+    # Each import made 4 requests taking 50ms, which did not stop the loop
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.04
+    for token in ("token-a", "token-b"):
+        db = sqlite_utils.Database(str(tmpdir / "{}.db".format(token)))
+        assert {c["id"] for c in slow_api[token]} == {
+            row["id"] for row in db["checkins"].rows
+        }
+        assert {"checkin_details", "venue_details"} == set(db.view_names())
+
+
+def test_import_checkins_matches_save_checkins(tmpdir):
+    checkins = list(generate_checkins(50, seed=3))
+    expected = sqlite_utils.Database(str(tmpdir / "expected.db"))
+    utils.create_tables(expected)
+    utils.save_checkins(json.loads(json.dumps(checkins)), expected)
+    aio_path = str(tmpdir / "aio.db")
+    assert 50 == asyncio.run(aio.import_checkins(aio_path, checkins, batch_size=8))
+    db = sqlite_utils.Database(aio_path)
+    for table in expected.table_names():
+        sql = "select * from [{}] order by rowid".format(table)
+        assert expected.execute(sql).fetchall() == db.execute(sql).fetchall()
+
+
+def test_import_checkins_reads_blocking_iterable_in_thread(tmpdir):
+    ticks = []
+    reads = []
+
+    def checkins():
+        # A regular generator that blocks, like a file or API reader
+        for checkin in generate_checkins(10, seed=5):
+            time.sleep(0.05)
+            reads.append(time.perf_counter())
+            yield checkin
+
+    async def heartbeat():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.005)
+
+    async def main():
+        beating = asyncio.ensure_future(heartbeat())
+        count = await aio.import_checkins(str(tmpdir / "swarm.db"), checkins())
+        beating.cancel()
+        return count
+
+    assert 10 == asyncio.run(main())
+    # The loop kept running while the checkins were read
+    during = [tick for tick in ticks if tick < reads[-1]]
+    assert len(during) > 10
+    assert max(b - a for a, b in zip(during, during[1:])) < 0.04
+
+
+def test_import_checkins_saves_checkins_before_fetch_error(tmpdir):
+    async def checkins():
+        for checkin in generate_checkins(20, seed=4):
+            yield checkin
+        raise requests.ConnectionError("Connection lost")
+
+    db_path = str(tmpdir / "swarm.db")
+    with pytest.raises(requests.ConnectionError):
+        asyncio.run(aio.import_checkins(db_path, checkins(), batch_size=5))
+    assert 20 == sqlite_utils.Database(db_path)["checkins"].count
+
+
+def test_import_checkins_writer_error(tmpdir):
+    async def checkins():
+        for i in range(1000):
+            yield {"id": "bad"}
+
+    with pytest.raises(KeyError):
+        asyncio.run(
+            aio.import_checkins(
+                str(tmpdir / "swarm.db"), checkins(), batch_size=1, queue_size=1
+            )
+        )
+
+
+def test_import_checkins_partitioned(tmpdir):
+    db_path = str(tmpdir / "swarm.db")
+    db = sqlite_utils.Database(db_path)
+    partitions.enable_partitions(db, "year")
+    checkins = list(generate_checkins(30, seed=5))
+    assert 30 == asyncio.run(aio.import_checkins(db_path, checkins, batch_size=8))
+    names = {partitions.partition_name(c["createdAt"], "year") for c in checkins}
+    assert names == {row["name"] for row in db["partitions"].rows}
+    assert not db["checkins"].exists()
+    partitions.attach_partitions(db)
+    assert 30 == db.execute("select count(*) from checkins").fetchone()[0]
@@ -0,0 +1,30 @@
+from swarm_to_sqlite import benchmark, synthetic, utils
+import json
+import sqlite_utils
+
+
+def test_generate_checkins():
+    checkins = list(synthetic.generate_checkins(50, venue_reuse=0.5, photos=2, seed=1))
+    assert 50 == len(checkins)
+    assert checkins == list(
+        synthetic.generate_checkins(50, venue_reuse=0.5, photos=2, seed=1)
+    )
+    created = [checkin["createdAt"] for checkin in checkins]
+    assert sorted(created, reverse=True) == created
+    db = sqlite_utils.Database(memory=True)
+    utils.save_checkins(checkins, db)
+    assert 50 == db["checkins"].count
+    assert 100 == db["photos"].count
+    assert 10 < db["venues"].count < 50
+
+
+def test_run_benchmarks():
+    results = benchmark.run_benchmarks(
+        ["save_checkins", "views"], isolate=False, count=20
+    )
+    json.dumps(results)
+    assert {"count": 20} == results["options"]
+    assert ["save_checkins", "views"] == [r["name"] for r in results["results"]]
+    for result in results["results"]:
+        assert result["seconds"] > 0
+        assert result["db_size_bytes"] > 0
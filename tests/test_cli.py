@@ -0,0 +1,526 @@
+from click.testing import CliRunner
+from swarm_to_sqlite.cli import cli
+import json
+import pathlib
+import pytest
+import requests
+import sqlite_utils
+import threading
+from sqlite_utils.db import ForeignKey
+
+
+def load_checkins():
+    json_path = pathlib.Path(__file__).parent / "checkin.json"
+    checkin = json.load(open(json_path, "r"))
+    return [
+        dict(checkin, id="checkin{}".format(i), createdAt=checkin["createdAt"] + i)
+        for i in range(3)
+    ]
+
+
+def test_load(tmpdir):
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.json")
+    with open(load_path, "w") as fp:
+        json.dump(load_checkins(), fp)
+    result = CliRunner().invoke(
+        cli, [db_path, "--load", load_path, "--batch-size", "2", "--silent"]
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert 3 == db["checkins"].count
+    assert {"checkin_details", "venue_details"} == set(db.view_names())
+    assert not db["checkins_fts"].exists()
+    # Views are not materialized by later imports unless asked to
+    result = CliRunner().invoke(cli, [db_path, "--load", load_path, "--silent"])
+    assert 0 == result.exit_code, result.output
+    assert {"checkin_details", "venue_details"} == set(db.view_names())
+    # A second import with --search-index indexes the existing rows
+    result = CliRunner().invoke(
+        cli, [db_path, "--load", load_path, "--search-index", "--silent"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert 3 == len(list(db["checkins"].search("anniversary")))
+
+
+def test_load_bulk_commit_every_processes(tmpdir):
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.json")
+    with open(load_path, "w") as fp:
+        json.dump(load_checkins(), fp)
+    result = CliRunner().invoke(
+        cli,
+        [db_path, "--load", load_path, "--bulk", "--commit-every", "2"]
+        + ["--processes", "2", "--silent"],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert 3 == db["checkins"].count
+    # Journal mode is restored once the import has finished
+    assert "delete" == db.execute("pragma journal_mode").fetchone()[0]
+
+
+def test_spatial_index_and_venues_commands(tmpdir):
+    from swarm_to_sqlite import venues
+
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.json")
+    with open(load_path, "w") as fp:
+        json.dump(load_checkins(), fp)
+    result = CliRunner().invoke(
+        cli, [db_path, "--load", load_path, "--spatial-index", "--silent"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert sqlite_utils.Database(db_path)["venues_rtree"].exists()
+    result = CliRunner().invoke(
+        venues.cli,
+        ["nearest", db_path, "--latitude", "37.7", "--longitude", "-122.4"],
+    )
+    assert 0 == result.exit_code, result.output
+    nearest = json.loads(result.output)
+    assert ["Restaurant Name"] == [venue["name"] for venue in nearest]
+    assert nearest[0]["distance"] > 0
+    result = CliRunner().invoke(
+        venues.cli, ["bbox", db_path, "--bbox", "0", "-180", "1", "180"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert [] == json.loads(result.output)
+
+
+def test_rollups_and_rebuild_command(tmpdir):
+    from swarm_to_sqlite import rollups
+
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.json")
+    with open(load_path, "w") as fp:
+        json.dump(load_checkins(), fp)
+    db = sqlite_utils.Database(db_path)
+    # Rollups are kept up to date by later imports, which replace the checkins
+    for args in (["--rollups"], []):
+        result = CliRunner().invoke(cli, [db_path, "--load", load_path] + args)
+        assert 0 == result.exit_code, result.output
+        assert [{"day": "2017-05-28", "checkins": 3}] == list(db["rollup_days"].rows)
+        assert [{"cc": "US", "city": "City", "checkins": 3}] == list(
+            db["rollup_cities"].rows
+        )
+    db.execute("delete from rollup_days")
+    result = CliRunner().invoke(rollups.cli, ["rebuild", db_path])
+    assert 0 == result.exit_code, result.output
+    assert "rollup_days: 1 rows" in result.output
+    assert [("2017-05-28", 3)] == db.execute("select * from rollup_days").fetchall()
+
+
+def test_load_ndjson_processes(tmpdir):
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.ndjson")
+    with open(load_path, "w") as fp:
+        fp.write("\n".join(json.dumps(checkin) for checkin in load_checkins()))
+    result = CliRunner().invoke(
+        cli, [db_path, "--load", load_path, "--processes", "2", "--silent"]
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert ["checkin0", "checkin1", "checkin2"] == [
+        row["id"] for row in db["checkins"].rows_where(order_by="id")
+    ]
+
+
+def test_load_materialize(tmpdir):
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.json")
+    with open(load_path, "w") as fp:
+        json.dump(load_checkins(), fp)
+    for args in (["--materialize"], []):
+        result = CliRunner().invoke(cli, [db_path, "--load", load_path] + args)
+        assert 0 == result.exit_code, result.output
+        db = sqlite_utils.Database(db_path)
+        assert [] == db.view_names()
+        assert 3 == db["checkin_details"].count
+
+
+def test_materialize_refreshes_checkins_at_changed_venues(tmpdir):
+    db_path = str(tmpdir / "swarm.db")
+    first, second, _ = load_checkins()
+    second["venue"] = dict(second["venue"], name="Renamed")
+    for checkins, args in (([first], ["--materialize"]), ([second], [])):
+        load_path = str(tmpdir / "checkins.json")
+        with open(load_path, "w") as fp:
+            json.dump(checkins, fp)
+        result = CliRunner().invoke(cli, [db_path, "--load", load_path] + args)
+        assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert [("checkin0", "Renamed"), ("checkin1", "Renamed")] == db.execute(
+        "select id, venue_name from checkin_details order by id"
+    ).fetchall()
+
+
+def test_load_newline_delimited_and_save(tmpdir):
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.jsonl")
+    save_path = str(tmpdir / "saved.json")
+    checkins = load_checkins()
+    with open(load_path, "w") as fp:
+        for checkin in checkins:
+            fp.write(json.dumps(checkin) + "\n")
+    result = CliRunner().invoke(
+        cli, [db_path, "--load", load_path, "--save", save_path]
+    )
+    assert 0 == result.exit_code, result.output
+    assert "Importing checkins" in result.output
+    assert 3 == sqlite_utils.Database(db_path)["checkins"].count
+    # Saved checkins should be unmodified
+    assert checkins == json.load(open(save_path))
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data):
+        self.content = json.dumps(data).encode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def test_multiple_accounts(tmpdir, monkeypatch):
+    accounts = {
+        "token-a": ("1", load_checkins()),
+        "token-b": (
+            "2",
+            [dict(checkin, id=checkin["id"] + "b") for checkin in load_checkins()],
+        ),
+    }
+
+    def fake_get(self, url, params, **kwargs):
+        user_id, checkins = accounts[params["oauth_token"]]
+        if url.endswith("/users/self"):
+            return FakeResponse(
+                {"response": {"user": {"id": user_id, "firstName": "User " + user_id}}}
+            )
+        items = sorted(checkins, key=lambda c: c["createdAt"], reverse=True)
+        items = [
+            c
+            for c in items
+            if c["createdAt"] < params.get("beforeTimestamp", float("inf"))
+        ]
+        return FakeResponse(
+            {"response": {"checkins": {"count": len(checkins), "items": items[:2]}}}
+        )
+
+    monkeypatch.setattr(requests.Session, "get", fake_get)
+    db_path = str(tmpdir / "swarm.db")
+    tokens_path = str(tmpdir / "tokens.txt")
+    with open(tokens_path, "w") as fp:
+        fp.write("token-b\n")
+    result = CliRunner().invoke(
+        cli, [db_path, "--token", "token-a", "--tokens-file", tokens_path]
+    )
+    assert 0 == result.exit_code, result.output
+    assert "Importing 6 checkins" in result.output
+    db = sqlite_utils.Database(db_path)
+    assert [("1", 3), ("2", 3)] == db.execute(
+        "select account, count(*) from checkins group by account order by account"
+    ).fetchall()
+    assert ["User 1", "User 2"] == [
+        row[0]
+        for row in db.execute(
+            "select firstName from users where id in ('1', '2') order by id"
+        )
+    ]
+    assert (
+        ForeignKey(
+            table="checkins", column="account", other_table="users", other_column="id"
+        )
+        in db["checkins"].foreign_keys
+    )
+
+
+def test_multiple_accounts_fetched_concurrently(tmpdir, monkeypatch):
+    # Every account lookup and first page waits for the other two accounts'
+    # requests, so this only finishes if they are made at the same time
+    tokens = ["token-a", "token-b", "token-c"]
+    lookups = threading.Barrier(len(tokens), timeout=5)
+    first_pages = threading.Barrier(len(tokens), timeout=5)
+
+    def fake_get(self, url, params, **kwargs):
+        token = params["oauth_token"]
+        if url.endswith("/users/self"):
+            lookups.wait()
+            return FakeResponse({"response": {"user": {"id": token}}})
+        items = []
+        if "beforeTimestamp" not in params:
+            first_pages.wait()
+            items = [dict(load_checkins()[0], id=token)]
+        return FakeResponse(
+            {"response": {"checkins": {"count": len(items), "items": items}}}
+        )
+
+    monkeypatch.setattr(requests.Session, "get", fake_get)
+    db_path = str(tmpdir / "swarm.db")
+    args = [db_path, "--silent"]
+    for token in tokens:
+        args.extend(["--token", token])
+    result = CliRunner().invoke(cli, args)
+    assert 0 == result.exit_code, result.output
+    assert tokens == [
+        row[0]
+        for row in sqlite_utils.Database(db_path).execute(
+            "select account from checkins order by account"
+        )
+    ]
+
+
+def test_resume(tmpdir, monkeypatch):
+    checkins = sorted(load_checkins(), key=lambda c: c["createdAt"], reverse=True)
+    requested = []
+    fail = {"on": True}
+
+    def fake_get(self, url, params, **kwargs):
+        before = params.get("beforeTimestamp")
+        requested.append(before)
+        if before is not None and fail["on"]:
+            raise ValueError("Connection lost")
+        items = [c for c in checkins if c["createdAt"] < (before or float("inf"))]
+        return FakeResponse(
+            {"response": {"checkins": {"count": len(checkins), "items": items[:1]}}}
+        )
+
+    monkeypatch.setattr(requests.Session, "get", fake_get)
+    db_path = str(tmpdir / "swarm.db")
+    args = [db_path, "--token", "token", "--commit-every", "1", "--silent"]
+    result = CliRunner().invoke(cli, args)
+    assert 0 != result.exit_code
+    db = sqlite_utils.Database(db_path)
+    state = db["import_state"].get("self")
+    assert 1 == state["checkins_saved"]
+    assert checkins[0]["createdAt"] == state["before_timestamp"]
+    assert 0 == state["complete"]
+    # Resuming continues from the oldest saved checkin
+    fail["on"] = False
+    requested.clear()
+    result = CliRunner().invoke(cli, args + ["--resume"])
+    assert 0 == result.exit_code, result.output
+    assert checkins[0]["createdAt"] in requested
+    assert {c["id"] for c in checkins} == {r["id"] for r in db["checkins"].rows}
+    state = db["import_state"].get("self")
+    assert 1 == state["complete"]
+    assert 3 == state["checkins_saved"]
+
+
+@pytest.mark.parametrize("extra", [["--resume"], ["--incremental"]])
+def test_incremental_after_interrupted_import(tmpdir, monkeypatch, extra):
+    # --incremental finishes an interrupted import instead of starting from
+    # the newest saved checkin and skipping the older history
+    checkins = sorted(load_checkins(), key=lambda c: c["createdAt"], reverse=True)
+    fail = {"on": True}
+
+    def fake_get(self, url, params, **kwargs):
+        before = params.get("beforeTimestamp")
+        if before is not None and fail["on"]:
+            raise ValueError("Connection lost")
+        after = params.get("afterTimestamp", 0)
+        items = [
+            c for c in checkins if after < c["createdAt"] < (before or float("inf"))
+        ]
+        return FakeResponse(
+            {"response": {"checkins": {"count": len(checkins), "items": items[:1]}}}
+        )
+
+    monkeypatch.setattr(requests.Session, "get", fake_get)
+    db_path = str(tmpdir / "swarm.db")
+    args = [db_path, "--token", "token", "--commit-every", "1"]
+    assert 0 != CliRunner().invoke(cli, args + ["--silent"]).exit_code
+    fail["on"] = False
+    # --parallel cannot resume, so it asks for --resume first
+    result = CliRunner().invoke(cli, args + ["--incremental", "--parallel", "2"])
+    assert 0 != result.exit_code
+    assert "use --resume to finish it" in result.output
+    result = CliRunner().invoke(cli, args + extra)
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert {c["id"] for c in checkins} == {r["id"] for r in db["checkins"].rows}
+    assert 1 == db["import_state"].get("self")["complete"]
+    assert ("Resuming an interrupted import" in result.output) == (
+        extra == ["--incremental"]
+    )
+
+
+def test_parallel(tmpdir, monkeypatch):
+    checkins = sorted(load_checkins(), key=lambda c: c["createdAt"], reverse=True)
+
+    def fake_get(self, url, params, **kwargs):
+        before = params.get("beforeTimestamp", float("inf"))
+        after = params.get("afterTimestamp", 0)
+        items = [c for c in checkins if after < c["createdAt"] < before]
+        return FakeResponse(
+            {"response": {"checkins": {"count": len(checkins), "items": items[:1]}}}
+        )
+
+    monkeypatch.setattr(requests.Session, "get", fake_get)
+    db_path = str(tmpdir / "swarm.db")
+    result = CliRunner().invoke(cli, [db_path, "--token", "token", "--parallel", "3"])
+    assert 0 == result.exit_code, result.output
+    assert "Importing 3 checkins" in result.output
+    db = sqlite_utils.Database(db_path)
+    assert {c["id"] for c in checkins} == {r["id"] for r in db["checkins"].rows}
+    # Windows are fetched out of order, so they cannot be resumed
+    assert not db["import_state"].exists()
+    result = CliRunner().invoke(
+        cli, [db_path, "--token", "token", "--parallel", "3", "--resume"]
+    )
+    assert 0 != result.exit_code
+    assert "--resume cannot be used with --parallel" in result.output
+
+
+def test_partition(tmpdir, monkeypatch):
+    from swarm_to_sqlite import partitions, utils
+
+    # One checkin in each of 2017, 2018 and 2019, with photos taken then
+    checkins = []
+    for i, checkin in enumerate(load_checkins()):
+        created_at = checkin["createdAt"] + i * 365 * 24 * 60 * 60
+        photos = [
+            dict(photo, id="{}-{}".format(checkin["id"], photo["id"]))
+            for photo in checkin["photos"]["items"]
+        ]
+        for photo in photos:
+            photo["createdAt"] = created_at
+        checkins.append(
+            dict(
+                checkin,
+                createdAt=created_at,
+                photos=dict(checkin["photos"], items=photos),
+            )
+        )
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.json")
+    with open(load_path, "w") as fp:
+        json.dump(checkins, fp)
+    # Checkins already in the database are moved into the partitions
+    result = CliRunner().invoke(cli, [db_path, "--load", load_path, "--silent"])
+    assert 0 == result.exit_code, result.output
+    result = CliRunner().invoke(
+        cli, [db_path, "--load", load_path, "--partition", "year", "--silent"]
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert ["2017", "2018", "2019"] == [
+        row["name"] for row in db["partitions"].rows_where(order_by="name")
+    ]
+    assert "year" == partitions.partition_period(db)
+    assert not {"checkins", "photos", "posts"} & set(db.table_names())
+    assert [] == db.view_names()
+    assert db["venues"].exists()
+    for name, checkin in zip(("2017", "2018", "2019"), checkins):
+        partition = sqlite_utils.Database(str(tmpdir / "swarm-{}.db".format(name)))
+        assert [checkin["id"]] == [row["id"] for row in partition["checkins"].rows]
+    # An incremental import only writes to the newest partition
+    newer = dict(checkins[2], id="checkin3", createdAt=checkins[2]["createdAt"] + 1)
+
+    def fake_get(self, url, params, **kwargs):
+        before = params.get("beforeTimestamp", float("inf"))
+        after = params.get("afterTimestamp", 0)
+        items = [c for c in [newer] + checkins if after < c["createdAt"] < before]
+        return FakeResponse(
+            {"response": {"checkins": {"count": len(items), "items": items}}}
+        )
+
+    monkeypatch.setattr(requests.Session, "get", fake_get)
+    older = [
+        (tmpdir / "swarm-{}.db".format(name)).read_binary() for name in ("2017", "2018")
+    ]
+    result = CliRunner().invoke(
+        cli, [db_path, "--token", "token", "--incremental", "--silent"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert older == [
+        (tmpdir / "swarm-{}.db".format(name)).read_binary() for name in ("2017", "2018")
+    ]
+    # The partitions can be queried through temporary views
+    db = sqlite_utils.Database(db_path)
+    partitions.attach_partitions(db)
+    assert ["checkin3", "checkin2", "checkin1", "checkin0"] == [
+        row[0] for row in db.execute("select id from checkin_details")
+    ]
+    assert 9 == db.execute("select count(*) from photos").fetchone()[0]
+    result = CliRunner().invoke(
+        partitions.cli, ["views", db_path, "--start", "2018", "--end", "2018"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert "as [partition_2018];" in result.output
+    assert "partition_2017" not in result.output
+    assert "partition_2019" not in result.output
+    # The partitioning is fixed once chosen
+    result = CliRunner().invoke(
+        cli, [db_path, "--load", load_path, "--partition", "month"]
+    )
+    assert 0 != result.exit_code
+    assert "Database is already partitioned by year" in result.output
+    result = CliRunner().invoke(cli, [db_path, "--load", load_path, "--compact"])
+    assert 0 != result.exit_code
+    assert "--compact cannot be used with partitioned storage" in result.output
+    result = CliRunner().invoke(cli, [db_path, "--load", load_path, "--rollups"])
+    assert 0 != result.exit_code
+    assert "--rollups cannot be used with partitioned storage" in result.output
+
+
+@pytest.mark.parametrize("period", ["year", "month"])
+def test_partition_then_reimport(tmpdir, period):
+    from swarm_to_sqlite import partitions
+
+    # The fixture's photos are from 2018 and its post from February 2017,
+    # while the checkin is from May 2017. Moving existing rows and importing
+    # them again must put each one in the same partition
+    db_path = str(tmpdir / "c.db")
+    load_path = str(pathlib.Path(__file__).parent / "checkin.json")
+    for args in ([], ["--partition", period], []):
+        result = CliRunner().invoke(cli, [db_path, "--load", load_path] + args)
+        assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    partitions.attach_partitions(db)
+    for table in ("checkins", "photos", "posts"):
+        assert (
+            []
+            == db.execute(
+                "select id from [{}] group by id having count(*) > 1".format(table)
+            ).fetchall()
+        )
+    assert 3 == db.execute("select count(*) from photos").fetchone()[0]
+    checkin_partition = partitions.partition_name(1496001790, period)
+    partition = sqlite_utils.Database(str(tmpdir / "c-{}.db".format(checkin_partition)))
+    assert 1 == partition["posts"].count
+
+
+def test_stats_and_profile(tmpdir):
+    db_path = str(tmpdir / "swarm.db")
+    load_path = str(tmpdir / "checkins.json")
+    stats_path = str(tmpdir / "stats.json")
+    profile_path = str(tmpdir / "import.prof")
+    with open(load_path, "w") as fp:
+        json.dump(load_checkins(), fp)
+    result = CliRunner().invoke(
+        cli,
+        [
+            db_path,
+            "--load",
+            load_path,
+            "--silent",
+            "--stats",
+            "--stats-json",
+            stats_path,
+            "--profile",
+            profile_path,
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert "write checkins" in result.output
+    stats = json.load(open(stats_path))
+    assert stats["sql_statements"] > 0
+    assert 3 == stats["stages"]["transform"]["calls"]
+    assert 3 == stats["stages"]["write checkins"]["rows"]
+    # One call per checkin plus the final one that finds no more
+    assert 4 == stats["stages"]["load"]["calls"]
+    for stage in ("create_tables", "ensure_foreign_keys", "create_views"):
+        assert 1 == stats["stages"][stage]["calls"]
+    assert pathlib.Path(profile_path).stat().st_size > 0
@@ -0,0 +1,392 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from swarm_to_sqlite import utils
+from urllib.parse import parse_qs, urlparse
+import concurrent.futures
+import json
+import pytest
+import requests
+import sqlite_utils
+import threading
+import time
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps(data).encode("utf-8")
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    # Serves pages of two checkins, newest first, honoring beforeTimestamp
+    checkins = [{"id": "c{}".format(i), "createdAt": 1000 + i} for i in range(5)]
+    checkins.reverse()
+    calls = []
+
+    def fake_get(self, url, params, **kwargs):
+        calls.append(dict(params))
+        items = [
+            c
+            for c in checkins
+            if c["createdAt"] < params.get("beforeTimestamp", float("inf"))
+            and c["createdAt"] > params.get("afterTimestamp", 0)
+        ]
+        return FakeResponse(
+            {"response": {"checkins": {"count": len(checkins), "items": items[:2]}}}
+        )
+
+    monkeypatch.setattr(utils.requests.Session, "get", fake_get)
+    return calls
+
+
+def test_fetch_all_checkins(fake_api):
+    checkins = list(utils.fetch_all_checkins("token"))
+    assert ["c4", "c3", "c2", "c1", "c0"] == [c["id"] for c in checkins]
+    assert 4 == len(fake_api)
+
+
+def test_fetch_all_checkins_stop_ids(fake_api):
+    checkins = list(utils.fetch_all_checkins("token", stop_ids={"c3"}))
+    assert ["c4"] == [c["id"] for c in checkins]
+    assert 1 == len(fake_api)
+
+
+def test_incremental_state():
+    db = sqlite_utils.Database(memory=True)
+    assert (None, set()) == utils.incremental_state(db)
+    db["checkins"].insert_all(
+        [
+            {"id": "a", "createdAt": 1001},
+            {"id": "b", "createdAt": 1003},
+            {"id": "c", "createdAt": 1003},
+        ],
+        pk="id",
+    )
+    assert (1003, {"b", "c"}) == utils.incremental_state(db)
+
+
+def test_fetch_all_checkins_after_timestamp(fake_api):
+    checkins = list(utils.fetch_all_checkins("token", after_timestamp=1002))
+    assert ["c4", "c3"] == [c["id"] for c in checkins]
+    assert 1002 == fake_api[0]["afterTimestamp"]
+
+
+@pytest.fixture
+def stub_server():
+    # Local HTTP server serving 25 checkins, 10 per page
+    checkins = [{"id": "c{}".format(i), "createdAt": 1000 + i} for i in range(25)]
+    checkins.reverse()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = {
+                key: int(value[0])
+                for key, value in parse_qs(urlparse(self.path).query).items()
+                if key in ("beforeTimestamp", "afterTimestamp")
+            }
+            items = [
+                c
+                for c in checkins
+                if c["createdAt"] < params.get("beforeTimestamp", float("inf"))
+                and c["createdAt"] > params.get("afterTimestamp", 0)
+            ]
+            body = json.dumps(
+                {
+                    "response": {
+                        "checkins": {"count": len(checkins), "items": items[:10]}
+                    }
+                }
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/v2/users/self/checkins".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+def test_fetch_all_checkins_prefetch(stub_server, prefetch):
+    checkins = utils.fetch_all_checkins(
+        "token", count_first=True, prefetch=prefetch, url=stub_server
+    )
+    assert 25 == next(checkins)
+    assert ["c{}".format(i) for i in reversed(range(25))] == [c["id"] for c in checkins]
+
+
+def test_fetch_all_checkins_prefetch_stop_ids(stub_server):
+    checkins = utils.fetch_all_checkins(
+        "token", stop_ids={"c20"}, prefetch=2, url=stub_server
+    )
+    assert ["c24", "c23", "c22", "c21"] == [c["id"] for c in checkins]
+
+
+def test_prefetched_reraises_errors():
+    def pages():
+        yield 1
+        raise ValueError("Bad page")
+
+    iterator = utils.prefetched(pages(), 2)
+    assert 1 == next(iterator)
+    with pytest.raises(ValueError):
+        next(iterator)
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.headers = {}
+        self.responses = list(responses)
+
+    def get(self, url, params, **kwargs):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_client_retries_with_backoff():
+    sleeps = []
+    page = {"response": {"checkins": {"count": 0, "items": []}}}
+    client = utils.FoursquareClient(
+        session=FakeSession(
+            [
+                FakeResponse({}, status_code=500),
+                FakeResponse({}, status_code=429, headers={"retry-after": "5"}),
+                FakeResponse(page),
+            ]
+        ),
+        sleep=sleeps.append,
+    )
+    assert page == client.get("url", {})
+    assert [1.0, 5.0] == sleeps
+    assert 3 == client.request_count
+    assert 2 == client.retry_count
+    assert len(json.dumps(page)) + 4 == client.bytes_transferred
+
+
+def test_client_retries_network_errors():
+    page = {"response": {"checkins": {"count": 0, "items": []}}}
+    client = utils.FoursquareClient(
+        session=FakeSession(
+            [
+                requests.ConnectionError("Connection reset"),
+                requests.ReadTimeout("Read timed out"),
+                requests.exceptions.ChunkedEncodingError("Connection broken"),
+                FakeResponse(page),
+            ]
+        ),
+        sleep=lambda delay: None,
+    )
+    assert page == client.get("url", {})
+    assert 4 == client.request_count
+    assert 3 == client.retry_count
+
+
+def test_client_gives_up_after_max_retries():
+    client = utils.FoursquareClient(
+        max_retries=2,
+        session=FakeSession([FakeResponse({}, status_code=503)] * 3),
+        sleep=lambda delay: None,
+    )
+    with pytest.raises(requests.HTTPError):
+        client.get("url", {})
+    assert 3 == client.request_count
+
+
+def test_client_waits_for_rate_limit_reset(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(utils.time, "time", lambda: 1000)
+    client = utils.FoursquareClient(
+        session=FakeSession(
+            [
+                FakeResponse(
+                    {},
+                    headers={"x-ratelimit-remaining": "0", "x-ratelimit-reset": "1030"},
+                )
+            ]
+        ),
+        sleep=sleeps.append,
+    )
+    client.get("url", {})
+    assert [30] == sleeps
+
+
+def test_fetch_all_checkins_response_cache(fake_api, tmpdir):
+    cache = utils.ResponseCache(str(tmpdir / "cache"))
+    expected = ["c4", "c3", "c2", "c1", "c0"]
+    checkins = list(utils.fetch_all_checkins("token", response_cache=cache))
+    assert expected == [c["id"] for c in checkins]
+    assert 4 == len(fake_api)
+    # A second fetch, even with a different token, only requests the first page
+    fake_api.clear()
+    checkins = list(utils.fetch_all_checkins("token2", response_cache=cache))
+    assert expected == [c["id"] for c in checkins]
+    assert 1 == len(fake_api)
+    assert (3, 3) == (cache.hits, cache.misses)
+    # Tokens are not written to disk
+    for path in (tmpdir / "cache").listdir():
+        assert b"token" not in path.read_binary()
+
+
+def test_response_cache_skips_error_responses(tmpdir):
+    # An error body for page 2, such as a 403 quota error, is not cached, so
+    # a later fetch with a healthy API gets every checkin
+    checkins = [{"id": "c{}".format(i), "createdAt": 1000 + i} for i in range(4)]
+    checkins.reverse()
+
+    class StubClient:
+        def __init__(self, fail):
+            self.fail = fail
+
+        def get(self, url, params):
+            before = params.get("beforeTimestamp", float("inf"))
+            if self.fail and "beforeTimestamp" in params:
+                return {"meta": {"code": 403, "errorType": "quota_exceeded"}}
+            items = [c for c in checkins if c["createdAt"] < before][:2]
+            return {"meta": {"code": 200}, "response": {"checkins": {"items": items}}}
+
+    cache = utils.ResponseCache(str(tmpdir / "cache"))
+    fetched = utils.fetch_all_checkins(
+        "token", client=StubClient(True), response_cache=cache
+    )
+    assert ["c3", "c2"] == [c["id"] for c in fetched]
+    fetched = utils.fetch_all_checkins(
+        "token", client=StubClient(False), response_cache=cache
+    )
+    assert ["c3", "c2", "c1", "c0"] == [c["id"] for c in fetched]
+    assert 0 == cache.hits
+
+
+def test_response_cache_ttl_and_eviction(tmpdir, monkeypatch):
+    cache = utils.ResponseCache(str(tmpdir), ttl=60, max_bytes=1000)
+    url = utils.CHECKINS_URL
+    cache.set(url, {"oauth_token": "a", "beforeTimestamp": 1}, {"page": 1})
+    assert {"page": 1} == cache.get(url, {"oauth_token": "b", "beforeTimestamp": 1})
+    assert cache.get(url, {"beforeTimestamp": 2}) is None
+    # Entries expire once they are older than the TTL
+    now = utils.time.time()
+    monkeypatch.setattr(utils.time, "time", lambda: now + 61)
+    assert cache.get(url, {"beforeTimestamp": 1}) is None
+    assert [] == tmpdir.listdir()
+    # The least recently used entries are evicted beyond max_bytes
+    for i in range(20):
+        cache.set(url, {"beforeTimestamp": i}, {"page": "x" * i})
+    sizes = [path.size() for path in tmpdir.listdir()]
+    assert sum(sizes) <= 1000
+    assert cache.get(url, {"beforeTimestamp": 19}) == {"page": "x" * 19}
+    assert cache.get(url, {"beforeTimestamp": 0}) is None
+
+
+def test_response_cache_shared_between_threads(tmpdir):
+    # Threads with their own caches or one shared cache delete each other's
+    # entries while reading, writing and evicting them
+    url = utils.CHECKINS_URL
+    shared = utils.ResponseCache(str(tmpdir), ttl=0.01, max_bytes=2000)
+
+    def work(i):
+        cache = shared if i % 2 else utils.ResponseCache(str(tmpdir), max_bytes=2000)
+        for j in range(200):
+            cache.set(url, {"beforeTimestamp": j % 30}, {"page": "x" * (i * j % 50)})
+            cache.get(url, {"beforeTimestamp": (j + i) % 30})
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(work, range(8)))
+    assert not [path for path in tmpdir.listdir() if path.ext == ".tmp"]
+
+
+def test_response_cache_only_scans_when_full(tmpdir, monkeypatch):
+    cache = utils.ResponseCache(str(tmpdir), max_bytes=2000)
+    scans = []
+    entries = cache.entries
+    monkeypatch.setattr(cache, "entries", lambda: scans.append(1) or entries())
+    for i in range(100):
+        cache.set(utils.CHECKINS_URL, {"beforeTimestamp": i}, {"page": i})
+    assert sum(path.size() for path in tmpdir.listdir()) <= 2000
+    assert len(scans) <= 25
+
+
+@pytest.mark.parametrize("inclusive", [False, True])
+def test_fetch_checkins_in_windows(inclusive):
+    # 2,000 checkins over ten years, with a burst of 600 in a single day
+    timestamps = [utils.FIRST_CHECKIN_TIMESTAMP + i * 157680 for i in range(1400)]
+    timestamps += [
+        utils.FIRST_CHECKIN_TIMESTAMP + 10**8 + i * 100 for i in range(600)
+    ]
+    checkins = [
+        {"id": "c{}".format(i), "createdAt": timestamp}
+        for i, timestamp in enumerate(sorted(timestamps, reverse=True))
+    ]
+    lock = threading.Lock()
+    active = []
+    max_active = []
+
+    def fake_get(self, url, params, **kwargs):
+        with lock:
+            active.append(1)
+            max_active.append(len(active))
+        time.sleep(0.01)
+        before = params.get("beforeTimestamp", float("inf"))
+        after = params.get("afterTimestamp", 0)
+        if inclusive:
+            before, after = before + 1, after - 1
+        items = [c for c in checkins if after < c["createdAt"] < before]
+        with lock:
+            active.pop()
+        return FakeResponse(
+            {
+                "response": {
+                    "checkins": {
+                        "count": len(checkins),
+                        "items": items[: int(params["limit"])],
+                    }
+                }
+            }
+        )
+
+    # Each worker gets its own session, rather than patching requests, so
+    # threads left running by other tests cannot add to the count
+    class Session:
+        get = fake_get
+
+        def __init__(self):
+            self.headers = {}
+
+    clients = [utils.FoursquareClient(session=Session()) for _ in range(4)]
+    fetched = list(
+        utils.fetch_checkins_in_windows(
+            "token", workers=4, count_first=True, clients=clients
+        )
+    )
+    assert 2000 == fetched[0]
+    ids = [checkin["id"] for checkin in fetched[1:]]
+    assert len(ids) == len(set(ids))
+    assert {c["id"] for c in checkins} == set(ids)
+    assert 4 == max(max_active)
+
+
+def test_split_window():
+    start = utils.FIRST_CHECKIN_TIMESTAMP
+    assert [
+        (start + 66, start + 100),
+        (start + 33, start + 67),
+        (None, start + 34),
+    ] == utils.split_window(None, start + 100, 3)
+    assert [(start + 10, start + 12)] == utils.split_window(start + 10, start + 12, 4)
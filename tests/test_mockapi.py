@@ -0,0 +1,110 @@
+from click.testing import CliRunner
+from swarm_to_sqlite import benchmark, mockapi, utils
+from swarm_to_sqlite.synthetic import generate_checkins
+import json
+import pytest
+import requests
+import sqlite_utils
+
+
+@pytest.fixture
+def checkins():
+    return list(generate_checkins(60, seed=1))
+
+
+def get_page(api, **params):
+    status, headers, body = api.handle(
+        "/v2/users/self/checkins", dict(params, oauth_token="token")
+    )
+    assert 200 == status
+    return json.loads(body)["response"]["checkins"]
+
+
+def test_paging_parameters(checkins):
+    api = mockapi.MockFoursquareAPI(checkins, max_limit=25)
+    created = [checkin["createdAt"] for checkin in checkins]
+    page = get_page(api)
+    assert 60 == page["count"]
+    assert created[:25] == [item["createdAt"] for item in page["items"]]
+    page = get_page(api, limit=5, offset=2)
+    assert created[2:7] == [item["createdAt"] for item in page["items"]]
+    # Both timestamps are exclusive
+    page = get_page(api, beforeTimestamp=created[10], afterTimestamp=created[20])
+    assert created[11:20] == [item["createdAt"] for item in page["items"]]
+    page = get_page(api, afterTimestamp=created[3], sort="oldestfirst")
+    assert created[:3][::-1] == [item["createdAt"] for item in page["items"]]
+    assert 4 == api.stats()["pages"]
+
+
+def test_errors_and_rate_limit(checkins):
+    api = mockapi.MockFoursquareAPI(checkins, rate_limit=2)
+    assert 401 == api.handle("/v2/users/self/checkins", {})[0]
+    status, headers, _ = api.handle("/v2/users/self", {"oauth_token": "token"})
+    assert 200 == status
+    assert "0" == headers["X-RateLimit-Remaining"]
+    status, headers, body = api.handle("/v2/users/self", {"oauth_token": "token"})
+    assert 429 == status
+    assert "rate_limit_exceeded" == json.loads(body)["meta"]["errorType"]
+    assert int(headers["Retry-After"]) > 0
+    api = mockapi.MockFoursquareAPI(checkins, error_rate=0.5, seed=1)
+    statuses = [
+        api.handle("/v2/users/self/checkins", {"oauth_token": "token"})[0]
+        for _ in range(20)
+    ]
+    assert {200, 500} == set(statuses)
+    assert statuses.count(500) == api.stats()["errors"]
+
+
+def test_fetch_all_checkins_with_errors(checkins):
+    api = mockapi.MockFoursquareAPI(checkins, max_limit=7, error_rate=0.3, seed=2)
+    api_url = api.start()
+    try:
+        client = utils.FoursquareClient(backoff=0, session=requests.Session())
+        fetched = list(
+            utils.fetch_all_checkins(
+                "token", url=api_url + "/users/self/checkins", client=client
+            )
+        )
+    finally:
+        api.stop()
+    assert [c["id"] for c in checkins] == [c["id"] for c in fetched]
+    assert client.retry_count == api.stats()["errors"] > 0
+
+
+@pytest.mark.parametrize("args", [[], ["--parallel", "3"]])
+def test_benchmark_cli(checkins, tmpdir, args):
+    api = mockapi.MockFoursquareAPI(checkins, max_limit=10)
+    db_path = str(tmpdir / "swarm.db")
+    result = mockapi.benchmark_cli(api, db_path, args)
+    assert 60 == result["checkins_served"]
+    assert result["pages"] >= 7
+    assert result["pages_per_second"] > 0
+    assert result["checkins_per_second"] > 0
+    db = sqlite_utils.Database(db_path)
+    assert {c["id"] for c in checkins} == {row["id"] for row in db["checkins"].rows}
+    # An incremental import only fetches the first page
+    new = dict(checkins[0], id="new", createdAt=checkins[0]["createdAt"] + 60)
+    api = mockapi.MockFoursquareAPI([new] + checkins, max_limit=10)
+    result = mockapi.benchmark_cli(api, db_path, ["--incremental"])
+    assert 1 == result["checkins_served"]
+    assert 61 == db["checkins"].count
+
+
+def test_benchmark_command(tmpdir):
+    load_path = str(tmpdir / "checkins.json")
+    with open(load_path, "w") as fp:
+        json.dump(list(generate_checkins(30, seed=3)), fp)
+    result = CliRunner().invoke(
+        mockapi.cli,
+        ["benchmark", "--load", load_path, "--max-limit", "10", "--", "--bulk"],
+    )
+    assert 0 == result.exit_code, result.output
+    output = json.loads(result.output)
+    assert ["--bulk"] == output["options"]["args"]
+    assert 30 == output["result"]["checkins_served"]
+    assert 4 == output["result"]["pages"]
+
+
+def test_fetch_benchmark():
+    results = benchmark.run_benchmarks(["fetch"], isolate=False, count=20)
+    assert results["results"][0]["pages_per_second"] > 0
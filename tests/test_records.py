@@ -0,0 +1,62 @@
+from swarm_to_sqlite import records, utils
+from swarm_to_sqlite.synthetic import generate_checkins
+import copy
+import json
+import pathlib
+import pytest
+
+
+def load_checkin():
+    json_path = pathlib.Path(__file__).parent / "checkin.json"
+    return json.load(open(json_path, "r"))
+
+
+def test_checkin_from_json_does_not_modify_json():
+    checkin = load_checkin()
+    original = copy.deepcopy(checkin)
+    record = records.Checkin.from_json(checkin)
+    assert original == checkin
+    # So the same JSON can be flattened again
+    assert record.rows() == records.Checkin.from_json(checkin).rows()
+    assert utils.flatten_checkin(checkin) == record.rows()
+
+
+def test_checkin_records():
+    record = records.Checkin.from_json(load_checkin())
+    assert isinstance(record.venue, records.Venue)
+    assert isinstance(record.venue.categories[0], records.Category)
+    assert isinstance(record.event, records.Event)
+    assert isinstance(record.sticker, records.Sticker)
+    assert all(isinstance(user, records.User) for user in record.likes)
+    assert isinstance(record.photos[0].user, records.User)
+    assert isinstance(record.posts[0].post_source, records.PostSource)
+    assert record.id == record.posts[0].checkin
+    for value in (record, record.venue, record.photos[0], record.posts[0]):
+        assert not hasattr(value, "__dict__")
+
+
+def test_unknown_and_missing_keys():
+    user = records.User.from_json(
+        {"id": "1", "firstName": "Sam", "lastName": "Jones", "canonicalUrl": "u"}
+    )
+    assert {
+        "id": "1",
+        "firstName": "Sam",
+        "lastName": "Jones",
+        "photo_prefix": None,
+        "photo_suffix": None,
+        "canonicalUrl": "u",
+    } == user.row()
+    with pytest.raises(AttributeError):
+        user.nickname = "Sammy"
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_flatten_synthetic_checkins(seed):
+    for checkin in generate_checkins(20, photos=1, posts=1, likes=2, seed=seed):
+        rows = utils.flatten_checkin(checkin)
+        assert [checkin["id"]] == [row["id"] for row in rows["checkins"]]
+        assert checkin["venue"]["location"]["lat"] == rows["venues"][0]["latitude"]
+        assert "location" not in rows["venues"][0]
+        assert len(checkin["photos"]["items"]) == len(rows.get("photos", []))
+        assert len(checkin["posts"]["items"]) == len(rows.get("posts", []))
@@ -1,8 +1,10 @@
-from swarm_to_sqlite import utils
+from swarm_to_sqlite import compact, partitions, rollups, utils, venues
 import pytest
 import json
 import sqlite_utils
 from sqlite_utils.db import ForeignKey
+import copy
+import io
 import pathlib
 
 
@@ -300,3 +302,468 @@ def test_view(converted):
             "longitude": -122.345,
         }
     ] == list(converted["venue_details"].rows)
+
+
+def make_checkins(count):
+    checkins = []
+    for i in range(count):
+        checkin = load_checkin()
+        checkin["id"] = "checkin{}".format(i)
+        checkin["createdAt"] += i
+        if i % 2:
+            del checkin["event"]
+            del checkin["sticker"]
+        checkins.append(checkin)
+    return checkins
+
+
+def sort_key(row):
+    return json.dumps(row, sort_keys=True)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 100])
+def test_save_checkins_batched_matches_original_save_checkin(batch_size):
+    # save_checkin_expected.json holds the rows of every table after saving
+    # make_checkins(5) one at a time with the original, row by row save_checkin()
+    json_path = pathlib.Path(__file__).parent / "save_checkin_expected.json"
+    expected = json.load(open(json_path))
+    db = sqlite_utils.Database(":memory:")
+    utils.save_checkins(make_checkins(5), db, batch_size=batch_size)
+    for table, expected_rows in expected.items():
+        rows = list(db[table].rows)
+        columns = set(expected_rows[0])
+        # Columns created up front that the original never wrote stay empty
+        assert [] == [
+            (key, value)
+            for row in rows
+            for key, value in row.items()
+            if key not in columns and value is not None
+        ]
+        rows = [{key: row[key] for key in columns} for row in rows]
+        assert sorted(expected_rows, key=sort_key) == sorted(rows, key=sort_key)
+    assert set(expected) <= set(db.table_names())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+@pytest.mark.parametrize(
+    "content",
+    [
+        b'[{"id": 1, "name": "caf\xc3\xa9"}, {"id": 2, "items": [1, 2]}]',
+        b'  [\n  {"id": 1, "name": "caf\xc3\xa9"},\n  {"id": 2, "items": [1, 2]}\n]\n',
+        b'{"id": 1, "name": "caf\xc3\xa9"}\n{"id": 2, "items": [1, 2]}\n',
+    ],
+)
+def test_iter_json_records(content, chunk_size):
+    sizes = []
+    records = list(
+        utils.iter_json_records(
+            io.BytesIO(content), chunk_size=chunk_size, progress=sizes.append
+        )
+    )
+    assert [{"id": 1, "name": "café"}, {"id": 2, "items": [1, 2]}] == records
+    assert len(content) == sum(sizes)
+
+
+@pytest.mark.parametrize("content", [b"[]", b"", b"\n"])
+def test_iter_json_records_empty(content):
+    assert [] == list(utils.iter_json_records(io.BytesIO(content)))
+
+
+@pytest.mark.parametrize("content", [b'[{"id": 1}', b'[{"id": 1} {"id": 2}]'])
+def test_iter_json_records_invalid(content):
+    with pytest.raises(ValueError):
+        list(utils.iter_json_records(io.BytesIO(content), chunk_size=4))
+
+
+def test_save_checkins_with_cache():
+    expected = sqlite_utils.Database(":memory:")
+    utils.save_checkins(make_checkins(5), expected)
+    db = sqlite_utils.Database(":memory:")
+    cache = utils.ImportCache()
+    utils.save_checkins(make_checkins(5), db, batch_size=2, cache=cache)
+    # Same content, though rows are no longer rewritten so may be in a
+    # different order
+    assert sorted(expected.conn.iterdump()) == sorted(db.conn.iterdump())
+    rates = cache.hit_rates()
+    assert 0.8 == rates["venues"]
+    # 3 photo sources and a checkin source per checkin, only one distinct
+    assert 0.95 == rates["sources"]
+
+
+def test_import_cache_evicts_least_recently_used():
+    cache = utils.ImportCache(max_size=2)
+    assert not cache.seen("users", {"id": "1"})
+    assert not cache.seen("users", {"id": "2"})
+    assert cache.seen("users", {"id": "1"})
+    assert not cache.seen("users", {"id": "3"})
+    # 2 was least recently used so has been evicted
+    assert not cache.seen("users", {"id": "2"})
+    assert cache.seen("users", {"id": "3"})
+    # Changed rows are not treated as seen
+    assert not cache.seen("users", {"id": "3", "firstName": "Cleo"})
+
+
+def test_create_tables():
+    expected = sqlite_utils.Database(":memory:")
+    utils.save_checkins(make_checkins(3), expected)
+    utils.ensure_foreign_keys(expected)
+    db = sqlite_utils.Database(":memory:")
+    utils.create_tables(db)
+    assert {
+        ForeignKey("checkins", "createdBy", "users", "id"),
+        ForeignKey("checkins", "event", "events", "id"),
+        ForeignKey("checkins", "sticker", "stickers", "id"),
+        ForeignKey("checkins", "source", "sources", "id"),
+        ForeignKey("checkins", "venue", "venues", "id"),
+    } == set(db["checkins"].foreign_keys)
+    checkins = make_checkins(3)
+    checkins[2]["newField"] = "new"
+    utils.save_checkins(checkins, db)
+    utils.ensure_foreign_keys(db)
+    for table in expected.table_names():
+        assert expected[table].columns_dict.items() <= db[table].columns_dict.items()
+        assert set(expected[table].foreign_keys) == set(db[table].foreign_keys)
+        assert list(expected[table].rows) == [
+            {key: value for key, value in row.items() if key != "newField"}
+            for row in db[table].rows
+        ]
+    assert "new" == db["checkins"].get("checkin2")["newField"]
+
+
+def test_create_indexes(converted):
+    utils.create_indexes(converted)
+    indexed = {
+        (table.name, tuple(index.columns))
+        for table in converted.tables
+        for index in table.indexes
+    }
+    assert ("checkins", ("venue",)) in indexed
+    assert ("checkins", ("createdAt",)) in indexed
+    assert ("photos", ("user",)) in indexed
+
+
+def test_materialize_views():
+    db = sqlite_utils.Database(":memory:")
+    utils.save_checkins(make_checkins(3), db)
+    utils.create_views(db)
+    expected = {name: list(db[name].rows) for name in utils.VIEWS}
+    utils.materialize_views(db)
+    assert not db.view_names()
+    assert utils.has_materialized_views(db)
+    for name in utils.VIEWS:
+        assert sorted(expected[name], key=lambda r: r["id"]) == sorted(
+            db[name].rows, key=lambda r: r["id"]
+        )
+    # Only rows for the specified checkins should be refreshed
+    db["checkins"].update("checkin0", {"shout": "Updated"})
+    db["checkins"].update("checkin1", {"shout": "Not refreshed"})
+    utils.materialize_views(db, checkin_ids={"checkin0"}, venue_ids=set())
+    shouts = {row["id"]: row["shout"] for row in db["checkin_details"].rows}
+    assert "Updated" == shouts["checkin0"]
+    assert "Not refreshed" != shouts["checkin1"]
+    assert 3 == db["checkin_details"].count
+    # Checkins at a refreshed venue pick up its new details
+    db["venues"].update("453774dcf964a520bd3b1fe3", {"name": "Renamed"})
+    utils.materialize_views(
+        db, checkin_ids={"checkin0"}, venue_ids={"453774dcf964a520bd3b1fe3"}
+    )
+    assert {"Renamed"} == {row["venue_name"] for row in db["checkin_details"].rows}
+    assert [3] == [row["count"] for row in db["venue_details"].rows]
+
+
+def test_save_checkins_skip_unchanged():
+    db = sqlite_utils.Database(":memory:")
+    changes = utils.ChangeDetector()
+    utils.save_checkins(make_checkins(3), db, changes=changes)
+    assert {"inserted": 3} == changes.counts["checkins"]
+    assert {"inserted": 5} == changes.counts["users"]
+    expected = list(db.conn.iterdump())
+    # Importing the same checkins again should write nothing
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    changes = utils.ChangeDetector()
+    checkins = make_checkins(3)
+    utils.save_checkins(checkins, db, changes=changes)
+    db.conn.set_trace_callback(None)
+    assert not [s for s in statements if s.upper().startswith("INSERT")]
+    assert {"unchanged": 3} == changes.counts["checkins"]
+    assert expected == list(db.conn.iterdump())
+    # Changed checkins should be written
+    checkins = make_checkins(3)
+    checkins[1]["shout"] = "Changed"
+    changes = utils.ChangeDetector()
+    utils.save_checkins(checkins, db, changes=changes)
+    assert {"unchanged": 2, "updated": 1} == changes.counts["checkins"]
+    assert "Changed" == db["checkins"].get("checkin1")["shout"]
+    assert "checkins: 0 inserted, 1 updated, 2 unchanged" in changes.summary()
+
+
+def test_save_checkins_commit_every(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "swarm.db"))
+
+    def checkins_then_error():
+        for checkin in make_checkins(5):
+            yield checkin
+        raise IOError("Connection lost")
+
+    with pytest.raises(IOError):
+        utils.save_checkins(checkins_then_error(), db, batch_size=1, commit_every=2)
+    # The first four checkins were committed, the fifth rolled back
+    db = sqlite_utils.Database(str(tmpdir / "swarm.db"))
+    assert ["checkin0", "checkin1", "checkin2", "checkin3"] == [
+        row["id"] for row in db["checkins"].rows
+    ]
+    assert 4 == db["with"].count
+    assert (1496001793, {"checkin3"}) == utils.incremental_state(db)
+
+
+def test_bulk_import_mode(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "swarm.db"))
+
+    def pragmas():
+        return [
+            db.execute("pragma {}".format(pragma)).fetchone()[0]
+            for pragma in ("journal_mode", "synchronous", "cache_size")
+        ]
+
+    before = pragmas()
+    with utils.bulk_import_mode(db, cache_size_mb=8):
+        assert ["wal", 1, -8192] == pragmas()
+        utils.save_checkins(make_checkins(3), db)
+    assert before == pragmas()
+    assert 3 == db["checkins"].count
+
+
+@pytest.mark.parametrize("cache", [None, utils.ImportCache])
+def test_save_checkins_processes(cache):
+    expected = sqlite_utils.Database(":memory:")
+    utils.save_checkins(make_checkins(7), expected, cache=cache and cache())
+    db = sqlite_utils.Database(":memory:")
+    utils.save_checkins(make_checkins(7), db, cache=cache and cache(), processes=2)
+    assert list(expected.conn.iterdump()) == list(db.conn.iterdump())
+
+
+def test_flatten_in_processes():
+    checkins = make_checkins(250)
+    # Workers decode checkins passed as undecoded JSON
+    mixed = [json.dumps(c) if i % 2 else c for i, c in enumerate(checkins)]
+    flattened = list(utils.flatten_in_processes(iter(mixed), 2, shard_size=7))
+    assert [c["id"] for c in checkins] == [
+        rows["checkins"][0]["id"] for rows, _ in flattened
+    ]
+    rows, key_hashes = flattened[0]
+    assert set(key_hashes) == set(rows) & utils.CACHED_TABLES
+    assert [
+        (utils.row_key("users", row), utils.row_hash(row)) for row in rows["users"]
+    ] == key_hashes["users"]
+
+
+def test_iter_json_records_raw():
+    content = b'{"id": 1}\n\n{"id": 2, "name": "caf\xc3\xa9"}\n{"id": 3}'
+    for chunk_size in (1, 5, 1024):
+        records = utils.iter_json_records(
+            io.BytesIO(content), chunk_size=chunk_size, raw=True
+        )
+        assert ['{"id": 1}', '{"id": 2, "name": "café"}', '{"id": 3}'] == list(records)
+    # Records in a JSON array are still decoded
+    records = utils.iter_json_records(io.BytesIO(b'[{"id": 1}]'), raw=True)
+    assert [{"id": 1}] == list(records)
+
+
+def test_spatial_index():
+    from swarm_to_sqlite.synthetic import generate_checkins
+
+    db = sqlite_utils.Database(memory=True)
+    checkins = list(generate_checkins(200, seed=1))
+    utils.save_checkins(checkins[:100], db)
+    venues.enable_spatial_index(db)
+    # Venues saved later are added by triggers, including replaced venues
+    utils.save_checkins(checkins[100:], db)
+    assert db["venues"].count == db["venues_rtree"].count
+    assert (
+        []
+        == db.execute(
+            "select id from venues_rtree where id not in (select rowid from venues)"
+        ).fetchall()
+    )
+    venue_rows = list(db["venues"].rows)
+    for latitude, longitude in ((37.77, -122.42), (51.5, -0.1), (0, 0)):
+        expected = sorted(
+            venue_rows,
+            key=lambda v: venues.distance(
+                latitude, longitude, v["latitude"], v["longitude"]
+            ),
+        )[:5]
+        nearest = venues.nearest_venues(db, latitude, longitude, limit=5)
+        assert [v["id"] for v in expected] == [v["id"] for v in nearest]
+    in_bbox = {v["id"] for v in venues.venues_in_bbox(db, 37, -123, 38, -122)}
+    assert in_bbox == {
+        v["id"]
+        for v in venue_rows
+        if 37 <= v["latitude"] <= 38 and -123 <= v["longitude"] <= -122
+    }
+
+
+def test_venues_in_bbox_crossing_antimeridian():
+    db = sqlite_utils.Database(memory=True)
+    utils.create_tables(db)
+    venues.enable_spatial_index(db)
+    db["venues"].insert_all(
+        [
+            {"id": "fiji", "latitude": -17.7, "longitude": 178.1},
+            {"id": "samoa", "latitude": -13.8, "longitude": -171.8},
+            {"id": "sydney", "latitude": -33.9, "longitude": 151.2},
+        ]
+    )
+    assert ["fiji", "samoa"] == [
+        v["id"] for v in venues.venues_in_bbox(db, -20, 170, -10, -170)
+    ]
+    assert ["fiji", "samoa"] == [
+        v["id"] for v in venues.nearest_venues(db, -15, 179.9, limit=2)
+    ]
+
+
+def test_search_index():
+    db = sqlite_utils.Database(memory=True)
+    utils.create_tables(db)
+    checkins = make_checkins(4)
+    utils.save_checkins(checkins[:2], db)
+    utils.enable_search_index(db)
+    assert {"checkins_fts", "venues_fts", "events_fts"} <= set(db.table_names())
+
+    def search(table, q):
+        return sorted(row["id"] for row in db[table].search(q))
+
+    assert ["checkin0", "checkin1"] == search("checkins", "anniversary")
+    # Rows saved later, including replaced rows, are indexed by triggers
+    checkins[2]["shout"] = "A brand new shout"
+    checkins[3]["venue"]["name"] = "Renamed Venue"
+    utils.save_checkins(checkins[2:], db)
+    assert ["checkin2"] == search("checkins", "brand")
+    assert [checkins[3]["venue"]["id"]] == search("venues", "renamed")
+    assert [] == search("venues", '"Restaurant Name"')
+    assert 1 == len(search("events", "movie"))
+    db.execute("insert into checkins_fts(checkins_fts) values('integrity-check')")
+    db.execute("insert into venues_fts(venues_fts) values('integrity-check')")
+
+
+@pytest.mark.parametrize("convert_existing", [False, True])
+def test_compact_storage(convert_existing):
+    from swarm_to_sqlite.synthetic import generate_checkins
+
+    checkins = list(generate_checkins(300, photos=2, posts=1, seed=2))
+    checkins[0]["posts"]["items"][0]["url"] = "https://example.com/post"
+    # Null URLs are not reconstructed from the contentId
+    checkins[1]["posts"]["items"][0]["url"] = None
+    checkins[150]["posts"]["items"][0]["url"] = None
+    expected = sqlite_utils.Database(memory=True)
+    utils.create_tables(expected)
+    utils.save_checkins(copy.deepcopy(checkins), expected)
+    db = sqlite_utils.Database(memory=True)
+    utils.create_tables(db)
+    if convert_existing:
+        utils.save_checkins(copy.deepcopy(checkins[:100]), db)
+        compact.enable_compact_storage(db)
+    else:
+        compact.enable_compact_storage(db)
+        utils.save_checkins(copy.deepcopy(checkins[:100]), db, compact=True)
+    utils.save_checkins(
+        copy.deepcopy(checkins[100:]), db, compact=True, cache=utils.ImportCache()
+    )
+    utils.create_tables(db)
+    assert {"photos", "posts"} <= set(db.view_names())
+    for table in ("photos", "posts"):
+        sql = "select * from [{}] order by id".format(table)
+        assert expected.execute(sql).fetchall() == db.execute(sql).fetchall()
+        assert list(expected[table].columns_dict) == list(db[table].columns_dict)
+    assert 2 == db.execute("select count(*) from posts where url is null").fetchone()[0]
+    report = compact.compact_storage_report(db)
+    assert {"photos", "posts"} == set(report)
+    for sizes in report.values():
+        assert sizes["saved_bytes"] > 0
+        assert sizes["compact_bytes"] + sizes["saved_bytes"] == sizes["original_bytes"]
+
+
+def test_compact_storage_report_without_dbstat(monkeypatch):
+    db = sqlite_utils.Database(memory=True)
+    utils.create_tables(db)
+    compact.enable_compact_storage(db)
+    monkeypatch.setattr(compact, "has_dbstat", lambda db: False)
+    assert compact.compact_storage_report(db) is None
+
+
+def test_compact_views_upgrade_url_derived():
+    # Compact tables created before url_derived have derived URLs as nulls
+    db = sqlite_utils.Database(memory=True)
+    utils.create_tables(db)
+    compact.enable_compact_storage(db)
+    db["posts_compact"].transform(drop=["url_derived"])
+    db["posts_compact"].insert({"id": "1", "url": None, "contentId": "abc"})
+    compact.create_compact_views(db)
+    assert [(compact.POST_URL_PREFIX + "abc",)] == db.execute(
+        "select url from posts"
+    ).fetchall()
+
+
+@pytest.mark.parametrize(
+    "created_at,period,name,bounds",
+    [
+        (1496001790, "year", "2017", (1483228800, 1514764800)),
+        (1496001790, "month", "2017-05", (1493596800, 1496275200)),
+        (1545436800, "month", "2018-12", (1543622400, 1546300800)),
+    ],
+)
+def test_partition_name_and_bounds(created_at, period, name, bounds):
+    assert name == partitions.partition_name(created_at, period)
+    assert bounds == partitions.partition_bounds(name)
+    assert bounds[0] <= created_at < bounds[1]
+
+
+def test_rollups_match_rebuild():
+    from swarm_to_sqlite.synthetic import generate_checkins
+    import datetime
+
+    db = sqlite_utils.Database(memory=True)
+    checkins = list(generate_checkins(200, seed=2))
+    utils.save_checkins(checkins[:100], db)
+    utils.create_indexes(db)
+    rollups.enable_rollups(db)
+    assert rollups.has_rollups(db)
+    # Recreating checkins to add foreign keys keeps the rollup triggers
+    utils.ensure_foreign_keys(db)
+    assert "rollup_days_checkins_insert" in db.triggers_dict
+    # Later imports add new checkins and replace existing ones, some of them
+    # at venues that have moved city or gained a category
+    changed = copy.deepcopy(checkins[50:])
+    for checkin in changed[:20]:
+        checkin["createdAt"] += 3 * 24 * 60 * 60
+        checkin["venue"]["location"]["city"] = "Elsewhere"
+        checkin["venue"]["categories"].append(
+            dict(checkin["venue"]["categories"][0], id="new", primary=False)
+        )
+    utils.save_checkins(changed, db, cache=utils.ImportCache(100))
+
+    def rollup_rows():
+        return {
+            name: {tuple(row.values()) for row in db[name].rows}
+            for name in rollups.ROLLUPS
+        }
+
+    incremental = rollup_rows()
+    rollups.rebuild_rollups(db)
+    assert rollup_rows() == incremental
+    assert 200 == sum(row[-1] for row in incremental["rollup_days"])
+    assert 200 == sum(row[-1] for row in incremental["rollup_weeks"])
+    assert all(
+        datetime.date.fromisoformat(week).weekday() == 0
+        for week, _ in incremental["rollup_weeks"]
+    )
+    elsewhere = db.execute(
+        "select count(*) from checkins join venues on venues.id = checkins.venue "
+        "where venues.city = 'Elsewhere'"
+    ).fetchone()[0]
+    assert elsewhere > 0
+    assert elsewhere == sum(
+        count for _, city, count in incremental["rollup_cities"] if city == "Elsewhere"
+    )
+    assert "new" in {category for category, _ in incremental["rollup_categories"]}